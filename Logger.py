@@ -3,14 +3,12 @@ Rickie Kerndt <rkerndt@cs.uoregon.edu>
 Subscribes to all tc\ messages and output message payload to file.
 """
 
-from TC_server import TC, TC_Exception, TC_Identifier
+from TC_server import TC, TC_Exception, TC_Identifier, TC_Scheduler, Message_filter
 import paho.mqtt.client as mqtt
 import socket
 from time import sleep
 import signal
 import sys
-from ctypes import *
-import threading
 import os
 
 class TC_Logger(TC):
@@ -46,7 +44,10 @@ class TC_Logger(TC):
         self.watchdog_sec = None
 
         # load needed dynamic libraries
-        self._libsystemd = CDLL("libsystemd.so")
+        self._libsystemd = TC.load_libsystemd()
+
+        # flag redelivered messages, memory stays fixed however many users are seen on tc/#
+        self._seen_mids = Message_filter()
 
 
     def run(self):
@@ -56,7 +57,7 @@ class TC_Logger(TC):
         """
 
         #tell systemd we are ready
-        result = self._libsystemd.sd_pid_notify(self.watchdog_pid,0,"READY=1".encode('ascii'))
+        result = self.sd_notify("READY=1")
         if result <= 0:
             msg = "Error %d sending sd_pid_notify READY" % (result,)
             self.output_log(msg)
@@ -97,8 +98,8 @@ class TC_Logger(TC):
                 self.output_error(msg)
                 exit(1)
 
-        # subscribe to base topic to pick up all messages
-        self.mqttc.subscribe(self.tc_topic)
+        # subscribe to base topic to pick up all messages, at TC._qos so they arrive with their message ids
+        self.mqttc.subscribe(self.subscriptions)
 
         # enter network loop forever, relying on interrupt handler to stop things
         self.mqttc.loop_forever()
@@ -113,6 +114,7 @@ class TC_Logger(TC):
         self.mqttc.disconnect()
         if self._watchdog_timer:
             self._watchdog_timer.cancel()
+        self._seen_mids.stop()
 
 
     def watchdog(self):
@@ -127,18 +129,20 @@ class TC_Logger(TC):
         if self.debug_level > 3:
             msg = "Running watchdog for pid %d, timeout in %d seconds" % (self.watchdog_pid, self.watchdog_sec)
             self.output_log(msg)
+            msg = "Seen message ids %(keys)d, filter memory %(memory)d bytes, saturated %(saturated)s" % \
+                  self._seen_mids.stats()
+            self.output_log(msg)
 
         result = 1
 
         # load the library at run time using cdll
         if self._healthy:
-            result = self._libsystemd.sd_pid_notify(self.watchdog_pid,0,"WATCHDOG=1".encode('ascii'))
+            result = self.sd_notify("WATCHDOG=1")
 
         if result <= 0:
             msg = "Error (%d) in sd_pid_notify" % (result,)
             self.output_log(msg)
-        self._watchdog_timer = threading.Timer(self.watchdog_sec/TC.WATCHDOG_INTERVAL, self.watchdog)
-        self._watchdog_timer.start()
+        self._watchdog_timer = TC_Scheduler.get().schedule(self.watchdog_sec/TC.WATCHDOG_INTERVAL, self.watchdog)
         self._healthy = False
 
 
@@ -166,11 +170,14 @@ class TC_Logger(TC):
         request = None
 
         try:
-            request = TC.decode(msg)
+            request = TC.decode(msg, lazy=True)
         except TC_Exception as err:
             userdata.output_error(err.msg)
         if request:
-            log_msg = "[%s] %s" % (msg.topic, request.__str__())
+            if isinstance(request, TC_Identifier) and userdata._seen_mids.is_duplicate(request):
+                log_msg = "[%s] duplicate %s" % (msg.topic, request.__str__())
+            else:
+                log_msg = "[%s] %s" % (msg.topic, request.__str__())
             userdata.output_log(log_msg)
         else:
             log_msg = "Request decode failed for message %s <%s>" % (msg.mid, msg.payload)
@@ -0,0 +1,609 @@
+#!/usr/bin/python3
+"""
+Micro benchmarks for the TC_server hot paths. Runs off device, no broker connection is made.
+
+usage: TC_benchmark.py [name ...]
+"""
+
+import contextlib
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+import tracemalloc
+import struct
+import paho.mqtt.client as mqtt
+import grovepi
+from time import monotonic, sleep
+from TC_server import TC, TC_Request_On, TC_Request_Off, TC_ACK, TC_Identifier, TC_Admin, TC_ACK_Cache, TC_Scheduler, \
+    TC_phase_request, TC_ACK_Multi, Server, Server_Host, Message_tracker, Message_filter, TC_Dedup_Store, tc_codec
+from grovepi_sim import SimulatedBus, SimulatedRelayIO
+
+USER_ID = 'cyclist_0042'
+CONTROLLER_ID = 'beacon_1.cs.uoregon.edu'
+
+
+def make_msg(payload, mid=1, topic=TC._tc_topic_format % CONTROLLER_ID):
+    """
+    Builds an MQTTMessage as paho would hand it to a topic callback
+    :param payload: bytes
+    :param mid: int
+    :param topic: str
+    :return: MQTTMessage
+    """
+    msg = mqtt.MQTTMessage(mid=mid, topic=topic.encode('utf-8'))
+    msg.payload = bytes(payload)
+    return msg
+
+
+def report(name, count, seconds):
+    """
+    Prints throughput for one benchmark
+    :param name: str
+    :param count: int number of operations timed
+    :param seconds: float
+    :return: None
+    """
+    print("%-32s %10.0f ops/s %8.2f us/op" % (name, count / seconds, 1e6 * seconds / count))
+
+
+def bench_codec(count=100000):
+    """
+    Decode and encode throughput of the c_struct payloads through the codec registry
+    """
+    request = make_msg(TC_Request_On(USER_ID, CONTROLLER_ID, 2).encode())
+    ack = make_msg(TC_ACK(USER_ID, 7, TC.ACK_OK).encode())
+    ident = make_msg(TC_Identifier(TC.ID, USER_ID).encode())
+    report("decode request", count, timeit.timeit(lambda: TC.decode(request), number=count))
+    report("decode request lazy", count, timeit.timeit(lambda: TC.decode(request, lazy=True), number=count))
+    report("decode request lazy + id", count, timeit.timeit(lambda: TC.decode(request, lazy=True).id, number=count))
+    report("decode ack", count, timeit.timeit(lambda: TC.decode(ack), number=count))
+    report("decode id", count, timeit.timeit(lambda: TC.decode(ident), number=count))
+    json_request = make_msg(TC_Request_On(USER_ID, CONTROLLER_ID, 2).json_dumps().encode('utf-8'))
+    report("decode json request", count, timeit.timeit(lambda: TC.decode(json_request), number=count))
+
+    tc_request = TC_Request_On(USER_ID, CONTROLLER_ID, 2)
+    buffer = bytearray(tc_codec.get_struct(TC.PHASE_REQUEST_ON).size)
+    report("encode request", count, timeit.timeit(tc_request.encode, number=count))
+    report("pack_into request", count, timeit.timeit(lambda: tc_request.pack_into(buffer), number=count))
+
+
+def bench_memory(count=10000):
+    """
+    Memory retained per decoded message and construction time with and without a known timestamp
+    """
+    msgs = [make_msg(TC_Request_On(USER_ID, CONTROLLER_ID, 2).encode(), mid) for mid in range(count)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    decoded = [TC.decode(msg) for msg in msgs]
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%-32s %10.1f bytes/msg" % ("retained per decoded request", retained / len(decoded)))
+
+    report("construct request", count, timeit.timeit(lambda: TC_Request_On(USER_ID, CONTROLLER_ID, 2), number=count))
+    report("construct request timestamp", count,
+           timeit.timeit(lambda: TC_Request_On(USER_ID, CONTROLLER_ID, 2, 1500000000), number=count))
+
+
+def bench_wire():
+    """
+    Payload bytes of c_struct (v1) versus v2 encodings for typical ids, and v2 codec throughput
+    """
+    commands = [('request', TC_Request_On(USER_ID, CONTROLLER_ID, 2)),
+                ('ack', TC_ACK(USER_ID, 4711, TC.ACK_OK)),
+                ('id', TC_Identifier(TC.ID, USER_ID)),
+                ('admin', TC_Admin(TC.ADMIN_WIFI_ENABLE, USER_ID, CONTROLLER_ID))]
+    for name, tc_cmd in commands:
+        v1 = len(tc_cmd.encode())
+        v2 = len(tc_cmd.encode_v2())
+        print("%-32s v1 %4d bytes  v2 %4d bytes  (%.0f%%)" % (name, v1, v2, 100.0 * v2 / v1))
+
+    count = 100000
+    request = commands[0][1]
+    msg = make_msg(request.encode_v2())
+    report("encode_v2 request", count, timeit.timeit(request.encode_v2, number=count))
+    report("decode v2 request", count, timeit.timeit(lambda: TC.decode(msg), number=count))
+
+
+def bench_ack(count=100000):
+    """
+    Cost of producing an ACK payload by building and encoding a TC_ACK versus rendering a cached template
+    """
+    cache = TC_ACK_Cache()
+    for name, encoding, encode in [('c_struct', TC.ENCODING_C_STRUC, TC_ACK.encode),
+                                   ('json', TC.ENCODING_JSON, TC_ACK.json_dumps),
+                                   ('v2', TC.ENCODING_V2, TC_ACK.encode_v2)]:
+        report("build ack %s" % (name,), count,
+               timeit.timeit(lambda: encode(TC_ACK(USER_ID, 7, TC.ACK_OK)), number=count))
+        report("template ack %s" % (name,), count,
+               timeit.timeit(lambda: cache.get(USER_ID, encoding).render(7, TC.ACK_OK, 1500000000), number=count))
+
+
+def bench_timers(seconds=5.0, request_rate=4):
+    """
+    Threads started per minute by the periodic timers of a running Server (1 s message purge, relay timeout re-armed
+    on every phase request) using one threading.Timer per event versus the shared TC_Scheduler, and how often the
+    scheduler thread wakes
+    """
+    started = [0]
+    thread_start = threading.Thread.start
+
+    def counting_start(thread):
+        started[0] += 1
+        thread_start(thread)
+
+    def timer_workload(schedule):
+        stop = threading.Event()
+        timers = {}
+
+        def purge():
+            if not stop.is_set():
+                timers['purge'] = schedule(1.0, purge)
+
+        def relay_timeout():
+            if not stop.is_set():
+                timers['relay'] = schedule(TC.MAX_PHASE_ON_SECS / TC.CHECK_PHASE_TIMEOUT_INTERVAL, relay_timeout)
+
+        timers['purge'] = schedule(1.0, purge)
+        timers['relay'] = schedule(TC.MAX_PHASE_ON_SECS / TC.CHECK_PHASE_TIMEOUT_INTERVAL, relay_timeout)
+        for i in range(int(seconds * request_rate)):
+            stop.wait(1.0 / request_rate)
+            timers['relay'].cancel()
+            timers['relay'] = schedule(TC.MAX_PHASE_ON_SECS / TC.CHECK_PHASE_TIMEOUT_INTERVAL, relay_timeout)
+        stop.set()
+        for timer in timers.values():
+            timer.cancel()
+
+    def thread_timer(delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.start()
+        return timer
+
+    scheduler = TC_Scheduler.get()
+    threading.Thread.start = counting_start
+    try:
+        for name, schedule in [('threading.Timer', thread_timer), ('TC_Scheduler', scheduler.schedule)]:
+            started[0] = 0
+            start_wakeups = scheduler.wakeups
+            timer_workload(schedule)
+            print("%-32s %10.1f threads/min" % (name, 60.0 * started[0] / seconds))
+        wakeups = scheduler.wakeups - start_wakeups
+    finally:
+        threading.Thread.start = thread_start
+    stats = scheduler.stats()
+    print("%-32s %d scheduled, %d fired, %d cancelled, %d pending, %.1f wakeups/s" %
+          ('scheduler', stats['scheduled'], stats['fired'], stats['cancelled'], stats['pending'], wakeups / seconds))
+
+
+def bench_relay(count=200, latency=0.0005, error_rate=0.0):
+    """
+    Actuation latency from TC_Relay.set_phases to the relay write on a simulated i2c bus, and i2c transactions
+    issued per request and per state change switching every phase, for a Server built off device. Run against
+    released firmware and against firmware with the digitalWriteMany and digitalReadMany commands.
+    """
+    for many_commands in [False, True]:
+        grovepi.dWriteMany_supported = many_commands
+        grovepi.reset_i2c_stats()
+        bus = SimulatedBus(latency=latency, error_rate=error_rate, seed=1, many_commands=many_commands)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = Server(CONTROLLER_ID, bus=bus)
+            relays = server._relays
+            relays.start()
+            pins = sorted(server.phase_to_gpio.values())
+            bus.wait_for(lambda bus: all(pin in bus.pins for pin in pins), 1.0)
+
+            pin = server.phase_to_gpio[2]
+            start_count = bus.count
+            latencies = []
+            for i in range(count):
+                user = 'cyclist_%04d' % (i // 2,)
+                on = i % 2 == 0
+                start = monotonic()
+                relays.set_phases([(TC_phase_request(2, user), on)])
+                bus.wait_for(lambda bus: bus.pins.get(pin) == int(on), 1.0)
+                latencies.append(monotonic() - start)
+            transactions = bus.count - start_count
+
+            start_count = bus.count
+            start_changes = relays.state_changes
+            for i in range(count):
+                user = 'cyclist_%04d' % (i // 2,)
+                on = i % 2 == 0
+                relays.set_phases([(TC_phase_request(phase, user), on) for phase in server.phase_to_gpio])
+                bus.wait_for(lambda bus: all(bus.pins.get(pin) == int(on) for pin in pins), 1.0)
+            all_transactions = bus.count - start_count
+            state_changes = relays.state_changes - start_changes
+            # let the readbacks still in flight confirm the last requests, slow on released firmware
+            settle = monotonic() + 2 * TC.RELAY_READBACK_TIMEOUT
+            while (relays._verifying or relays._unconfirmed) and monotonic() < settle:
+                relays._update.set()
+                sleep(0.05)
+
+            relays.stop()
+            relays.join()
+            server._pipeline.stop()
+            server._admin_commands.stop()
+            server._seen_mids.stop()
+        latencies.sort()
+        print("released firmware" if not many_commands else "firmware with digitalWriteMany")
+        print("%-32s mean %8.2f us  p99 %8.2f us" % ("relay actuation", 1e6 * sum(latencies) / count,
+                                                    1e6 * latencies[int(0.99 * (count - 1))]))
+        print("%-32s %10.2f per request" % ("i2c transactions", transactions / count))
+        print("%-32s %10.2f per state change" % ("i2c transactions all %d pins" % (len(pins),),
+                                                 all_transactions / max(1, state_changes)))
+        confirm = relays.confirm_stats()
+        print("%-32s mean %8.2f us  max %8.2f us  (%d confirmed, %d mismatches, %d readback timeouts)" %
+              ("request to confirmed actuation", 1e6 * confirm['mean'], 1e6 * confirm['max'], confirm['confirmed'],
+               confirm['mismatches'], confirm['timeouts']))
+        if error_rate > 0:
+            stats = grovepi.get_i2c_stats()['write']
+            print("%-32s %d errors, %d retries, %d failures, %d relay re-drives" %
+                  ("i2c writes at %.0f%% errors" % (100 * error_rate,), stats['errors'], stats['retries'],
+                   stats['failures'], relays.write_failures))
+
+
+def bench_coalesce(bursts=20, riders=16, spacing=0.002, latency=0.0005):
+    """
+    Relay wakeups, i2c writes and time to ACK per phase request when a group of riders requests the same phase
+    within a few tens of milliseconds, with and without the Server coalescing window. The first rider of a group
+    arrives in a quiet period like an isolated request.
+    """
+    for window in [0, TC.COALESCE_WINDOW]:
+        grovepi.dWriteMany_supported = True
+        bus = SimulatedBus(latency=latency, seed=1, many_commands=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = Server(CONTROLLER_ID, bus=bus)
+            server.coalesce_window = window
+            acked = []
+            acks = threading.Condition()
+
+            def send_ack(request, rc):
+                acks.acquire()
+                acked.append(monotonic())
+                acks.notify_all()
+                acks.release()
+
+            server.send_ack = send_ack
+            relays = server._relays
+            relays.start()
+            server._pipeline.start()
+            pins = sorted(server.phase_to_gpio.values())
+            bus.wait_for(lambda bus: all(pin in bus.pins for pin in pins), 1.0)
+            sleep(0.1)
+
+            start_wakeups = relays.wakeups
+            start_writes = grovepi.get_i2c_stats()['write']['calls']
+            waits = []
+            firsts = []
+            mid = 0
+            for burst in range(bursts):
+                request_type = TC_Request_On if burst % 2 == 0 else TC_Request_Off
+                del acked[:]
+                start = monotonic()
+                for rider in range(riders):
+                    request = request_type('cyclist_%04d' % (rider,), CONTROLLER_ID, 2)
+                    request._src_mid = mid
+                    mid += 1
+                    server._submit(request, server._process_request)
+                    sleep(spacing)
+                acks.acquire()
+                acks.wait_for(lambda: len(acked) == riders, 1.0)
+                acks.release()
+                waits.extend([ack - start - rider * spacing for rider, ack in enumerate(acked)])
+                firsts.append(acked[0] - start)
+                # let the relay write and its readback finish before the next group arrives
+                sleep(0.1)
+            requests = bursts * riders
+            wakeups = relays.wakeups - start_wakeups
+            writes = grovepi.get_i2c_stats()['write']['calls'] - start_writes
+
+            relays.stop()
+            relays.join()
+            server._pipeline.stop()
+            server._admin_commands.stop()
+            server._seen_mids.stop()
+        print("%-32s wakeups %5.2f  i2c writes %5.2f per request  ack mean %8.2f us  max %8.2f us  first %8.2f us" %
+              ("coalesce window %.3f s" % (window,), wakeups / requests, writes / requests,
+               1e6 * sum(waits) / len(waits), 1e6 * max(waits), 1e6 * sum(firsts) / len(firsts)))
+
+
+def bench_ack_batching(users=8, pipelined=8, spacing=0.001, latency=0.0005):
+    """
+    ACK publishes and QoS 2 packets per request when each user pipelines requests, with and without Server ACK
+    aggregation
+    """
+    for aggregation in [False, True]:
+        grovepi.dWriteMany_supported = True
+        bus = SimulatedBus(latency=latency, seed=1, many_commands=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = Server(CONTROLLER_ID, bus=bus)
+            server.ack_aggregation = aggregation
+            published = []
+            acked = [0]
+            acks = threading.Condition()
+
+            def publish(topic, payload, qos):
+                acks.acquire()
+                published.append(monotonic())
+                if TC.get_type(payload) == TC.ACK_MULTI:
+                    acked[0] += (len(payload) - TC_ACK_Multi._struct_size) // TC_ACK_Multi._entry_struct.size
+                else:
+                    acked[0] += 1
+                acks.notify_all()
+                acks.release()
+
+            server.mqttc.publish = publish
+            server._relays.start()
+            server._pipeline.start()
+            start = monotonic()
+            mid = 0
+            for request in range(pipelined):
+                for user in range(users):
+                    tc_request = TC_Request_On('cyclist_%04d' % (user,), CONTROLLER_ID, 2)
+                    tc_request._src_mid = mid
+                    mid += 1
+                    server._submit(tc_request, server._process_request)
+                sleep(spacing)
+            requests = users * pipelined
+            acks.acquire()
+            acks.wait_for(lambda: acked[0] == requests, 2.0)
+            acks.release()
+            seconds = published[-1] - start
+
+            server._relays.stop()
+            server._relays.join()
+            server._pipeline.stop()
+            server._admin_commands.stop()
+            server._seen_mids.stop()
+        print("%-32s publishes %5.2f  qos 2 packets %5.2f per request  all acked in %8.2f ms" %
+              ("ack aggregation %s" % ("on" if aggregation else "off",), len(published) / requests,
+               4 * len(published) / requests, 1e3 * seconds))
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in KiB: VmHWM is reset by exec, unlike ru_maxrss which a child started by
+    subprocess inherits from the benchmarks that already ran in its parent
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_controllers(controllers, hosted, requests=50, idle=2.0):
+    """
+    Runs in a child process of bench_host: serves requests phase requests to each of controllers controllers, either
+    hosted by one Server_Host or as a single standalone Server, idles and prints peak rss in KiB, cpu seconds and
+    thread count
+    """
+    ids = ['beacon_%d' % (i,) for i in range(controllers)]
+    acked = [0]
+    acks = threading.Condition()
+
+    def publish(topic, payload, qos):
+        acks.acquire()
+        acked[0] += 1
+        acks.notify_all()
+        acks.release()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if hosted:
+            host = Server_Host('bench_host', depth=TC.PIPELINE_DEPTH * controllers)
+            host.mqttc.publish = publish
+            for id in ids:
+                host.add_controller(id, io=SimulatedRelayIO())
+            host.start()
+            route = lambda msg: Server_Host.on_topic(None, host, msg)
+        else:
+            server = Server(ids[0], io=SimulatedRelayIO())
+            server.mqttc.publish = publish
+            server._relays.start()
+            server._pipeline.start()
+            server._admin_commands.start()
+            route = lambda msg: Server.on_topic(None, server, msg)
+
+        for mid in range(requests):
+            request_type = TC_Request_On if mid % 2 == 0 else TC_Request_Off
+            for id in ids:
+                route(make_msg(request_type('cyclist_%04d' % (mid // 2,), id, 2).encode(), mid,
+                               TC._tc_topic_format % (id,)))
+        acks.acquire()
+        acks.wait_for(lambda: acked[0] == requests * controllers, 10.0)
+        acks.release()
+        sleep(idle)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        rss = peak_rss()
+        threads = threading.active_count()
+        if hosted:
+            host.stop()
+        else:
+            server.stop()
+    print("%d %f %d" % (rss, usage.ru_utime + usage.ru_stime, threads))
+
+
+def bench_host(sizes=(1, 4, 16), requests=50):
+    """
+    Peak memory, cpu time and threads per controller serving requests phase requests each, N controllers in one
+    Server_Host process versus N standalone Server processes
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def spawn(controllers, hosted):
+        code = "import TC_benchmark; TC_benchmark.run_controllers(%d, %s, %d)" % (controllers, hosted, requests)
+        return subprocess.Popen([sys.executable, '-c', code], cwd=directory, stdout=subprocess.PIPE)
+
+    def collect(process):
+        output, unused = process.communicate()
+        rss, cpu, threads = output.split()
+        return int(rss), float(cpu), int(threads)
+
+    for controllers in sizes:
+        hosted = collect(spawn(controllers, True))
+        separate = [collect(process) for process in [spawn(1, False) for i in range(controllers)]]
+        rss = sum([result[0] for result in separate])
+        cpu = sum([result[1] for result in separate])
+        threads = sum([result[2] for result in separate])
+        for name, (total_rss, total_cpu, total_threads) in [('%d hosted' % (controllers,), hosted),
+                                                            ('%d processes' % (controllers,), (rss, cpu, threads))]:
+            print("%-32s %8.2f MiB %8.1f ms cpu %6.1f threads per controller" %
+                  (name, total_rss / 1024 / controllers, 1e3 * total_cpu / controllers, total_threads / controllers))
+
+
+def bench_sensors(count=100000, batch=64):
+    """
+    Decoding grovepi sensor response blocks one at a time and in batches of buffered readings
+    """
+    dht_block = bytes([40]) + struct.pack('<ff', 21.5, 45.25) + bytes(grovepi.RESPONSE_LENGTH - 9)
+    acc_block = bytes([20, 5, 250, 33]) + bytes(grovepi.RESPONSE_LENGTH - 4)
+    ultrasonic_block = bytes([7, 0, 123]) + bytes(grovepi.RESPONSE_LENGTH - 3)
+    for name, block, decode, decode_many in [('dht', dht_block, grovepi.decode_dht, grovepi.decode_dht_many),
+                                             ('acc_xyz', acc_block, grovepi.decode_acc_xyz,
+                                              grovepi.decode_acc_xyz_many),
+                                             ('ultrasonic', ultrasonic_block, grovepi.decode_ultrasonic,
+                                              grovepi.decode_ultrasonic_many)]:
+        number = list(block)
+        report("decode %s" % (name,), count, timeit.timeit(lambda: decode(number), number=count))
+        buffer = block * batch
+        rounds = count // batch
+        report("decode %s batch of %d" % (name, batch), rounds * batch,
+               timeit.timeit(lambda: decode_many(buffer), number=rounds))
+
+
+def bench_dedup(count=100000):
+    """
+    Message_tracker duplicate checks, and the time a purge holds the lock as the number of remembered keys grows:
+    the previous per entry timestamp scan versus dropping a bucket
+    """
+    tracker = Message_tracker()
+    tracker.stop()
+    requests = [TC_Request_On('cyclist_%04d' % (i % 1000,), CONTROLLER_ID, 2) for i in range(count)]
+    for mid, request in enumerate(requests):
+        request._src_mid = mid
+    report("is_duplicate new key", count, timeit.timeit(lambda: [tracker.is_duplicate(r) for r in requests], number=1))
+    report("is_duplicate seen key", count, timeit.timeit(lambda: [tracker.is_duplicate(r) for r in requests], number=1))
+
+    for keys in (1000, 10000, 100000):
+        timestamp = 1500000000.0
+        message_ids = dict(((USER_ID, mid), timestamp + mid % TC.DEFAULT_MSG_LIFE) for mid in range(keys))
+
+        def scan():
+            expired = timestamp + 1
+            for mid, sent in list(message_ids.items()):
+                if sent < expired:
+                    del message_ids[mid]
+        scan_time = timeit.timeit(scan, number=1)
+
+        tracker = Message_tracker()
+        tracker.stop()
+        for mid in range(keys):
+            tracker._buckets[mid % len(tracker._buckets)].add((USER_ID, mid))
+        tracker._lock.acquire()
+        start = monotonic()
+        expired = tracker._buckets.popleft()
+        tracker._buckets.append(set())
+        bucket_time = monotonic() - start
+        tracker._lock.release()
+        expired.clear()
+        print("%-32s scan %10.2f us  bucket %8.2f us" % ("purge lock hold %d keys" % (keys,), 1e6 * scan_time,
+                                                        1e6 * bucket_time))
+
+
+def bench_dedup_store(count=100000):
+    """
+    Cost of a Message_tracker duplicate check with and without a TC_Dedup_Store, and the time to reopen a full
+    store and restore the tracker from it as after a restart
+    """
+    requests = [TC_Request_On('cyclist_%04d' % (i % 1000,), CONTROLLER_ID, 2) for i in range(count)]
+    for mid, request in enumerate(requests):
+        request._src_mid = mid % 65536
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'dedup')
+
+    tracker = Message_tracker()
+    tracker.stop()
+    report("is_duplicate in memory", count, timeit.timeit(lambda: [tracker.is_duplicate(r) for r in requests], number=1))
+    tracker = Message_tracker(store=TC_Dedup_Store(path))
+    report("is_duplicate with store", count, timeit.timeit(lambda: [tracker.is_duplicate(r) for r in requests], number=1))
+    tracker.stop()
+    del requests, tracker
+
+    start = monotonic()
+    tracker = Message_tracker(store=TC_Dedup_Store(path))
+    recovery = monotonic() - start
+    tracker.stop()
+    print("%-32s %10.2f ms for %d keys" % ("recovery", 1e3 * recovery, len(tracker)))
+    os.remove(path)
+    os.rmdir(directory)
+
+
+def bench_dedup_filter(sizes=(10000, 100000, 1000000)):
+    """
+    Memory, is_duplicate throughput and false positives of the exact Message_tracker and a Message_filter sized for
+    the same number of distinct messages arriving within one lifetime
+    """
+    requests = [TC_Request_On('cyclist_%04d' % (i,), CONTROLLER_ID, 2) for i in range(1000)]
+
+    def fill(tracker, count):
+        duplicates = 0
+        for mid in range(count):
+            request = requests[mid % len(requests)]
+            request._src_mid = mid
+            duplicates += tracker.is_duplicate(request)
+        return duplicates
+
+    for count in sizes:
+        for name, make in [('tracker', Message_tracker), ('filter', lambda: Message_filter(count))]:
+            tracker = make()
+            tracker.stop()
+            start = monotonic()
+            false_positives = fill(tracker, count)
+            seconds = monotonic() - start
+            del tracker
+            tracemalloc.start()
+            tracker = make()
+            tracker.stop()
+            fill(tracker, count)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del tracker
+            print("%-32s %10.0f ops/s %8.2f us/op %8.1f MiB  false positives %d" %
+                  ("%s %d" % (name, count), count / seconds, 1e6 * seconds / count, memory / 2**20, false_positives))
+
+
+BENCHMARKS = {'ack': bench_ack,
+              'ack_batching': bench_ack_batching,
+              'codec': bench_codec,
+              'coalesce': bench_coalesce,
+              'dedup': bench_dedup,
+              'dedup_filter': bench_dedup_filter,
+              'dedup_store': bench_dedup_store,
+              'host': bench_host,
+              'memory': bench_memory,
+              'relay': bench_relay,
+              'relay_faults': lambda: bench_relay(error_rate=0.2),
+              'sensors': bench_sensors,
+              'timers': bench_timers,
+              'wire': bench_wire}
+
+
+def main(argv):
+    names = argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(__doc__.strip())
+            return 1
+        print("== %s" % (name,))
+        BENCHMARKS[name]()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
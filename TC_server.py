@@ -3,25 +3,33 @@ Rickie Kerndt <rkerndt@cs.uoregon.edu>
 Classes and methods for receiving traffic controller phase requests.
 """
 
+import grovepi
 try:
-    import grovepi
+    import smbus
+    import RPi.GPIO
     I_AM_PI = True
-except:
+except ImportError:
     I_AM_PI = False
 
 import paho.mqtt.client as mqtt
 import struct
-from datetime import datetime, timedelta
+from datetime import datetime
 import sys
 import threading
-from time import sleep
+from time import sleep, monotonic, time
 import signal
 import socket
-from io import StringIO
 import json
 from ctypes import *
 import os
+import mmap
+import zlib
 import subprocess
+import tempfile
+import queue
+import heapq
+import math
+from collections import OrderedDict, deque
 
 class TC_Exception (Exception):
     """
@@ -48,6 +56,10 @@ class TC:
     PHASE_REQUEST_OFF = 0x03
     ACK = 0x04
     ID = 0x05
+    PHASE_REQUEST_BATCH = 0x06
+    ACK_BATCH = 0x07
+    ACK_RESULT = 0x08
+    ACK_MULTI = 0x09
 
     # Admin Message Types
     ADMIN_REBOOT = 0x100
@@ -65,12 +77,16 @@ class TC:
     ACK_INVALID_PHASE = 0x01
     ACK_INVALID_CMD = 0x02
     ACK_DUPLICATE_MID = 0x03
+    ACK_BUSY = 0x04
+    ACK_TIMEOUT = 0x05
     ACK_UNKNOWN_ERR = 0xFF
     RESULT_CODES = { ACK_OK: 'OK',
                      ACK_INVALID_PHASE: 'Invalid Phase Number',
                      ACK_INVALID_CMD: 'Invalid command type',
                      ACK_UNKNOWN_ERR: 'Failed, unknown error',
-                     ACK_DUPLICATE_MID: 'Duplicate message id'}
+                     ACK_DUPLICATE_MID: 'Duplicate message id',
+                     ACK_BUSY: 'Server busy, request dropped',
+                     ACK_TIMEOUT: 'Command timed out'}
 
 
     # Constants
@@ -89,10 +105,49 @@ class TC:
     TC_ACK_LENGTH = 5
     COMMAND_TIMEOUT = 10   # number of seconds to wait for tc command to complete before giving up
     DEFAULT_MSG_LIFE = 10  #seconds
+    ACK_CACHE_SIZE = 256   # number of per user ACK templates kept by Server
+    PIPELINE_WORKERS = 2   # worker threads processing requests off the mqtt network thread
+    PIPELINE_DEPTH = 64    # maximum queued requests per worker before requests are refused
+    ADMIN_CONCURRENCY = 1  # admin commands allowed to run at the same time
+    ADMIN_QUEUE_DEPTH = 4  # admin commands allowed to wait for a free slot
+    MAX_ADMIN_OUTPUT = 128 # bytes of admin command output returned in a TC_ACK_Result
+    MAX_BATCH_ENTRIES = 32 # maximum number of phase requests carried in one PHASE_REQUEST_BATCH
+    RELAY_REASSERT_INTERVAL = 12 # seconds between rewrites of unchanged relay pins
+    RELAY_REDRIVE_INTERVAL = 0.05 # seconds before pins are driven again after a failed relay write
+    RELAY_CONFIRM_SAMPLES = 1024 # most recent request to confirmed actuation times kept by TC_Relay
+    RELAY_READBACK_TIMEOUT = 0.5 # seconds per pin read back before a relay readback still in flight is abandoned
+                                 # and issued again, released firmware reads the pins one digitalRead at a time
+    SCHEDULER_TICK = 0.05  # seconds per slot of the innermost timing wheel
+    SCHEDULER_SLOT_BITS = 6 # each timing wheel has 2**SCHEDULER_SLOT_BITS slots
+    SCHEDULER_LEVELS = 4   # number of timing wheels, spans SCHEDULER_TICK * 2**(bits * levels) seconds
+    DEDUP_STORE_RECORDS = 16384 # (sender, mid) records kept in the persistent dedup ring file
+    DEDUP_FILTER_CAPACITY = 100000 # messages per DEFAULT_MSG_LIFE a Message_filter is sized for
+    DEDUP_FILTER_ERROR_RATE = 0.001 # Message_filter false positive rate at capacity
+    COALESCE_WINDOW = SCHEDULER_TICK # seconds after a phase request during which further requests are held so
+                                     # those arriving together make one relay update, 0 = off
+    ACK_NAGLE_WINDOW = 0.005 # seconds after an ACK to a user during which further ACKs are held and sent together in
+                             # one TC_ACK_Multi, each held ACK is delayed by up to this much
+    MAX_MULTI_ENTRIES = 64 # maximum number of (mid, rc) entries carried in one ACK_MULTI
 
     # encodings
     ENCODING_C_STRUC = 0x100
     ENCODING_JSON   = 0x101
+    ENCODING_V2     = 0x102
+
+    # v2 encoding one byte type codes, the high bit distinguishes them from the first byte of c_struct (always 0x00)
+    # and json ('{') payloads
+    V2_MARKER = 0x80
+    V2_TYPE_CODES = { WILL: 0x80,
+                      PHASE_REQUEST: 0x81,
+                      PHASE_REQUEST_ON: 0x82,
+                      PHASE_REQUEST_OFF: 0x83,
+                      ACK: 0x84,
+                      ID: 0x85,
+                      ADMIN_REBOOT: 0x90,
+                      ADMIN_WIFI_ENABLE: 0x91,
+                      ADMIN_WIFI_DISABLE: 0x92,
+                      ADMIN_UPGRADE: 0x93 }
+    V2_TYPES = dict([(code, type) for type, code in V2_TYPE_CODES.items()])
 
     # configuration: TODO: put this stuff into a configuration file
     _qos = 2
@@ -111,7 +166,9 @@ class TC:
 
     # general payload formats
     _payload_type_format = '!i'
-    _payload_type_length = struct.calcsize(_payload_type_format)
+    _payload_type_struct = struct.Struct(_payload_type_format)
+    _payload_type_length = _payload_type_struct.size
+    _json_lead_bytes = frozenset(b'{ \t\r\n')
 
 
     def __init__(self):
@@ -120,6 +177,61 @@ class TC:
         self._healthy = False
         self.subscriptions = None
 
+    @staticmethod
+    def load_libsystemd():
+        """
+        Loads libsystemd for sd_pid_notify(3)
+        :return: CDLL or None where libsystemd is not available (e.g. off device)
+        """
+        try:
+            return CDLL("libsystemd.so")
+        except OSError:
+            return None
+
+    def sd_notify(self, state:str):
+        """
+        Sends state to systemd for watchdog_pid, a no-op where libsystemd is not loaded
+        :param state: str e.g. "READY=1"
+        :return: int result of sd_pid_notify(3), 1 without libsystemd
+        """
+        if self._libsystemd is None:
+            return 1
+        return self._libsystemd.sd_pid_notify(self.watchdog_pid, 0, state.encode('ascii'))
+
+    def connect_broker(self):
+        """
+        Connects mqttc to the broker, retrying with a progressive delay while the network is not yet up. Exits the
+        process on connection errors.
+        :return: None
+        """
+        connected = False
+        connection_retry_delay = TC.INITIAL_CONNECTION_RETRY_DELAY
+        while not connected:
+            try:
+                connected = True
+                msg = "starting TC Server for controller %s" % (self.id,)
+                self.output_log(msg)
+                self.mqttc.connect(TC._broker_url, TC._broker_port, TC._broker_keepalive)
+            except (socket.gaierror, socket.herror, socket.timeout) as e:
+                # probably network initialization delayed at startup, retry with progressive delay
+                error_int, error_string = e.args
+                connected = False
+                msg = "connect attempt failed (%d) %s:retry in %f seconds" % (error_int, error_string, connection_retry_delay)
+                self.output_error(msg)
+                sleep(connection_retry_delay)
+                connection_retry_delay *= TC.CONNECTION_RETRY_FACTOR
+                if connection_retry_delay > TC.MAX_CONNECTION_RETRY_DELAY:
+                    connection_retry_delay = TC.MAX_CONNECTION_RETRY_DELAY
+            except (ConnectionError, ConnectionRefusedError, ConnectionAbortedError, ConnectionResetError) as e:
+                error_int, error_string = e.args
+                msg = "aborted due to connection error (%d) (%s)" % (error_int, error_string)
+                self.output_error(msg)
+                exit(error_int)
+            except:
+                msg = "aborted with unkown error"
+                self.output_error(msg)
+                exit(1)
+
     def output_msg(self, msg:str, stream):
         """
         Outputs msg to IOText stream
@@ -170,26 +282,30 @@ class TC:
     @staticmethod
     def get_type(payload:bytes):
         """
-        Examines the first field within the packed byte object to obtain the payload type value.
+        Examines the first field within the packed byte object (c_struct or v2) to obtain the payload type value.
         :param payload:
         :return: int
         """
+        if len(payload) > 0 and payload[0] & TC.V2_MARKER:
+            if payload[0] not in TC.V2_TYPES:
+                msg = 'unknown v2 TC payload type (0x%02x)' % (payload[0],)
+                raise TC_Exception(msg)
+            return TC.V2_TYPES[payload[0]]
         if len(payload) < TC._payload_type_length:
             msg = 'improperly formated TC payload'
             raise TC_Exception(msg)
-        (request_type,) = struct.unpack_from(TC._payload_type_format, payload, 0)
+        (request_type,) = TC._payload_type_struct.unpack_from(payload, 0)
         return request_type
 
     @staticmethod
     def non_block_sleep(sec):
         """
-        Uses Timer object to wait fo specified seconds. This will not block the main thread.
-        :param sec: 
+        Uses the shared scheduler to wait fo specified seconds. This will not block the main thread.
+        :param sec:
         :return: None
         """
         rested = threading.Event()
-        nap = threading.Timer(sec, lambda: rested.set())
-        nap.start()
+        TC_Scheduler.get().schedule(sec, rested.set)
         rested.wait()
 
     """
@@ -353,38 +469,20 @@ class TC:
             userdata.output_log(msg)
 
     @staticmethod
-    def decode(mqtt_msg:mqtt.MQTTMessage):
+    def decode(mqtt_msg:mqtt.MQTTMessage, lazy=False):
         """
-        Checks whether mqtt message encodes a valid TC object. Attempts to first find a matching c_struct object to
-        decode and where that fails attempts to decode as a json object by calling TC.decode_json.
+        Checks whether mqtt message encodes a valid TC object. Payloads starting with a json object are passed to
+        TC.decode_json, everything else is decoded as c_struct (or v2) through the tc_codec registry. With lazy set,
+        phase requests are returned as a TC_Request_View over the payload.
         :param mqtt_msg: MQTTMessage
+        :param lazy: bool
         :return: TC_Identifier derived object
         """
 
-        tc_command = None
-
-        try:
-            tc_type = TC.get_type(mqtt_msg.payload)
-            if tc_type in [TC.WILL, TC.ID]:
-                tc_command = TC_Identifier.decode(mqtt_msg)
-            elif tc_type == TC.ACK:
-                tc_command = TC_ACK.decode(mqtt_msg)
-            elif tc_type == TC.PHASE_REQUEST:
-                tc_command = TC_Request.decode((mqtt_msg))
-            elif tc_type == TC.PHASE_REQUEST_ON:
-                tc_command = TC_Request_On.decode(mqtt_msg)
-            elif tc_type == TC.PHASE_REQUEST_OFF:
-                tc_command = TC_Request_Off.decode(mqtt_msg)
-            elif tc_type in [TC.ADMIN_REBOOT, TC.ADMIN_WIFI_ENABLE, TC.ADMIN_WIFI_DISABLE]:
-                tc_command = TC_Admin.decode(mqtt_msg)
-            else:
-                raise TC_Exception("No matching command type")
-
-        except TC_Exception as err:
-            # try to decode as json object
-            tc_command = TC.decode_json(mqtt_msg)
-
-        return tc_command
+        payload = mqtt_msg.payload
+        if len(payload) > 0 and payload[0] in TC._json_lead_bytes:
+            return TC.decode_json(mqtt_msg)
+        return tc_codec.decode(mqtt_msg, lazy)
 
     @staticmethod
     def decode_json(mqtt_msg:mqtt.MQTTMessage):
@@ -396,9 +494,7 @@ class TC:
         :return: TC_type derived class
         """
         try:
-            payload_string = mqtt_msg.payload.decode("utf-8")
-            payload_stream = StringIO(payload_string)
-            payload_dict = json.load(payload_stream)
+            payload_dict = json.loads(mqtt_msg.payload)
             if "type" in payload_dict:
                 type = payload_dict["type"]
                 if type in [TC.PHASE_REQUEST, TC.PHASE_REQUEST_ON, TC.PHASE_REQUEST_OFF]:
@@ -418,12 +514,115 @@ class TC:
             raise TC_Exception("Unkown exception %s" % (sys.exc_info()[0],))
 
 
+def _put_varint(buffer:bytearray, value:int):
+    """
+    Appends value to buffer as an unsigned LEB128 varint
+    :param buffer: bytearray
+    :param value: int
+    :return: None
+    """
+    if value < 0:
+        raise TC_Exception("cannot encode negative value %d as varint" % (value,))
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _get_varint(payload, offset:int):
+    """
+    Reads an unsigned LEB128 varint from payload starting at offset
+    :param payload: bytes
+    :param offset: int
+    :return: (int, int) value and offset of the following byte
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(payload) or shift > 63:
+            raise TC_Exception("truncated or oversized varint in v2 payload")
+        byte = payload[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+class TC_Id_Table:
+    """
+    Bounded intern table so that repeated user and controller ids share a single str object. Lookups can also be made
+    with the raw null padded id field of a payload, where a hit skips the utf-8 decode as well.
+    """
+
+    DEFAULT_MAX_IDS = 4096
+
+    def __init__(self, max_ids=DEFAULT_MAX_IDS):
+        """
+        :param max_ids: int - table is cleared once this many distinct ids have been seen
+        """
+        self.max_ids = max_ids
+        self._by_str = dict()
+        self._by_bytes = dict()
+
+    def intern(self, id:str):
+        """
+        Returns the shared str object equal to id, adding id to the table if not present
+        :param id: str
+        :return: str
+        """
+        shared = self._by_str.get(id)
+        if shared is None:
+            if len(self._by_str) >= self.max_ids:
+                self.clear()
+            shared = self._by_str.setdefault(id, id)
+        return shared
+
+    def from_bytes(self, id_bytes):
+        """
+        Returns the shared str object for a null padded utf-8 id field
+        :param id_bytes: bytes or read only memoryview
+        :return: str
+        """
+        try:
+            shared = self._by_bytes.get(id_bytes)
+        except TypeError:
+            # memoryview over a writable buffer is not hashable
+            id_bytes = bytes(id_bytes)
+            shared = self._by_bytes.get(id_bytes)
+        if shared is None:
+            id_bytes = bytes(id_bytes)
+            shared = self.intern(id_bytes.decode('utf-8').rstrip('\0'))
+            self._by_bytes[id_bytes] = shared
+        return shared
+
+    def clear(self):
+        """
+        Drops all interned ids
+        :return: None
+        """
+        self._by_str.clear()
+        self._by_bytes.clear()
+
+    def __len__(self):
+        return len(self._by_str)
+
+
+tc_ids = TC_Id_Table()
+
+
 class TC_Type:
     """
     Base TC class which holds only the type value
     """
+    __slots__ = ('type', '_encoding', '_src_mid')
+
     _struct_format = '!i'
-    _struct_size = struct.calcsize(_struct_format)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+
+    # (attribute, is_id) in v2 wire order, ids are length prefixed utf-8 and all other fields are varints
+    _v2_fields = ()
 
     def __init__(self, type:int):
         """
@@ -442,8 +641,40 @@ class TC_Type:
         } __attribute__((PACKED));
         :return: bytearray
         """
-        packed = struct.pack(TC_Type._struct_format, self.type)
-        return bytearray(packed)
+        packed = bytearray(TC_Type._struct_size)
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        TC_Type._struct.pack_into(buffer, offset, self.type)
+        return TC_Type._struct_size
+
+    def packed_size(self):
+        """
+        Number of bytes encode() or pack_into() will produce for this object
+        :return: int
+        """
+        return self._struct_size
+
+    def encode_v2(self):
+        """
+        Converts into the compact v2 encoding: a one byte type code followed by the fields listed in _v2_fields
+        :return: bytearray
+        """
+        return tc_codec.encode_v2(self)
+
+    def _validate(self):
+        """
+        Checks field values of an object created by a decoder that bypasses __init__
+        :return: None
+        """
+        pass
 
     @classmethod
     def decode(cls, msg:mqtt.MQTTMessage):
@@ -456,7 +687,7 @@ class TC_Type:
         if len(msg.payload) < TC_Type._struct_size:
             msg = 'improperly formatted TC Type (derived) payload'
             raise TC_Exception(msg)
-        (type,) = struct.unpack_from(TC_Type._struct_format, msg.payload, 0)
+        (type,) = TC_Type._struct.unpack_from(msg.payload, 0)
         myType = TC_Type(type)
         myType._encoding = TC.ENCODING_C_STRUC
         myType._src_mid = msg.mid
@@ -474,17 +705,32 @@ class TC_Identifier(TC_Type):
     Structure for TC identifier payload. Includes just the type and sender fields. This class is used for the
     will payload (with type set to TC.Will. All other payload types are derived from this class
     """
+    __slots__ = ('id', 'timestamp')
+
     _struct_format = '!iq%ds' % (TC.MAX_ID_BYTES,)
-    _struct_size = struct.calcsize(_struct_format)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _v2_fields = (('timestamp', False), ('id', True))
 
-    def __init__(self, type:int, id:str):
+    def __init__(self, type:int, id:str, timestamp=None):
         """
 
         :param id: str
+        :param timestamp: int - already known timestamp (e.g. when decoding), defaults to now
         """
         super().__init__(type)
         self.id = id
-        self.timestamp = int(datetime.utcnow().timestamp())
+        if timestamp is None:
+            timestamp = int(datetime.utcnow().timestamp())
+        self.timestamp = timestamp
+
+    def shard_key(self):
+        """
+        Key assigning the sender's messages to one pipeline worker, the utf-8 bytes of id so that lazily decoded
+        messages can take it from the payload
+        :return: bytes
+        """
+        return self.id.encode('utf-8')
 
     def encode(self):
         """
@@ -496,12 +742,23 @@ class TC_Identifier(TC_Type):
         }  __attribute__((PACKED));
         :return: bytearray
         """
+        packed = bytearray(TC_Identifier._struct_size)
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
         id_bytes = self.id.encode('utf-8')
         if len(id_bytes) > TC.MAX_ID_BYTES:
             msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
             raise TC_Exception(msg)
-        packed = struct.pack(TC_Identifier._struct_format, self.type, self.timestamp, id_bytes)
-        return bytearray(packed)
+        TC_Identifier._struct.pack_into(buffer, offset, self.type, self.timestamp, id_bytes)
+        return TC_Identifier._struct_size
 
     @classmethod
     def decode(cls, msg:mqtt.MQTTMessage):
@@ -514,10 +771,9 @@ class TC_Identifier(TC_Type):
         if len(msg.payload) < TC_Identifier._struct_size:
             msg = 'improperly formatted TC Will payload'
             raise TC_Exception(msg)
-        type, timestamp, id_bytes = struct.unpack_from(TC_Identifier._struct_format, msg.payload, 0)
-        id = id_bytes.decode('utf-8').rstrip('\0')
-        myID = TC_Identifier(type, id)
-        myID.timestamp = timestamp
+        type, timestamp, id_bytes = TC_Identifier._struct.unpack_from(msg.payload, 0)
+        id = tc_ids.from_bytes(id_bytes)
+        myID = TC_Identifier(type, id, timestamp)
         myID._encoding = TC.ENCODING_C_STRUC
         myID._src_mid = msg.mid
         return myID
@@ -534,18 +790,22 @@ class TC_Request(TC_Identifier):
     """
     Structure and methods for manipulating mqtt payloads used in traffic control requests
     """
+    __slots__ = ('controller_id', 'phase')
 
     _struct_format = '!iq%ds%dsi' % (TC.MAX_ID_BYTES, TC.MAX_ID_BYTES)
-    _struct_size = struct.calcsize(_struct_format)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _v2_fields = (('timestamp', False), ('id', True), ('controller_id', True), ('phase', False))
 
-    def __init__(self, user_id: str, controller_id: str, phase: int):
+    def __init__(self, user_id: str, controller_id: str, phase: int, timestamp=None):
         """
         Instantiates a Traffic Controller phase request
         :param user_id: str
         :param controller_id: str
         :param phase: int
+        :param timestamp: int - defaults to now
         """
-        super().__init__(TC.PHASE_REQUEST, user_id)
+        super().__init__(TC.PHASE_REQUEST, user_id, timestamp)
         self.controller_id = controller_id
         self.phase = phase
 
@@ -564,6 +824,17 @@ class TC_Request(TC_Identifier):
 
         :return: bytearray
         """
+        packed = bytearray(TC_Request._struct_size)
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
         user_id_bytes = self.id.encode('utf-8')
         controller_id_bytes = self.controller_id.encode('utf-8')
         if len(user_id_bytes) > TC.MAX_ID_BYTES:
@@ -572,8 +843,9 @@ class TC_Request(TC_Identifier):
         if len(controller_id_bytes) > TC.MAX_ID_BYTES:
             msg = "controller id <%s> exceeds %d utf-8 bytes" % (self.controller_id, TC.MAX_ID_BYTES)
             raise TC_Exception(msg)
-        packed = struct.pack(TC_Request._struct_format, self.type, self.timestamp, user_id_bytes, controller_id_bytes, self.phase)
-        return bytearray(packed)
+        TC_Request._struct.pack_into(buffer, offset, self.type, self.timestamp, user_id_bytes, controller_id_bytes,
+                                     self.phase)
+        return TC_Request._struct_size
 
     @classmethod
     def decode(cls, msg:mqtt.MQTTMessage):
@@ -588,16 +860,15 @@ class TC_Request(TC_Identifier):
             msg = 'improperly formatted TC Request payload: expected %d bytes got %d' % (TC_Request._struct_size, len(msg.payload))
             raise TC_Exception(msg)
 
-        type, timestamp, user_id_bytes, controller_id_bytes, phase = struct.unpack(TC_Request._struct_format, msg.payload)
+        type, timestamp, user_id_bytes, controller_id_bytes, phase = TC_Request._struct.unpack(msg.payload)
 
         if type != TC.PHASE_REQUEST:
             msg = 'payload claimed to be a phase request but received code (%d)' % type
             raise TC_Exception(msg)
-        user_id = user_id_bytes.decode('utf-8').rstrip('\0')
-        controller_id = controller_id_bytes.decode('utf-8').rstrip('\0')
+        user_id = tc_ids.from_bytes(user_id_bytes)
+        controller_id = tc_ids.from_bytes(controller_id_bytes)
 
-        myRequest = TC_Request(user_id, controller_id, phase)
-        myRequest.timestamp = timestamp
+        myRequest = TC_Request(user_id, controller_id, phase, timestamp)
         myRequest._encoding = TC.ENCODING_C_STRUC
         myRequest._src_mid = msg.mid
         return myRequest
@@ -608,6 +879,13 @@ class TC_Request(TC_Identifier):
         :param fs:
         :return: None
         """
+        fs.write(self.json_dumps())
+
+    def json_dumps(self):
+        """
+        Encodes TC_Request object into a JSON string
+        :return: str
+        """
 
         # fist stuff object attributes into a dictionary
         json_dict = {}
@@ -616,7 +894,7 @@ class TC_Request(TC_Identifier):
         json_dict['id'] = self.id
         json_dict['controller_id'] = self.controller_id
         json_dict['phase'] =self.phase
-        json.dump(json_dict, fs)
+        return json.dumps(json_dict)
 
     @classmethod
     def json_load(cls, json_dict):
@@ -633,12 +911,11 @@ class TC_Request(TC_Identifier):
         try:
             type = int(json_dict['type'])
             timestamp = int(json_dict['timestamp'])
-            id = json_dict['id']
-            controller_id = json_dict['controller_id']
+            id = tc_ids.intern(json_dict['id'])
+            controller_id = tc_ids.intern(json_dict['controller_id'])
             phase = int(json_dict['phase'])
-            new_tc_reqeust = TC_Request(id, controller_id, phase)
+            new_tc_reqeust = TC_Request(id, controller_id, phase, timestamp)
             new_tc_reqeust.type = type
-            new_tc_reqeust.timestamp = timestamp
             return new_tc_reqeust
         except:
             msg = "Malformed TC_Request Encoding: %s : %s" % (str(json_dict),sys.exc_info()[0])
@@ -664,14 +941,17 @@ class TC_Request_On(TC_Request):
     TC_Request mqtt payload to set phase on
     """
 
-    def __init__(self, user_id: str, controller_id: str, phase: int):
+    __slots__ = ()
+
+    def __init__(self, user_id: str, controller_id: str, phase: int, timestamp=None):
         """
 
         :param user_id:
         :param controller_id:
         :param phase:
+        :param timestamp:
         """
-        super().__init__(user_id, controller_id, phase)
+        super().__init__(user_id, controller_id, phase, timestamp)
         self.type = TC.PHASE_REQUEST_ON
 
     @classmethod
@@ -687,16 +967,15 @@ class TC_Request_On(TC_Request):
             msg = 'improperly formatted TC Request payload: expected %d bytes got %d' % (TC_Request._struct_size, len(msg.payload))
             raise TC_Exception(msg)
 
-        type, timestamp, user_id_bytes, controller_id_bytes, phase = struct.unpack(TC_Request._struct_format, msg.payload)
+        type, timestamp, user_id_bytes, controller_id_bytes, phase = TC_Request._struct.unpack(msg.payload)
 
         if type != TC.PHASE_REQUEST_ON:
             msg = 'payload claimed to be a phase request on but received code (%d)' % type
             raise TC_Exception(msg)
-        user_id = user_id_bytes.decode('utf-8').rstrip('\0')
-        controller_id = controller_id_bytes.decode('utf-8').rstrip('\0')
+        user_id = tc_ids.from_bytes(user_id_bytes)
+        controller_id = tc_ids.from_bytes(controller_id_bytes)
 
-        myRequestOn = TC_Request_On(user_id, controller_id, phase)
-        myRequestOn.timestamp = timestamp
+        myRequestOn = TC_Request_On(user_id, controller_id, phase, timestamp)
         myRequestOn._encoding = TC.ENCODING_C_STRUC
         myRequestOn._src_mid = msg.mid
         return myRequestOn
@@ -707,14 +986,17 @@ class TC_Request_Off(TC_Request):
     TC_Request mqtt payload to set phase on
     """
 
-    def __init__(self, user_id: str, controller_id: str, phase: int):
+    __slots__ = ()
+
+    def __init__(self, user_id: str, controller_id: str, phase: int, timestamp=None):
         """
 
         :param user_id:
         :param controller_id:
         :param phase:
+        :param timestamp:
         """
-        super().__init__(user_id, controller_id, phase)
+        super().__init__(user_id, controller_id, phase, timestamp)
         self.type = TC.PHASE_REQUEST_OFF
 
     @classmethod
@@ -730,38 +1012,125 @@ class TC_Request_Off(TC_Request):
             msg = 'improperly formatted TC Request payload: expected %d bytes got %d' % (TC_Request._struct_size, len(msg.payload))
             raise TC_Exception(msg)
 
-        type, timestamp, user_id_bytes, controller_id_bytes, phase = struct.unpack(TC_Request._struct_format, msg.payload)
+        type, timestamp, user_id_bytes, controller_id_bytes, phase = TC_Request._struct.unpack(msg.payload)
 
         if type != TC.PHASE_REQUEST_OFF:
             msg = 'payload claimed to be a phase request off but received code (%d)' % type
             raise TC_Exception(msg)
-        user_id = user_id_bytes.decode('utf-8').rstrip('\0')
-        controller_id = controller_id_bytes.decode('utf-8').rstrip('\0')
+        user_id = tc_ids.from_bytes(user_id_bytes)
+        controller_id = tc_ids.from_bytes(controller_id_bytes)
 
-        myRequestOff = TC_Request_Off(user_id, controller_id, phase)
-        myRequestOff.timestamp = timestamp
+        myRequestOff = TC_Request_Off(user_id, controller_id, phase, timestamp)
         myRequestOff._encoding = TC.ENCODING_C_STRUC
         myRequestOff._src_mid = msg.mid
         return myRequestOff
 
 
+class TC_Request_View(TC_Request):
+    """
+    Read only view of a c_struct encoded phase request. The type, timestamp and phase fields are unpacked directly
+    from a memoryview over the mqtt payload, the id and controller_id strings are decoded the first time they are read.
+    """
+
+    __slots__ = ('_view', '_id', '_controller_id')
+
+    _head_struct = struct.Struct('!iq')
+    _phase_struct = struct.Struct('!i')
+    _id_offset = _head_struct.size
+    _controller_id_offset = _id_offset + TC.MAX_ID_BYTES
+    _phase_offset = _controller_id_offset + TC.MAX_ID_BYTES
+    _request_types = frozenset([TC.PHASE_REQUEST, TC.PHASE_REQUEST_ON, TC.PHASE_REQUEST_OFF])
+
+    def __init__(self, msg:mqtt.MQTTMessage):
+        """
+        Wraps the payload of msg without copying it
+        :param msg: MQTTMessage
+        """
+        if len(msg.payload) != TC_Request._struct_size:
+            msg = 'improperly formatted TC Request payload: expected %d bytes got %d' % (TC_Request._struct_size, len(msg.payload))
+            raise TC_Exception(msg)
+
+        self._view = memoryview(msg.payload)
+        self.type, self.timestamp = TC_Request_View._head_struct.unpack_from(self._view, 0)
+        if self.type not in TC_Request_View._request_types:
+            msg = 'payload claimed to be a phase request but received code (%d)' % self.type
+            raise TC_Exception(msg)
+        (self.phase,) = TC_Request_View._phase_struct.unpack_from(self._view, TC_Request_View._phase_offset)
+        self._id = None
+        self._controller_id = None
+        self._encoding = TC.ENCODING_C_STRUC
+        self._src_mid = msg.mid
+
+    @classmethod
+    def decode(cls, msg:mqtt.MQTTMessage):
+        """
+        Creates a TC_Request_View over a payload packed using TC_Request.encode()
+        :param msg: MQTTMessage
+        :return: TC_Request_View
+        """
+        return TC_Request_View(msg)
+
+    def _decode_id(self, offset:int):
+        """
+        Decodes the null padded id field starting at offset
+        :param offset: int
+        :return: str
+        """
+        try:
+            return tc_ids.from_bytes(self._view[offset:offset + TC.MAX_ID_BYTES])
+        except UnicodeDecodeError as err:
+            raise TC_Exception("id decoding error: %s" % str(err))
+
+    def shard_key(self):
+        """
+        The utf-8 bytes of id read from the payload without decoding the id
+        :return: bytes
+        """
+        offset = TC_Request_View._id_offset
+        return bytes(self._view[offset:offset + TC.MAX_ID_BYTES]).rstrip(b'\0')
+
+    @property
+    def id(self):
+        if self._id is None:
+            self._id = self._decode_id(TC_Request_View._id_offset)
+        return self._id
+
+    @id.setter
+    def id(self, value:str):
+        self._id = value
+
+    @property
+    def controller_id(self):
+        if self._controller_id is None:
+            self._controller_id = self._decode_id(TC_Request_View._controller_id_offset)
+        return self._controller_id
+
+    @controller_id.setter
+    def controller_id(self, value:str):
+        self._controller_id = value
+
+
 class TC_ACK(TC_Identifier):
     """
     TC_ACK provides acknowledgement that referenced command suceeded
     """
+    __slots__ = ('mid', 'rc')
 
     _struct_format = '!iq%dsii' % (TC.MAX_ID_BYTES,)
-    _struct_size = struct.calcsize(_struct_format)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _v2_fields = (('timestamp', False), ('id', True), ('mid', False), ('rc', False))
 
 
-    def __init__(self, user_id:str, mid:int, result_code:int):
+    def __init__(self, user_id:str, mid:int, result_code:int, timestamp=None):
         """
 
         :param user_id:
         :param mid:
         :param result_code:
+        :param timestamp:
         """
-        super().__init__(TC.ACK, user_id)
+        super().__init__(TC.ACK, user_id, timestamp)
         self.mid = mid
         self.rc = None
         if result_code in TC.RESULT_CODES:
@@ -769,6 +1138,14 @@ class TC_ACK(TC_Identifier):
         else:
             raise TC_Exception("Result code %d out of range" % (result_code,))
 
+    def _validate(self):
+        """
+        Checks result code of an object created by a decoder that bypasses __init__
+        :return: None
+        """
+        if self.rc not in TC.RESULT_CODES:
+            raise TC_Exception("Result code %d out of range" % (self.rc,))
+
     def encode(self):
         """
         Converts python values into a bytes object representing a c structure for use in mqtt payload. Strings
@@ -784,12 +1161,23 @@ class TC_ACK(TC_Identifier):
 
         :return: bytearray
         """
+        packed = bytearray(TC_ACK._struct_size)
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
         user_id_bytes = self.id.encode('utf-8')
         if len(user_id_bytes) > TC.MAX_ID_BYTES:
             msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
             raise TC_Exception(msg)
-        packed = struct.pack(TC_ACK._struct_format, self.type, self.timestamp, user_id_bytes, self.mid, self.rc)
-        return bytearray(packed)
+        TC_ACK._struct.pack_into(buffer, offset, self.type, self.timestamp, user_id_bytes, self.mid, self.rc)
+        return TC_ACK._struct_size
 
 
     @classmethod
@@ -803,15 +1191,14 @@ class TC_ACK(TC_Identifier):
             msg = 'improperly formatted TC ACK payload: expected %d bytes got %d' % (TC_ACK._struct_size, len(msg.payload))
             raise TC_Exception(msg)
 
-        type, timestamp, user_id_bytes, mid, rc = struct.unpack(TC_ACK._struct_format, msg.payload)
+        type, timestamp, user_id_bytes, mid, rc = TC_ACK._struct.unpack(msg.payload)
 
         if type != TC.ACK:
             msg = 'payload claimed to be an ACK but received code (%d)' % type
             raise TC_Exception(msg)
-        user_id = user_id_bytes.decode('utf-8').rstrip('\0')
+        user_id = tc_ids.from_bytes(user_id_bytes)
 
-        myACK = TC_ACK(user_id, mid, rc)
-        myACK.timestamp = timestamp
+        myACK = TC_ACK(user_id, mid, rc, timestamp)
         myACK._encoding = TC.ENCODING_C_STRUC
         myACK._src_mid = msg.mid
 
@@ -824,13 +1211,20 @@ class TC_ACK(TC_Identifier):
         :param fs:
         :return: None
         """
+        fs.write(self.json_dumps())
+
+    def json_dumps(self):
+        """
+        Encodes TC_ACK object into a JSON string
+        :return: str
+        """
         json_dict = {}
         json_dict['type'] = self.type
         json_dict['timestamp'] = self.timestamp
         json_dict['id'] = self.id
         json_dict['mid'] = self.mid
         json_dict['rc'] =self.rc
-        json.dump(json_dict, fs)
+        return json.dumps(json_dict)
 
     @classmethod
     def json_load(cls, json_dict):
@@ -844,12 +1238,11 @@ class TC_ACK(TC_Identifier):
             msg = "JSON encoding contains %d elements when expecting %d" % (len(json_dict), TC.TC_ACK_LENGTH)
             raise TC_Exception(msg)
         try:
-            id = json_dict['id']
+            id = tc_ids.intern(json_dict['id'])
             timestamp = json_dict['timestamp']
             mid = int(json_dict['mid'])
             rc = int(json_dict['rc'])
-            myACK = TC_ACK(id, mid, rc)
-            myACK.timestamp = timestamp
+            myACK = TC_ACK(id, mid, rc, timestamp)
             return myACK
         except:
             msg = "Malformed TC_Request Encoding: %s" % (str(json_dict),)
@@ -865,22 +1258,124 @@ class TC_ACK(TC_Identifier):
         return msg
 
 
+class TC_ACK_Result(TC_ACK):
+    """
+    Acknowledgement of a completed admin command which also carries the command exit status and the start of its
+    output, truncated to TC.MAX_ADMIN_OUTPUT bytes.
+    """
+    __slots__ = ('status', 'output')
+
+    _struct_format = '!iq%dsiii%ds' % (TC.MAX_ID_BYTES, TC.MAX_ADMIN_OUTPUT)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _v2_fields = ()
+
+    def __init__(self, user_id:str, mid:int, result_code:int, status:int, output:str, timestamp=None):
+        """
+
+        :param user_id:
+        :param mid:
+        :param result_code:
+        :param status: int - exit status of the command
+        :param output: str - command output
+        :param timestamp:
+        """
+        super().__init__(user_id, mid, result_code, timestamp)
+        self.type = TC.ACK_RESULT
+        self.status = status
+        self.output = output
+
+    def encode(self):
+        """
+        Converts python values into a bytes object representing a c structure for use in mqtt payload.
+
+        struct TC_ACK_Result {
+            int type;
+            long long timestamp;
+            char user_id[TC.MAX_ID_BYTES];
+            int mid;
+            int rc;
+            int status;
+            char output[TC.MAX_ADMIN_OUTPUT];
+            } __attribute__((PACKED));
+
+        :return: bytearray
+        """
+        packed = bytearray(TC_ACK_Result._struct_size)
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        Output is silently truncated to TC.MAX_ADMIN_OUTPUT bytes.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        user_id_bytes = self.id.encode('utf-8')
+        if len(user_id_bytes) > TC.MAX_ID_BYTES:
+            msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
+            raise TC_Exception(msg)
+        output_bytes = self.output.encode('utf-8')[:TC.MAX_ADMIN_OUTPUT]
+        TC_ACK_Result._struct.pack_into(buffer, offset, self.type, self.timestamp, user_id_bytes, self.mid, self.rc,
+                                        self.status, output_bytes)
+        return TC_ACK_Result._struct_size
+
+    @classmethod
+    def decode(cls, msg:mqtt.MQTTMessage):
+        """
+        Creates a TC_ACK_Result obj from payload that was encoded using TC_ACK_Result.encode
+        :param msg: MQTTMessage
+        :return: TC_ACK_Result
+        """
+        if len(msg.payload) != TC_ACK_Result._struct_size:
+            msg = 'improperly formatted TC ACK Result payload: expected %d bytes got %d' % (TC_ACK_Result._struct_size, len(msg.payload))
+            raise TC_Exception(msg)
+
+        type, timestamp, user_id_bytes, mid, rc, status, output_bytes = TC_ACK_Result._struct.unpack(msg.payload)
+
+        if type != TC.ACK_RESULT:
+            msg = 'payload claimed to be an ACK result but received code (%d)' % type
+            raise TC_Exception(msg)
+        output = output_bytes.rstrip(b'\0').decode('utf-8', 'replace')
+
+        myACK = TC_ACK_Result(tc_ids.from_bytes(user_id_bytes), mid, rc, status, output, timestamp)
+        myACK._encoding = TC.ENCODING_C_STRUC
+        myACK._src_mid = msg.mid
+        return myACK
+
+    def __str__(self):
+        """
+        Human readable string
+        :return: string
+        """
+        msg = "Acknowledgement to %s for message id %d with result %s, exit status %d and timestamp %s: %s" % \
+              (self.id, self.mid, TC.RESULT_CODES[self.rc], self.status, datetime.utcfromtimestamp(self.timestamp),
+               self.output)
+        return msg
+
+
 class TC_Admin(TC_Identifier):
     """
     Base class for administration commands where want to require an action but do not need to provide input
     """
+    __slots__ = ('controller_id',)
 
     _struct_format = '!iq%ds%ds' % (TC.MAX_ID_BYTES, TC.MAX_ID_BYTES)
-    _struct_size = struct.calcsize(_struct_format)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _v2_fields = (('timestamp', False), ('id', True), ('controller_id', True))
 
-    def __init__(self, tc_cmd:int, user_id:str, controller_id:str):
+    def __init__(self, tc_cmd:int, user_id:str, controller_id:str, timestamp=None):
         """
         
         :param tc_cmd: int
         :param user_id: str - id of user sending the command
         :param controller_id: str - target machine for command execution
+        :param timestamp: int - defaults to now
         """
-        super().__init__(tc_cmd, user_id)
+        super().__init__(tc_cmd, user_id, timestamp)
         self.controller_id = controller_id
 
     def encode(self):
@@ -892,7 +1387,17 @@ class TC_Admin(TC_Identifier):
             char controller_id[TC.MAX_ID_BYTES]
         :return: bytearray
         """
+        packed = bytearray(TC_Admin._struct_size)
+        self.pack_into(packed)
+        return packed
 
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
         id_bytes = self.id.encode('utf-8')
         if len(id_bytes) > TC.MAX_ID_BYTES:
             msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
@@ -901,8 +1406,8 @@ class TC_Admin(TC_Identifier):
         if len(controller_id_bytes) > TC.MAX_ID_BYTES:
             msg = "controller id <%s> exceeds %d utf-8 bytes" % (self.controller_id, TC.MAX_ID_BYTES)
             raise TC_Exception(msg)
-        packed = struct.pack(TC_Admin._struct_format, self.type, self.timestamp, id_bytes, controller_id_bytes)
-        return bytearray(packed)
+        TC_Admin._struct.pack_into(buffer, offset, self.type, self.timestamp, id_bytes, controller_id_bytes)
+        return TC_Admin._struct_size
 
     @classmethod
     def decode(cls, msg:mqtt.MQTTMessage):
@@ -914,11 +1419,10 @@ class TC_Admin(TC_Identifier):
         if len(msg.payload) < TC_Admin._struct_size:
             msg = 'improperly formatted TC Admin payload'
             raise TC_Exception(msg)
-        type, timestamp, id_bytes, controller_id_bytes = struct.unpack_from(TC_Admin._struct_format, msg.payload, 0)
-        id = id_bytes.decode('utf-8').rstrip('\0')
-        controller_id = controller_id_bytes.decode('utf-8').rstrip('\0')
-        admin_cmd = TC_Admin(type, id, controller_id)
-        admin_cmd.timestamp = timestamp
+        type, timestamp, id_bytes, controller_id_bytes = TC_Admin._struct.unpack_from(msg.payload, 0)
+        id = tc_ids.from_bytes(id_bytes)
+        controller_id = tc_ids.from_bytes(controller_id_bytes)
+        admin_cmd = TC_Admin(type, id, controller_id, timestamp)
         admin_cmd._encoding = TC.ENCODING_C_STRUC
         admin_cmd._src_mid = msg.mid
 
@@ -934,221 +1438,1724 @@ class TC_Admin(TC_Identifier):
         return msg
 
 
-class TC_phase_request:
+class TC_Request_Batch(TC_Identifier):
     """
-    State information we want to keep for a phase loop
+    Carries several phase on/off requests to one controller in a single payload, e.g. from a gateway aggregating
+    requests for many users. Each entry is a (user_id, phase, type) tuple where type is TC.PHASE_REQUEST_ON or
+    TC.PHASE_REQUEST_OFF.
     """
+    __slots__ = ('controller_id', 'entries')
 
-    def __init__(self, phase:int, user:str):
-        self.phase = phase
-        self.timestamp = datetime.now()
-        self.user = user
+    _struct_format = '!iq%ds%dsi' % (TC.MAX_ID_BYTES, TC.MAX_ID_BYTES)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _entry_struct = struct.Struct('!%dsii' % (TC.MAX_ID_BYTES,))
 
+    def __init__(self, user_id:str, controller_id:str, entries, timestamp=None):
+        """
 
-class TC_Relay(threading.Thread):
-    """
-    Controls relays effecting Traffic Controller Phases. Maintains local phase state and setter methods that ensure
-    relayy access methods are executed atomically.
-    """
+        :param user_id: str - id of the sender
+        :param controller_id: str
+        :param entries: list [(str, int, int)] of (user_id, phase, request type)
+        :param timestamp: int - defaults to now
+        """
+        super().__init__(TC.PHASE_REQUEST_BATCH, user_id, timestamp)
+        self.controller_id = controller_id
+        self.entries = list(entries)
 
-    def __init__(self, parent, pins, max_on_time=TC.MAX_PHASE_ON_SECS):
+    def packed_size(self):
         """
-        Sets up control of these pins, relies on server to provide a valid gpio pin list
-        A timer is setup to check states every 30 seconds. This allows PHASE_ON to timeout
-        after TC.MAX_PHASE_ON_SECS. Acts as a fail safe so that states are not kept on
-        indefinitely.
-        :param self:
-        :param pins: list of grovepi pin ids used for relay control
-        :return: None
+        Number of bytes encode() or pack_into() will produce for this object
+        :return: int
         """
-        super().__init__()
-        self._parent = parent
-        self._max_delta_time = timedelta(seconds=max_on_time)
-        self._valid_pins = frozenset(pins)
-        self._phase_queues = dict()
-        self._runnable = True
-        self._lock = threading.Lock()
-        self._update = threading.Event()
-        self._timer = threading.Timer(TC.MAX_PHASE_ON_SECS/TC.CHECK_PHASE_TIMEOUT_INTERVAL, self._timeout)
+        return TC_Request_Batch._struct_size + len(self.entries) * TC_Request_Batch._entry_struct.size
 
-        for pin in pins:
-            self._phase_queues[pin] = dict()
-
-    def set_phase_on(self, request:TC_phase_request):
-        """
-        Sets the state of the pin to on
-        :param pin:
-        :return: None
+    def encode(self):
         """
-        msg = ""
-        pin_num = self._parent.phase_to_gpio[request.phase]
-        if pin_num in self._valid_pins:
-            self._lock.acquire()
-            self._timer.cancel()
+        Converts python values into a bytes object representing a c structure for use in mqtt payload.
 
-            phase_queue = self._phase_queues[pin_num]
-            if request.user in phase_queue:
-                msg = "Extending phase %d (pin %d) time for user %s " % (request.phase, pin_num, request.user)
-                self._parent.output_log(msg)
-                phase_queue[request.user].timestamp = datetime.now()
-            else:
-                request.timestamp = datetime.now()
+        struct TC_Request_Entry {
+            char user_id[TC.MAX_ID_BYTES];
+            int phase;
+            int type;
+            } __attribute__((PACKED));
+
+        struct TC_Request_Batch {
+            int type;
+            long long timestamp;
+            char user_id[TC.MAX_ID_BYTES];
+            char controller_id[TC.MAX_ID_BYTES];
+            int count;
+            struct TC_Request_Entry entries[count];
+            } __attribute__((PACKED));
+
+        :return: bytearray
+        """
+        packed = bytearray(self.packed_size())
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        if len(self.entries) > TC.MAX_BATCH_ENTRIES:
+            msg = "batch of %d requests exceeds %d entries" % (len(self.entries), TC.MAX_BATCH_ENTRIES)
+            raise TC_Exception(msg)
+        id_bytes = self.id.encode('utf-8')
+        if len(id_bytes) > TC.MAX_ID_BYTES:
+            msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
+            raise TC_Exception(msg)
+        controller_id_bytes = self.controller_id.encode('utf-8')
+        if len(controller_id_bytes) > TC.MAX_ID_BYTES:
+            msg = "controller id <%s> exceeds %d utf-8 bytes" % (self.controller_id, TC.MAX_ID_BYTES)
+            raise TC_Exception(msg)
+        TC_Request_Batch._struct.pack_into(buffer, offset, self.type, self.timestamp, id_bytes, controller_id_bytes,
+                                           len(self.entries))
+        position = offset + TC_Request_Batch._struct_size
+        for user_id, phase, type in self.entries:
+            user_id_bytes = user_id.encode('utf-8')
+            if len(user_id_bytes) > TC.MAX_ID_BYTES:
+                msg = "user id <%s> exceeds %d utf-8 bytes" % (user_id, TC.MAX_ID_BYTES)
+                raise TC_Exception(msg)
+            TC_Request_Batch._entry_struct.pack_into(buffer, position, user_id_bytes, phase, type)
+            position += TC_Request_Batch._entry_struct.size
+        return position - offset
+
+    @classmethod
+    def decode(cls, msg:mqtt.MQTTMessage):
+        """
+        Creates a TC_Request_Batch object from bytes object which should have been packed using
+        TC_Request_Batch.encode()
+        :param msg: MQTTMessage
+        :return: TC_Request_Batch
+        """
+        payload = msg.payload
+        if len(payload) < TC_Request_Batch._struct_size:
+            msg = 'improperly formatted TC Request Batch payload'
+            raise TC_Exception(msg)
+        type, timestamp, id_bytes, controller_id_bytes, count = TC_Request_Batch._struct.unpack_from(payload, 0)
+        if type != TC.PHASE_REQUEST_BATCH:
+            msg = 'payload claimed to be a phase request batch but received code (%d)' % type
+            raise TC_Exception(msg)
+        expected = TC_Request_Batch._struct_size + count * TC_Request_Batch._entry_struct.size
+        if count < 0 or count > TC.MAX_BATCH_ENTRIES or len(payload) != expected:
+            msg = 'improperly formatted TC Request Batch payload: %d entries in %d bytes' % (count, len(payload))
+            raise TC_Exception(msg)
+
+        entries = []
+        position = TC_Request_Batch._struct_size
+        for i in range(count):
+            user_id_bytes, phase, entry_type = TC_Request_Batch._entry_struct.unpack_from(payload, position)
+            entries.append((tc_ids.from_bytes(user_id_bytes), phase, entry_type))
+            position += TC_Request_Batch._entry_struct.size
+
+        batch = TC_Request_Batch(tc_ids.from_bytes(id_bytes), tc_ids.from_bytes(controller_id_bytes), entries,
+                                 timestamp)
+        batch._encoding = TC.ENCODING_C_STRUC
+        batch._src_mid = msg.mid
+        return batch
+
+    def __str__(self):
+        """
+        Generates a human readable string suitable for logging
+        :return: str
+        """
+        requests = ", ".join(["%s %s phase %d" % (user_id, 'on' if type == TC.PHASE_REQUEST_ON else 'off', phase)
+                              for user_id, phase, type in self.entries])
+        msg = "User %s sent batch of %d requests, timestamp %s, to controller %s: %s" % \
+              (self.id, len(self.entries), datetime.utcfromtimestamp(self.timestamp), self.controller_id, requests)
+        return msg
+
+
+class TC_ACK_Batch(TC_Identifier):
+    """
+    Acknowledgement for a TC_Request_Batch carrying one result code for each entry of the batch, in order
+    """
+    __slots__ = ('mid', 'results')
+
+    _struct_format = '!iq%dsii' % (TC.MAX_ID_BYTES,)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _entry_struct = struct.Struct('!i')
+
+    def __init__(self, user_id:str, mid:int, results, timestamp=None):
+        """
+
+        :param user_id: str
+        :param mid: int - message id of the acknowledged batch
+        :param results: list [int] of result codes
+        :param timestamp: int - defaults to now
+        """
+        super().__init__(TC.ACK_BATCH, user_id, timestamp)
+        self.mid = mid
+        self.results = list(results)
+        for rc in self.results:
+            if rc not in TC.RESULT_CODES:
+                raise TC_Exception("Result code %d out of range" % (rc,))
+
+    def packed_size(self):
+        """
+        Number of bytes encode() or pack_into() will produce for this object
+        :return: int
+        """
+        return TC_ACK_Batch._struct_size + len(self.results) * TC_ACK_Batch._entry_struct.size
+
+    def encode(self):
+        """
+        Converts python values into a bytes object representing a c structure for use in mqtt payload.
+
+        struct TC_ACK_Batch {
+            int type;
+            long long timestamp;
+            char user_id[TC.MAX_ID_BYTES];
+            int mid;
+            int count;
+            int rc[count];
+            } __attribute__((PACKED));
+
+        :return: bytearray
+        """
+        packed = bytearray(self.packed_size())
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        user_id_bytes = self.id.encode('utf-8')
+        if len(user_id_bytes) > TC.MAX_ID_BYTES:
+            msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
+            raise TC_Exception(msg)
+        TC_ACK_Batch._struct.pack_into(buffer, offset, self.type, self.timestamp, user_id_bytes, self.mid,
+                                       len(self.results))
+        position = offset + TC_ACK_Batch._struct_size
+        for rc in self.results:
+            TC_ACK_Batch._entry_struct.pack_into(buffer, position, rc)
+            position += TC_ACK_Batch._entry_struct.size
+        return position - offset
+
+    @classmethod
+    def decode(cls, msg:mqtt.MQTTMessage):
+        """
+        Creates a TC_ACK_Batch obj from payload that was encoded using TC_ACK_Batch.encode
+        :param msg: MQTTMessage
+        :return: TC_ACK_Batch
+        """
+        payload = msg.payload
+        if len(payload) < TC_ACK_Batch._struct_size:
+            msg = 'improperly formatted TC ACK Batch payload'
+            raise TC_Exception(msg)
+        type, timestamp, user_id_bytes, mid, count = TC_ACK_Batch._struct.unpack_from(payload, 0)
+        if type != TC.ACK_BATCH:
+            msg = 'payload claimed to be a batch ACK but received code (%d)' % type
+            raise TC_Exception(msg)
+        if count < 0 or len(payload) != TC_ACK_Batch._struct_size + count * TC_ACK_Batch._entry_struct.size:
+            msg = 'improperly formatted TC ACK Batch payload: %d results in %d bytes' % (count, len(payload))
+            raise TC_Exception(msg)
+        results = struct.unpack_from('!%di' % (count,), payload, TC_ACK_Batch._struct_size)
+
+        myACK = TC_ACK_Batch(tc_ids.from_bytes(user_id_bytes), mid, results, timestamp)
+        myACK._encoding = TC.ENCODING_C_STRUC
+        myACK._src_mid = msg.mid
+        return myACK
+
+    def __str__(self):
+        """
+        Human readable string
+        :return: string
+        """
+        results = ", ".join([TC.RESULT_CODES[rc] for rc in self.results])
+        msg = "Batch acknowledgement to %s for message id %d with results [%s] and timestamp %s" % \
+              (self.id, self.mid, results, datetime.utcfromtimestamp(self.timestamp))
+        return msg
+
+
+class TC_ACK_Multi(TC_Identifier):
+    """
+    Several acknowledgements to one user in a single payload, each entry keeps the message id and result code of the
+    request it acknowledges
+    """
+    __slots__ = ('entries',)
+
+    _struct_format = '!iq%dsi' % (TC.MAX_ID_BYTES,)
+    _struct = struct.Struct(_struct_format)
+    _struct_size = _struct.size
+    _entry_struct = struct.Struct('!ii')
+
+    def __init__(self, user_id:str, entries, timestamp=None):
+        """
+        Instantiates the acknowledgements to user_id of the requests listed in entries
+        :param user_id: str
+        :param entries: list [(int, int)] of (message id, result code)
+        :param timestamp: int - defaults to now
+        """
+        super().__init__(TC.ACK_MULTI, user_id, timestamp)
+        self.entries = [(mid, rc) for mid, rc in entries]
+        if len(self.entries) > TC.MAX_MULTI_ENTRIES:
+            raise TC_Exception("ACK multi of %d entries exceeds %d" % (len(self.entries), TC.MAX_MULTI_ENTRIES))
+        for mid, rc in self.entries:
+            if rc not in TC.RESULT_CODES:
+                raise TC_Exception("Result code %d out of range" % (rc,))
+
+    def packed_size(self):
+        """
+        Number of bytes encode() or pack_into() will produce for this object
+        :return: int
+        """
+        return TC_ACK_Multi._struct_size + len(self.entries) * TC_ACK_Multi._entry_struct.size
+
+    def encode(self):
+        """
+        Converts python values into a bytes object representing a c structure for use in mqtt payload.
+
+        struct TC_ACK_Multi {
+            int type;
+            long long timestamp;
+            char user_id[TC.MAX_ID_BYTES];
+            int count;
+            struct {
+                int mid;
+                int rc;
+                } entry[count];
+            } __attribute__((PACKED));
+
+        :return: bytearray
+        """
+        packed = bytearray(self.packed_size())
+        self.pack_into(packed)
+        return packed
+
+    def pack_into(self, buffer, offset=0):
+        """
+        Packs the same c structure as encode() into a caller supplied writable buffer starting at offset.
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        user_id_bytes = self.id.encode('utf-8')
+        if len(user_id_bytes) > TC.MAX_ID_BYTES:
+            msg = "user id <%s> exceeds %d utf-8 bytes" % (self.id, TC.MAX_ID_BYTES)
+            raise TC_Exception(msg)
+        TC_ACK_Multi._struct.pack_into(buffer, offset, self.type, self.timestamp, user_id_bytes, len(self.entries))
+        position = offset + TC_ACK_Multi._struct_size
+        for mid, rc in self.entries:
+            TC_ACK_Multi._entry_struct.pack_into(buffer, position, mid, rc)
+            position += TC_ACK_Multi._entry_struct.size
+        return position - offset
+
+    @classmethod
+    def decode(cls, msg:mqtt.MQTTMessage):
+        """
+        Creates a TC_ACK_Multi obj from payload that was encoded using TC_ACK_Multi.encode
+        :param msg: MQTTMessage
+        :return: TC_ACK_Multi
+        """
+        payload = msg.payload
+        if len(payload) < TC_ACK_Multi._struct_size:
+            msg = 'improperly formatted TC ACK Multi payload'
+            raise TC_Exception(msg)
+        type, timestamp, user_id_bytes, count = TC_ACK_Multi._struct.unpack_from(payload, 0)
+        if type != TC.ACK_MULTI:
+            msg = 'payload claimed to be a multi ACK but received code (%d)' % type
+            raise TC_Exception(msg)
+        if count < 0 or count > TC.MAX_MULTI_ENTRIES or \
+                len(payload) != TC_ACK_Multi._struct_size + count * TC_ACK_Multi._entry_struct.size:
+            msg = 'improperly formatted TC ACK Multi payload: %d entries in %d bytes' % (count, len(payload))
+            raise TC_Exception(msg)
+        entries = TC_ACK_Multi._entry_struct.iter_unpack(memoryview(payload)[TC_ACK_Multi._struct_size:])
+
+        myACK = TC_ACK_Multi(tc_ids.from_bytes(user_id_bytes), entries, timestamp)
+        myACK._encoding = TC.ENCODING_C_STRUC
+        myACK._src_mid = msg.mid
+        return myACK
+
+    def __str__(self):
+        """
+        Human readable string
+        :return: string
+        """
+        entries = ", ".join(["%d: %s" % (mid, TC.RESULT_CODES[rc]) for mid, rc in self.entries])
+        msg = "Multi acknowledgement to %s for message ids [%s] and timestamp %s" % \
+              (self.id, entries, datetime.utcfromtimestamp(self.timestamp))
+        return msg
+
+
+class TC_Codec:
+    """
+    Registry of precompiled payload structures and decoders keyed by TC message type. TC.decode uses the registry to
+    dispatch straight from the payload type field to the matching decoder. The registry also holds the classes for
+    the compact v2 encoding, whose payloads are recognized by the high bit of their first byte.
+    """
+
+    def __init__(self):
+        self._decoders = dict()
+        self._views = dict()
+        self._structs = dict()
+        self._v2_classes = dict()
+
+    def register(self, tc_type:int, cls):
+        """
+        Associates message type code with the decode() method and precompiled struct of a TC_Type derived class
+        :param tc_type: int
+        :param cls: TC_Type derived class
+        :return: None
+        """
+        self._decoders[tc_type] = cls.decode
+        self._structs[tc_type] = cls._struct
+        if tc_type in TC.V2_TYPE_CODES:
+            self._v2_classes[tc_type] = cls
+
+    def register_view(self, tc_type:int, cls):
+        """
+        Associates message type code with the decode() method of a class used when lazy decoding is requested
+        :param tc_type: int
+        :param cls: TC_Type derived class
+        :return: None
+        """
+        self._views[tc_type] = cls.decode
+
+    def get_struct(self, tc_type:int):
+        """
+        Returns the precompiled struct registered for message type
+        :param tc_type: int
+        :return: struct.Struct
+        """
+        if tc_type not in self._structs:
+            raise TC_Exception("No matching command type (%d)" % (tc_type,))
+        return self._structs[tc_type]
+
+    def decode(self, mqtt_msg:mqtt.MQTTMessage, lazy=False):
+        """
+        Decodes c_struct encoded payload using the decoder registered for its type field. Where lazy is set and a
+        view class is registered for the type, that is used instead.
+        :param mqtt_msg: MQTTMessage
+        :param lazy: bool
+        :return: TC_Type derived object
+        """
+        payload = mqtt_msg.payload
+        if len(payload) > 0 and payload[0] & TC.V2_MARKER:
+            return self.decode_v2(mqtt_msg)
+        if len(payload) < TC._payload_type_length:
+            msg = 'improperly formated TC payload'
+            raise TC_Exception(msg)
+        (tc_type,) = TC._payload_type_struct.unpack_from(payload, 0)
+        decoder = None
+        if lazy:
+            decoder = self._views.get(tc_type)
+        if decoder is None:
+            decoder = self._decoders.get(tc_type)
+        if decoder is None:
+            raise TC_Exception("No matching command type")
+        return decoder(mqtt_msg)
+
+    def encode_v2(self, tc_cmd:TC_Type):
+        """
+        Encodes tc_cmd in the compact v2 format: one byte type code followed by its _v2_fields in order, each either
+        a varint or a varint length prefixed utf-8 id.
+        :param tc_cmd: TC_Type derived object
+        :return: bytearray
+        """
+        if tc_cmd.type not in self._v2_classes:
+            raise TC_Exception("No v2 encoding for command type (%d)" % (tc_cmd.type,))
+        packed = bytearray((TC.V2_TYPE_CODES[tc_cmd.type],))
+        for name, is_id in tc_cmd._v2_fields:
+            value = getattr(tc_cmd, name)
+            if is_id:
+                value = value.encode('utf-8')
+                if len(value) > TC.MAX_ID_BYTES:
+                    msg = "%s <%s> exceeds %d utf-8 bytes" % (name, getattr(tc_cmd, name), TC.MAX_ID_BYTES)
+                    raise TC_Exception(msg)
+                _put_varint(packed, len(value))
+                packed += value
+            else:
+                _put_varint(packed, value)
+        return packed
+
+    def decode_v2(self, mqtt_msg:mqtt.MQTTMessage):
+        """
+        Decodes a payload encoded with encode_v2()
+        :param mqtt_msg: MQTTMessage
+        :return: TC_Type derived object
+        """
+        payload = mqtt_msg.payload
+        tc_type = TC.V2_TYPES.get(payload[0])
+        cls = self._v2_classes.get(tc_type)
+        if cls is None:
+            raise TC_Exception("No matching v2 command type (0x%02x)" % (payload[0],))
+
+        view = memoryview(payload)
+        tc_cmd = cls.__new__(cls)
+        tc_cmd.type = tc_type
+        offset = 1
+        for name, is_id in cls._v2_fields:
+            value, offset = _get_varint(payload, offset)
+            if is_id:
+                end = offset + value
+                if value > TC.MAX_ID_BYTES or end > len(payload):
+                    raise TC_Exception("improperly formatted v2 %s field" % (name,))
+                try:
+                    value = tc_ids.from_bytes(view[offset:end])
+                except UnicodeDecodeError as err:
+                    raise TC_Exception("v2 %s decoding error: %s" % (name, str(err)))
+                offset = end
+            setattr(tc_cmd, name, value)
+        if offset != len(payload):
+            msg = 'improperly formatted v2 payload: %d trailing bytes' % (len(payload) - offset,)
+            raise TC_Exception(msg)
+        tc_cmd._validate()
+        tc_cmd._encoding = TC.ENCODING_V2
+        tc_cmd._src_mid = mqtt_msg.mid
+        return tc_cmd
+
+    def pack_into(self, tc_cmd:TC_Type, buffer, offset=0):
+        """
+        Packs tc_cmd into a caller supplied writable buffer, checking first that the buffer has room for it
+        :param tc_cmd: TC_Type derived object
+        :param buffer: bytearray or writable memoryview
+        :param offset: int
+        :return: int number of bytes written
+        """
+        self.get_struct(tc_cmd.type)
+        size = tc_cmd.packed_size()
+        if len(buffer) - offset < size:
+            msg = "buffer too small for command type %d: need %d bytes at offset %d" % (tc_cmd.type, size, offset)
+            raise TC_Exception(msg)
+        return tc_cmd.pack_into(buffer, offset)
+
+
+tc_codec = TC_Codec()
+tc_codec.register(TC.WILL, TC_Identifier)
+tc_codec.register(TC.ID, TC_Identifier)
+tc_codec.register(TC.ACK, TC_ACK)
+tc_codec.register(TC.PHASE_REQUEST, TC_Request)
+tc_codec.register(TC.PHASE_REQUEST_ON, TC_Request_On)
+tc_codec.register(TC.PHASE_REQUEST_OFF, TC_Request_Off)
+tc_codec.register(TC.PHASE_REQUEST_BATCH, TC_Request_Batch)
+tc_codec.register(TC.ACK_BATCH, TC_ACK_Batch)
+tc_codec.register(TC.ACK_RESULT, TC_ACK_Result)
+tc_codec.register(TC.ACK_MULTI, TC_ACK_Multi)
+tc_codec.register(TC.ADMIN_REBOOT, TC_Admin)
+tc_codec.register(TC.ADMIN_WIFI_ENABLE, TC_Admin)
+tc_codec.register(TC.ADMIN_WIFI_DISABLE, TC_Admin)
+tc_codec.register_view(TC.PHASE_REQUEST, TC_Request_View)
+tc_codec.register_view(TC.PHASE_REQUEST_ON, TC_Request_View)
+tc_codec.register_view(TC.PHASE_REQUEST_OFF, TC_Request_View)
+
+
+class TC_ACK_Template:
+    """
+    Preencoded TC_ACK payload for one user and encoding. Only the mid, rc and timestamp fields vary between ACKs sent
+    to the same user, so render() patches just those into a copy of the encoded template.
+    """
+
+    _timestamp_struct = struct.Struct('!q')
+    _result_struct = struct.Struct('!ii')
+    _timestamp_offset = TC._payload_type_length
+    _result_offset = _timestamp_offset + _timestamp_struct.size + TC.MAX_ID_BYTES
+
+    def __init__(self, user_id:str, encoding:int):
+        """
+
+        :param user_id: str
+        :param encoding: int - TC.ENCODING_C_STRUC, TC.ENCODING_JSON or TC.ENCODING_V2
+        """
+        self.user_id = user_id
+        self.encoding = encoding
+        self.topic = TC._tc_topic_format % (user_id,)
+        self._buffer = None
+        self._id_field = None
+        self._json_format = None
+        if encoding == TC.ENCODING_JSON:
+            # same key order and separators as TC_ACK.json_dumps()
+            id_json = json.dumps(user_id).replace('%', '%%')
+            self._json_format = '{"type": %d, "timestamp": %%d, "id": %s, "mid": %%d, "rc": %%d}' % (TC.ACK, id_json)
+        elif encoding == TC.ENCODING_V2:
+            id_bytes = user_id.encode('utf-8')
+            if len(id_bytes) > TC.MAX_ID_BYTES:
+                msg = "user id <%s> exceeds %d utf-8 bytes" % (user_id, TC.MAX_ID_BYTES)
+                raise TC_Exception(msg)
+            self._id_field = bytearray()
+            _put_varint(self._id_field, len(id_bytes))
+            self._id_field += id_bytes
+        else:
+            self._buffer = bytes(TC_ACK(user_id, 0, TC.ACK_OK, 0).encode())
+
+    def render(self, mid:int, rc:int, timestamp:int):
+        """
+        Returns a new payload for an acknowledgement of message id mid with result rc
+        :param mid: int
+        :param rc: int
+        :param timestamp: int
+        :return: bytes or str (json)
+        """
+        if rc not in TC.RESULT_CODES:
+            raise TC_Exception("Result code %d out of range" % (rc,))
+        if self._json_format:
+            return self._json_format % (timestamp, mid, rc)
+        if self._id_field:
+            packed = bytearray((TC.V2_TYPE_CODES[TC.ACK],))
+            _put_varint(packed, timestamp)
+            packed += self._id_field
+            _put_varint(packed, mid)
+            _put_varint(packed, rc)
+            return packed
+        packed = bytearray(self._buffer)
+        TC_ACK_Template._timestamp_struct.pack_into(packed, TC_ACK_Template._timestamp_offset, timestamp)
+        TC_ACK_Template._result_struct.pack_into(packed, TC_ACK_Template._result_offset, mid, rc)
+        return packed
+
+
+class TC_ACK_Cache:
+    """
+    Bounded cache of TC_ACK_Template objects keyed by user id and encoding with least recently used eviction
+    """
+
+    def __init__(self, max_size=TC.ACK_CACHE_SIZE):
+        """
+
+        :param max_size: int
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id:str, encoding:int):
+        """
+        Returns the template for user_id and encoding, creating it if not already cached
+        :param user_id: str
+        :param encoding: int
+        :return: TC_ACK_Template
+        """
+        if encoding not in [TC.ENCODING_JSON, TC.ENCODING_V2]:
+            encoding = TC.ENCODING_C_STRUC
+        key = (user_id, encoding)
+
+        self._lock.acquire()
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+            self.hits += 1
+        self._lock.release()
+        if template is not None:
+            return template
+
+        template = TC_ACK_Template(user_id, encoding)
+        self._lock.acquire()
+        self.misses += 1
+        self._templates[key] = template
+        while len(self._templates) > self.max_size:
+            self._templates.popitem(last=False)
+        self._lock.release()
+        return template
+
+    def __len__(self):
+        return len(self._templates)
+
+
+class TC_Timer_Handle:
+    """
+    A callback scheduled on the TC_Scheduler. Returned by schedule() so the caller can cancel it.
+    """
+
+    __slots__ = ('expires', 'callback', 'args', 'cancelled', '_scheduler', '_slot')
+
+    def __init__(self, expires:int, callback, args, scheduler=None):
+        """
+
+        :param expires: int scheduler tick at which callback is due
+        :param callback: callable
+        :param args: tuple of positional arguments for callback
+        :param scheduler: TC_Scheduler holding the handle
+        """
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self._scheduler = scheduler
+        self._slot = None   # wheel slot list holding the handle, None once due
+
+    def cancel(self):
+        """
+        Prevents the callback from running if it has not already started, a handle still waiting in the wheel is
+        taken out of it
+        :return: None
+        """
+        if self._scheduler is not None:
+            self._scheduler._cancel(self)
+        else:
+            self.cancelled = True
+
+
+class TC_Scheduler(threading.Thread):
+    """
+    Runs timed callbacks from a single thread using a hierarchical timing wheel. The innermost wheel has one slot per
+    tick, each outer wheel slot spans a full revolution of the wheel inside it. Timers are placed in the innermost
+    wheel able to hold their delay and cascade inward as their expiry approaches, so scheduling and cancelling are
+    constant time. Delays shorter than a tick are kept in a heap by deadline instead and run to the millisecond.
+    Callbacks run on the scheduler thread and must not block, long work is handed to another thread.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, tick=TC.SCHEDULER_TICK, slot_bits=TC.SCHEDULER_SLOT_BITS, levels=TC.SCHEDULER_LEVELS):
+        """
+
+        :param tick: float seconds per slot of the innermost wheel
+        :param slot_bits: int log2 of the number of slots per wheel
+        :param levels: int number of wheels
+        """
+        super().__init__(name='TC_Scheduler')
+        self.daemon = True
+        self._tick = tick
+        self._slot_bits = slot_bits
+        self._slot_mask = (1 << slot_bits) - 1
+        self._max_ticks = (1 << (slot_bits * levels)) - 1
+        self._wheels = [[[] for slot in range(1 << slot_bits)] for level in range(levels)]
+        self._epoch = monotonic()
+        self._current = 0
+        self._pending = 0   # timers in the wheels
+        self._short = []    # heap of (monotonic deadline, sequence, TC_Timer_Handle) for delays under one tick
+        self._runnable = True
+        self._condition = threading.Condition()
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.wakeups = 0
+
+    @classmethod
+    def get(cls):
+        """
+        Returns the process wide scheduler, starting it on first use
+        :return: TC_Scheduler
+        """
+        cls._instance_lock.acquire()
+        if cls._instance is None or not cls._instance.is_alive():
+            cls._instance = cls()
+            cls._instance.start()
+        cls._instance_lock.release()
+        return cls._instance
+
+    def schedule(self, delay:float, callback, *args):
+        """
+        Schedules callback(*args) to run once after delay seconds, rounded up to the next tick unless shorter than
+        a tick
+        :param delay: float seconds
+        :param callback: callable
+        :return: TC_Timer_Handle
+        """
+        self._condition.acquire()
+        if delay < self._tick:
+            deadline = monotonic() + max(0.0, delay)
+            handle = TC_Timer_Handle(int((deadline - self._epoch) / self._tick), callback, args, self)
+            heapq.heappush(self._short, (deadline, self.scheduled, handle))
+        else:
+            ticks = int(-(-delay // self._tick))
+            if self._pending == 0:
+                # nothing to cascade while idle, skip the wheel forward rather than replaying empty ticks
+                self._current = self._now()
+            # the wheel stands still while the thread sleeps to its next slot, count from the tick now under way
+            handle = TC_Timer_Handle(max(self._current, self._now() + 1) + ticks, callback, args, self)
+            self._insert(handle)
+            self._pending += 1
+        self.scheduled += 1
+        self._condition.notify()
+        self._condition.release()
+        return handle
+
+    def _cancel(self, handle:TC_Timer_Handle):
+        """
+        Marks handle cancelled and removes it from its wheel slot if it is not yet due, a cancelled handle in the
+        heap of short timers is dropped when its deadline passes
+        :param handle: TC_Timer_Handle
+        :return: None
+        """
+        self._condition.acquire()
+        if not handle.cancelled:
+            handle.cancelled = True
+            if handle._slot is not None:
+                handle._slot.remove(handle)
+                handle._slot = None
+                self._pending -= 1
+                self.cancelled += 1
+        self._condition.release()
+
+    def stop(self):
+        """
+        Quits thread, pending callbacks are dropped
+        :return: None
+        """
+        self._condition.acquire()
+        self._runnable = False
+        self._condition.notify()
+        self._condition.release()
+
+    def stats(self):
+        """
+        Snapshot of scheduler counters
+        :return: dict with pending, scheduled, fired and cancelled counts and thread wakeups
+        """
+        return {'pending': self._pending + len(self._short), 'scheduled': self.scheduled, 'fired': self.fired,
+                'cancelled': self.cancelled, 'wakeups': self.wakeups}
+
+    def run(self):
+        """
+        Sleeps until the next occupied slot, cascade or short timer deadline while timers are pending, then advances
+        the wheels to the current tick and runs due callbacks
+        :return: None
+        """
+        while self._runnable:
+            self._condition.acquire()
+            while self._runnable and self._pending == 0 and not self._short:
+                self._condition.wait()
+            self.wakeups += 1
+            due = []
+            now = monotonic()
+            while self._short and self._short[0][0] <= now:
+                due.append(heapq.heappop(self._short)[2])
+            timeout = None
+            if self._pending > 0:
+                next_tick = self._next_tick()
+                if next_tick > self._now():
+                    timeout = self._epoch + next_tick * self._tick - now
+                else:
+                    while self._current <= self._now():
+                        due.extend(self._advance())
+            if self._runnable and not due and (timeout is not None or self._pending == 0):
+                if self._short:
+                    short = self._short[0][0] - now
+                    timeout = short if timeout is None else min(timeout, short)
+                self._condition.wait(timeout)
+            self._condition.release()
+
+            for handle in due:
+                if handle.cancelled:
+                    self.cancelled += 1
+                    continue
+                self.fired += 1
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    msg = "%s: scheduled callback %r failed: %s\n" % (str(datetime.now()), handle.callback, e)
+                    sys.stderr.write(msg)
+
+    def _now(self):
+        """
+        :return: int ticks elapsed since the scheduler was created
+        """
+        return int((monotonic() - self._epoch) / self._tick)
+
+    def _next_tick(self):
+        """
+        First tick with work to do, the next occupied slot of the innermost wheel in its current revolution or else
+        the end of the revolution where outer wheels cascade. Caller must hold the condition.
+        :return: int tick
+        """
+        index = self._current & self._slot_mask
+        wheel = self._wheels[0]
+        for slot in range(index, self._slot_mask + 1):
+            if wheel[slot]:
+                return self._current + slot - index
+        return (self._current | self._slot_mask) + 1
+
+    def _insert(self, handle:TC_Timer_Handle):
+        """
+        Places handle in the innermost wheel whose span covers its remaining ticks, caller must hold the condition
+        :param handle: TC_Timer_Handle
+        :return: None
+        """
+        expires = handle.expires
+        remaining = expires - self._current
+        if remaining < 0:
+            expires = self._current
+        elif remaining > self._max_ticks:
+            expires = self._current + self._max_ticks
+        level = 0
+        remaining = (expires - self._current) >> self._slot_bits
+        while remaining > 0:
+            level += 1
+            remaining >>= self._slot_bits
+        slot = (expires >> (self._slot_bits * level)) & self._slot_mask
+        handle._slot = self._wheels[level][slot]
+        handle._slot.append(handle)
+
+    def _advance(self):
+        """
+        Processes the current tick, cascading outer wheel slots that fall due, then moves to the next tick.
+        Caller must hold the condition.
+        :return: list of TC_Timer_Handle due to run
+        """
+        level = 0
+        index = self._current & self._slot_mask
+        while index == 0 and level + 1 < len(self._wheels):
+            level += 1
+            index = (self._current >> (self._slot_bits * level)) & self._slot_mask
+            cascade = self._wheels[level][index]
+            self._wheels[level][index] = []
+            for handle in cascade:
+                self._insert(handle)
+
+        slot = self._current & self._slot_mask
+        due = self._wheels[0][slot]
+        self._wheels[0][slot] = []
+        for handle in due:
+            handle._slot = None
+        self._pending -= len(due)
+        self._current += 1
+        return due
+
+
+class TC_phase_request:
+    """
+    State information we want to keep for a phase loop
+    """
+
+    def __init__(self, phase:int, user:str):
+        self.phase = phase
+        self.timestamp = datetime.now()
+        self.received = monotonic()
+        self.deadline = None
+        self.user = user
+
+
+class TC_Relay(threading.Thread):
+    """
+    Controls relays effecting Traffic Controller Phases. Maintains local phase state and setter methods that ensure
+    relayy access methods are executed atomically.
+    """
+
+    def __init__(self, parent, pins, max_on_time=TC.MAX_PHASE_ON_SECS, reassert_interval=TC.RELAY_REASSERT_INTERVAL,
+                 verify=True, io=grovepi):
+        """
+        Sets up control of these pins, relies on server to provide a valid gpio pin list
+        Each phase request carries a monotonic deadline kept in a min heap, the relay thread sleeps until the
+        earliest deadline so PHASE_ON times out exactly TC.MAX_PHASE_ON_SECS after the last request. Acts as a
+        fail safe so that states are not kept on indefinitely. A shadow of the value last written to each pin
+        limits i2c writes to transitions, every reassert_interval seconds all pins are rewritten regardless.
+        With verify set, written pins are read back with a single non-blocking grovepi.digitalReadMany_nb and pins
+        that disagree are driven again, the time from each request to its confirmed actuation is recorded.
+        :param self:
+        :param pins: list of grovepi pin ids used for relay control
+        :param max_on_time: seconds a phase request stays on unless extended
+        :param reassert_interval: seconds between rewrites of pins whose state has not changed
+        :param verify: bool read back pins after writes
+        :param io: relay io backend providing digitalWriteMany and digitalReadMany_nb, the grovepi module or e.g.
+                   grovepi_sim.SimulatedRelayIO
+        :return: None
+        """
+        super().__init__()
+        self._parent = parent
+        self._io = io
+        self._max_on_time = max_on_time
+        self._reassert_interval = reassert_interval
+        self._next_reassert = 0.0
+        self._valid_pins = frozenset(pins)
+        self._phase_queues = dict()
+        self._pin_state = dict()   # pin -> value last written, None until first write
+        self._pin_generation = dict() # pin -> count of changes to _pin_state, tells readbacks overtaken by writes
+        self.wakeups = 0
+        self.writes = 0
+        self.skipped_writes = 0
+        self.state_changes = 0
+        self.write_failures = 0
+        self._verify = verify
+        self._verifying = False    # a readback is in flight
+        self._readback_id = 0      # identifies the readback in flight, results of abandoned ones are dropped
+        self._readback_pending = dict() # pin -> request arrival times awaiting the readback in flight
+        self._readback_expiry = 0.0 # monotonic time after which the readback in flight is abandoned
+        self._readbacks = deque()  # completed readbacks handed from the i2c scheduler thread to the relay thread
+        self._unconfirmed = dict() # pin -> list of request arrival times (monotonic) awaiting readback
+        self._mismatched = set()   # pins whose last readback disagreed with the value written
+        self.confirm_times = deque(maxlen=TC.RELAY_CONFIRM_SAMPLES)
+        self.confirmed = 0
+        self.mismatches = 0
+        self.readback_timeouts = 0
+        self._deadlines = []   # heap of (deadline, pin, user), superseded entries are dropped when popped
+        self._runnable = True
+        self._lock = threading.Lock()
+        self._update = threading.Event()
+
+        for pin in pins:
+            self._phase_queues[pin] = dict()
+            self._pin_state[pin] = None
+            self._pin_generation[pin] = 0
+
+    def set_phase_on(self, request:TC_phase_request):
+        """
+        Sets the state of the pin to on
+        :param pin:
+        :return: None
+        """
+        self.set_phases([(request, True)])
+
+    def set_phase_off(self, request:TC_phase_request):
+        """
+        Sets the state of pin to off
+        :param pin:
+        :return: None
+        """
+        self.set_phases([(request, False)])
+
+    def set_phases(self, requests):
+        """
+        Applies a list of phase on/off requests under a single acquisition of the relay lock
+        :param requests: list [(TC_phase_request, bool)] where bool is True to set phase on and False to set it off
+        :return: None
+        """
+        self._lock.acquire()
+        for request, on in requests:
+            if on:
+                self._add_request(request)
+            else:
+                self._remove_request(request)
+        self._lock.release()
+        self._update.set()
+
+    def _add_request(self, request:TC_phase_request):
+        """
+        Adds or extends request in its phase queue, caller must hold the relay lock
+        :param request: TC_phase_request
+        :return: None
+        """
+        pin_num = self._parent.phase_to_gpio[request.phase]
+        if pin_num in self._valid_pins:
+            phase_queue = self._phase_queues[pin_num]
+            self._await_confirmation(pin_num, request.received)
+            if request.user in phase_queue:
+                msg = "Extending phase %d (pin %d) time for user %s " % (request.phase, pin_num, request.user)
+                self._parent.output_log(msg)
+                request = phase_queue[request.user]
+                request.timestamp = datetime.now()
+            else:
+                request.timestamp = datetime.now()
                 msg = "Adding user %s to phase %d (pin %d)" % (request.user, request.phase, pin_num)
                 self._parent.output_log(msg)
                 phase_queue[request.user] = request
-
-            self._timer = threading.Timer(TC.MAX_PHASE_ON_SECS/TC.CHECK_PHASE_TIMEOUT_INTERVAL, self._timeout)
-            self._timer.start()
-            self._lock.release()
-            self._update.set()
+            request.deadline = monotonic() + self._max_on_time
+            heapq.heappush(self._deadlines, (request.deadline, pin_num, request.user))
+            self._compact_deadlines()
         else:
             msg = "Invalid pin %d associated with phase %d request from user %s" % (pin_num, request.phase, request.user)
             self._parent.output_log(msg)
 
-
-    def set_phase_off(self, request:TC_phase_request):
+    def _remove_request(self, request:TC_phase_request):
         """
-        Sets the state of pin to off
-        :param pin:
+        Removes request from its phase queue, caller must hold the relay lock. The heap entry is left in place
+        and discarded when it comes due.
+        :param request: TC_phase_request
         :return: None
         """
-        msg = ""
         pin_num = self._parent.phase_to_gpio[request.phase]
         if pin_num in self._valid_pins:
-            self._lock.acquire()
             phase_queue = self._phase_queues[pin_num]
             if request.user in phase_queue:
-                self._timer.cancel()
                 msg = "Removing user %s from phase %d (pin %d) queue" % (request.user, request.phase, pin_num)
                 self._parent.output_log(msg)
                 del phase_queue[request.user]
-                self._timer = threading.Timer(TC.MAX_PHASE_ON_SECS/TC.CHECK_PHASE_TIMEOUT_INTERVAL, self._timeout)
-                self._timer.start()
+                self._await_confirmation(pin_num, request.received)
             else:
                 msg = "User %s not in queue for phase %d (pin %d)" % (request.user, request.phase, pin_num)
                 self._parent.output_log(msg)
-            self._lock.release()
-            self._update.set()
         else:
             msg = "Invalid pin %d associated with phase %d release from user %s" % (pin_num, request.phase, request.user)
             self._parent.output_log(msg)
 
+    def _await_confirmation(self, pin:int, received:float):
+        """
+        Notes that a request is waiting for the readback confirming pin, caller must hold the relay lock
+        :param pin: int
+        :param received: float monotonic arrival time of the request
+        :return: None
+        """
+        if self._verify:
+            self._unconfirmed.setdefault(pin, []).append(received)
+
+    def _set_pin_state(self, pin:int, value):
+        """
+        Records the value last written to pin, caller must hold the relay lock
+        :param pin: int
+        :param value: int, or None where the pin state is unknown
+        :return: None
+        """
+        if self._pin_state[pin] != value:
+            self._pin_state[pin] = value
+            self._pin_generation[pin] += 1
+
+    def _start_readback(self, pins):
+        """
+        Issues a non-blocking readback of pins, caller must hold the relay lock
+        :param pins: list of int
+        :return: None
+        """
+        expected = [(self._pin_state[pin], self._pin_generation[pin]) for pin in pins]
+        pending = [self._unconfirmed.pop(pin, []) for pin in pins]
+        self._readback_pending = dict(zip(pins, pending))
+        self._verifying = True
+        self._readback_id += 1
+        self._readback_expiry = monotonic() + TC.RELAY_READBACK_TIMEOUT * len(pins)
+        readback_id = self._readback_id
+        self._io.digitalReadMany_nb(pins, lambda future: self._readback_done(readback_id, pins, expected, pending,
+                                                                             future))
+
+    def _expire_readback(self, now:float):
+        """
+        Abandons a readback in flight for longer than TC.RELAY_READBACK_TIMEOUT per pin so that a new one can start,
+        its requests wait for the next readback and its result is dropped should it still arrive. Caller must hold
+        the relay lock.
+        :param now: float monotonic time
+        :return: None
+        """
+        if self._verifying and now >= self._readback_expiry:
+            self._verifying = False
+            self._readback_id += 1
+            self.readback_timeouts += 1
+            for pin, received in self._readback_pending.items():
+                if received:
+                    self._unconfirmed.setdefault(pin, [])[:0] = received
+            timeout = TC.RELAY_READBACK_TIMEOUT * len(self._readback_pending)
+            self._readback_pending = dict()
+            msg = "Relay readback timed out after %.1f seconds, reading again" % (timeout,)
+            self._parent.output_error(msg)
+
+    def _readback_done(self, readback_id, pins, expected, pending, future):
+        """
+        Runs on the grovepi i2c scheduler thread, hands the readback to the relay thread. Must not take the relay
+        lock, the relay thread holds it while waiting on i2c writes.
+        :return: None
+        """
+        try:
+            values = future.result()
+        except Exception:
+            values = [-1] * len(pins)
+        self._readbacks.append((readback_id, pins, expected, pending, values, monotonic()))
+        if values == [written for written, generation in expected]:
+            self._update.set()
+        else:
+            # leave the bus to other work before driving the pins again
+            TC_Scheduler.get().schedule(TC.RELAY_REDRIVE_INTERVAL, self._update.set)
+
+    def _apply_readbacks(self):
+        """
+        Compares completed readbacks with the values written, records confirmation times and invalidates the shadow
+        state of pins that disagree so they are driven again. A pin written again while its readback was in flight
+        may have been read at an intermediate value, it is left to the next readback. Caller must hold the relay
+        lock.
+        :return: None
+        """
+        while self._readbacks:
+            readback_id, pins, expected, pending, values, completed = self._readbacks.popleft()
+            if readback_id != self._readback_id:
+                # abandoned by _expire_readback, its requests went back to _unconfirmed
+                continue
+            self._verifying = False
+            self._readback_pending = dict()
+            for pin, value, (written, generation), received in zip(pins, values, expected, pending):
+                if value == written and written is not None:
+                    for start in received:
+                        self.confirm_times.append(completed - start)
+                    self.confirmed += len(received)
+                    if pin in self._mismatched:
+                        self._mismatched.discard(pin)
+                        msg = "Relay pin %d confirmed at %d" % (pin, value)
+                        self._parent.output_log(msg)
+                    continue
+                if received:
+                    self._unconfirmed.setdefault(pin, [])[:0] = received
+                if self._pin_generation[pin] == generation and written is not None:
+                    # pin was not written since the readback was issued, so it really disagrees
+                    self.mismatches += 1
+                    self._set_pin_state(pin, None)
+                    if pin not in self._mismatched:
+                        self._mismatched.add(pin)
+                        msg = "Relay pin %d read back %d after writing %d, driving again" % (pin, value, written)
+                        self._parent.output_error(msg)
+
+    def confirm_stats(self):
+        """
+        Request to confirmed actuation times over the most recent TC.RELAY_CONFIRM_SAMPLES requests
+        :return: dict with confirmed, mismatches, readback timeouts, mean and max seconds
+        """
+        samples = list(self.confirm_times)
+        mean = 0.0
+        if samples:
+            mean = sum(samples) / len(samples)
+        return {'confirmed': self.confirmed, 'mismatches': self.mismatches, 'timeouts': self.readback_timeouts,
+                'mean': mean, 'max': max(samples) if samples else 0.0}
+
+    def _compact_deadlines(self):
+        """
+        Rebuilds the deadline heap from the live requests once superseded entries outnumber them, caller must hold
+        the relay lock
+        :return: None
+        """
+        live = 0
+        for phase_queue in self._phase_queues.values():
+            live += len(phase_queue)
+        if len(self._deadlines) > 2 * live + len(self._phase_queues):
+            self._deadlines = [(request.deadline, pin, user) for pin, phase_queue in self._phase_queues.items()
+                               for user, request in phase_queue.items()]
+            heapq.heapify(self._deadlines)
+
     def stop(self):
         """
         Quits thread
         :return: None
         """
         self._runnable = False
-        if self._timer:
-            self._timer.cancel()
         self._update.set()
 
 
     def run(self):
         """
-
+        Checks states whenever a request arrives or the next deadline or check interval passes
         :return: None
         """
-        self._timer.start()
         while self._runnable:
-            self._check_states()
-            self._update.wait()
-
-    def _timeout(self):
-        """
-        Calls _check_states and resets the timer
-        :return: None
-        """
-        self._check_states()
-        self._timer = threading.Timer(TC.MAX_PHASE_ON_SECS/TC.CHECK_PHASE_TIMEOUT_INTERVAL, self._timeout)
-        self._timer.start()
+            timeout = self._check_states()
+            self._update.wait(timeout)
 
     def _check_states(self):
         """
-        Passes through phase queues making gpio calls to set relay to the corresponding phase
-        :return: None
+        Expires requests whose deadline has passed and makes gpio calls to set relay to the corresponding phase
+        :return: float seconds until the next deadline or pin reassert
         """
         msg = ""
         self._lock.acquire()
         self._update.clear()
+        self.wakeups += 1
+        self._apply_readbacks()
+        now = monotonic()
+        self._expire_readback(now)
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, pin, user = heapq.heappop(self._deadlines)
+            phase_request = self._phase_queues[pin].get(user)
+            # skip entries superseded by an extension or a removal
+            if phase_request is not None and phase_request.deadline == deadline:
+                del self._phase_queues[pin][user]
+                msg = "User %s timeout in phase %d (pin %d)" % (user, phase_request.phase, pin)
+                self._parent.output_log(msg)
+        reassert = now >= self._next_reassert
+        if reassert:
+            self._next_reassert = now + self._reassert_interval
+        changes = []
         for pin, phase_queue in self._phase_queues.items():
-            for phase_request in list(phase_queue.values()):
-                msg = ""
-                delta_time = datetime.now() - phase_request.timestamp
-                if self._parent.debug_level > 1:
-                    remaining_time = self._max_delta_time.total_seconds() - delta_time.total_seconds()
+            if self._parent.debug_level > 1:
+                for phase_request in phase_queue.values():
+                    remaining_time = phase_request.deadline - now
                     msg = "User %s has %d seconds remaining in phase %d" % (phase_request.user, remaining_time, phase_request.phase)
                     self._parent.output_log(msg)
-                # turn off if exceed max time
-                if delta_time > self._max_delta_time:
-                    del phase_queue[phase_request.user]
-                    msg = "User %s timeout in phase %d (pin %d)" % (phase_request.user, phase_request.phase, pin)
-                    self._parent.output_log(msg)
-            # TODO: check against actual gpio pin state rather than just setting
-            # TODO: also need to add confirmation that write was successful
             value = 0
             if len(phase_queue) > 0:
                 value = 1
-            grovepi.digitalWrite(pin, value)
+            if reassert or self._pin_state[pin] != value:
+                changes.append((pin, value))
+            else:
+                self.skipped_writes += 1
+        redrive = False
+        if changes:
+            # all pins switch together in one i2c transaction with grovepi.dWriteMany_supported set
+            if self._io.digitalWriteMany(changes) == -1:
+                # pin state unknown, drive them again on the next pass
+                msg = "Relay write failed for pins %s, retrying" % (", ".join(str(pin) for pin, value in changes),)
+                self._parent.output_error(msg)
+                for pin, value in changes:
+                    self._set_pin_state(pin, None)
+                self.write_failures += 1
+                redrive = True
+            else:
+                for pin, value in changes:
+                    self._set_pin_state(pin, value)
+                self.writes += len(changes)
+                self.state_changes += 1
+        if self._verify and not self._verifying and not redrive:
+            verify_pins = set(self._unconfirmed)
+            verify_pins.update(pin for pin, value in changes)
+            verify_pins = sorted(pin for pin in verify_pins if self._pin_state[pin] is not None)
+            if verify_pins:
+                self._start_readback(verify_pins)
+        timeout = max(0.0, self._next_reassert - monotonic())
+        if self._deadlines:
+            timeout = min(timeout, max(0.0, self._deadlines[0][0] - monotonic()))
+        if redrive:
+            timeout = min(timeout, TC.RELAY_REDRIVE_INTERVAL)
+        if self._verifying:
+            timeout = min(timeout, max(0.0, self._readback_expiry - monotonic()))
         self._lock.release()
+        return timeout
+
+class TC_Dedup_Store:
+    """
+    Fixed size ring of (sender id, message id, arrival time) records in a memory mapped file so that Message_tracker
+    can restore its dedup window after a restart. Appends only copy a record into the mapping, the kernel writes the
+    dirty pages back in its own time and they survive the process being killed (e.g. by the systemd watchdog). Every
+    record carries a crc32 so one torn by a crash mid write is dropped on load rather than restored as a bogus key.
+    Message ids are the packet ids the broker assigns within the client's session, so the records are only of use to
+    a client resuming that session (clean_session False), a new session numbers its messages from 1 again and the
+    ring must be cleared. Not thread safe, Message_tracker serializes access under its own lock.
+    """
+
+    MAGIC = b'TCDD'
+    VERSION = 1
+    _header_struct = struct.Struct('!4sHHI')   # magic, version, record size, capacity
+    _record_struct = struct.Struct('!%dsId' % (TC.MAX_ID_BYTES,))
+    _crc_struct = struct.Struct('!I')
+    _slot_struct = struct.Struct('!%dsIdI' % (TC.MAX_ID_BYTES,))
+    RECORD_SIZE = _slot_struct.size
+
+    def __init__(self, path:str, capacity=TC.DEDUP_STORE_RECORDS):
+        """
+        Opens the ring file at path, creating or reinitializing it where it is missing or its layout does not match
+        :param path: str file name
+        :param capacity: int number of records in the ring, should exceed the messages received in one lifetime
+        """
+        self.path = path
+        self.capacity = capacity
+        self.appended = 0
+        self.restored = 0
+        self.dropped = 0
+        self._header_size = TC_Dedup_Store._header_struct.size
+        size = self._header_size + capacity * TC_Dedup_Store.RECORD_SIZE
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._next = 0   # slot to write next, found again by load as the one after the newest record
+        header = (TC_Dedup_Store.MAGIC, TC_Dedup_Store.VERSION, TC_Dedup_Store.RECORD_SIZE, capacity)
+        if TC_Dedup_Store._header_struct.unpack_from(self._map, 0) != header:
+            self._map[:] = bytes(size)
+            TC_Dedup_Store._header_struct.pack_into(self._map, 0, *header)
+
+    def append(self, sender:str, mid:int, timestamp:float):
+        """
+        Writes a record over the oldest slot in the ring
+        :param sender: str sender id
+        :param mid: int message id
+        :param timestamp: float seconds since the epoch the message arrived
+        :return: None
+        """
+        offset = self._header_size + self._next * TC_Dedup_Store.RECORD_SIZE
+        record = TC_Dedup_Store._record_struct.pack(sender.encode('utf-8'), mid, timestamp)
+        self._map[offset:offset + TC_Dedup_Store.RECORD_SIZE] = record + \
+            TC_Dedup_Store._crc_struct.pack(zlib.crc32(record))
+        self._next = (self._next + 1) % self.capacity
+        self.appended += 1
+
+    def load(self, since:float):
+        """
+        Reads back the intact records that arrived after since
+        :param since: float seconds since the epoch
+        :return: list of (str sender id, int message id, float timestamp)
+        """
+        records = []
+        record_length = TC_Dedup_Store._record_struct.size
+        newest = 0.0
+        senders = dict()   # raw id field -> str, senders usually have many records in the ring
+        view = memoryview(self._map)[self._header_size:]
+        slots = TC_Dedup_Store._slot_struct.iter_unpack(view)
+        for slot, (sender, mid, timestamp, crc) in enumerate(slots):
+            if timestamp <= since:
+                continue
+            offset = slot * TC_Dedup_Store.RECORD_SIZE
+            if crc != zlib.crc32(view[offset:offset + record_length]):
+                self.dropped += 1
+                continue
+            id = senders.get(sender)
+            if id is None:
+                id = senders[sender] = tc_ids.intern(sender.rstrip(b'\0').decode('utf-8'))
+            records.append((id, mid, timestamp))
+            if timestamp > newest:
+                newest = timestamp
+                self._next = (slot + 1) % self.capacity
+        del slots
+        view.release()
+        self.restored = len(records)
+        return records
+
+    def clear(self):
+        """
+        Drops every record in the ring
+        :return: None
+        """
+        self._map[self._header_size:] = bytes(self.capacity * TC_Dedup_Store.RECORD_SIZE)
+        self._next = 0
+
+    def flush(self):
+        """
+        Schedules the dirty pages of the ring for write back, msync(2), only needed to survive a power failure
+        :return: None
+        """
+        self._map.flush()
+
+    def close(self):
+        """
+        Flushes and unmaps the ring file
+        :return: None
+        """
+        if not self._map.closed:
+            self._map.flush()
+            self._map.close()
+
+    def stats(self):
+        """
+        :return: dict of records appended since open and restored and dropped by load
+        """
+        return {'appended': self.appended, 'restored': self.restored, 'dropped': self.dropped}
 
 class Message_tracker:
     """
-    Maintains a dictionary of message ids associated with timestamp and method to perform an atomic add/test of
-    a new message id
+    Maintains the (sender id, message id) keys seen within the last lifetime seconds and a method to perform an
+    atomic add/test of a new key. Keys are kept in a ring of per TIMER_INTERVAL buckets, each purge drops the oldest
+    bucket whole so the time the lock is held does not grow with the number of active users. With a TC_Dedup_Store
+    new keys are also appended to the store and the keys still within their lifetime are restored from it at startup.
     """
 
     TIMER_INTERVAL = 1.0
 
-    def __init__(self):
+    def __init__(self, lifetime=TC.DEFAULT_MSG_LIFE, store=None):
+        """
+        Starts an empty window of keys, restoring those still within lifetime from store where one is given
+        :param lifetime: seconds a key is remembered, rounded up to whole TIMER_INTERVALs
+        :param store: TC_Dedup_Store or None to keep keys in memory only
+        """
         super().__init__()
-        self.lifetime = TC.DEFAULT_MSG_LIFE
-        self._message_ids = dict()
+        self.lifetime = lifetime
+        buckets = int(-(-lifetime // Message_tracker.TIMER_INTERVAL)) + 1
+        self._buckets = deque(set() for bucket in range(buckets))   # oldest on the left, current on the right
+        self._store = store
+        if store is not None:
+            now = time()
+            ring = list(self._buckets)
+            for sender, mid, timestamp in store.load(now - lifetime):
+                # buckets are counted back from the current one by age, a key from the future goes in the current
+                age = int((now - timestamp) // Message_tracker.TIMER_INTERVAL)
+                ring[-1 - age if 0 <= age < buckets else -1].add((sender, mid))
         self._lock = threading.Lock()
         self._event = threading.Event()
-        self._timer = threading.Timer(Message_tracker.TIMER_INTERVAL, self._purge)
-        self._timer.start()
+        self._runnable = True
+        self._scheduler = TC_Scheduler.get()
+        self._timer = self._scheduler.schedule(Message_tracker.TIMER_INTERVAL, self._purge)
 
     def _purge(self):
         """
-        Removes expired message ids
+        Drops the oldest bucket of keys and starts a new current bucket
         :return: None
         """
         self._lock.acquire()
-        if len(self._message_ids) > 0:
-            expired = datetime.utcnow().timestamp() - self.lifetime
-            for mid, timestamp in list(self._message_ids.items()):
-                if timestamp < expired:
-                    del self._message_ids[mid]
+        expired = self._buckets.popleft()
+        self._buckets.append(set())
+        if self._runnable:
+            self._timer = self._scheduler.schedule(Message_tracker.TIMER_INTERVAL, self._purge)
         self._lock.release()
-        self._timer = threading.Timer(Message_tracker.TIMER_INTERVAL, self._purge)
-        self._timer.start()
+        # the expired keys are freed here, outside the lock
+        expired.clear()
 
     def is_duplicate(self, tc_cmd:TC_Identifier):
         """
-        Atomically checks if message id is in dictionary returning True if not present where it will add it, if
-        message is in dictionary returns False. Where the attribute _src_id is None no action is taken and the
-        False is returned.
-        :param msg: 
+        Atomically checks if the (sender id, message id) key of tc_cmd has been seen, returning True if so. If not
+        the key is added and False is returned. Where the attribute _src_mid is None, or 0 for a message delivered
+        at QoS 0 which has no message id and is never redelivered, no action is taken and False is returned.
+        :param tc_cmd: TC_Identifier
         :return: True or False
         """
+        if not tc_cmd._src_mid:
+            return False
+        key = (tc_cmd.id, tc_cmd._src_mid)
         duplicate = False
-        if tc_cmd._src_mid:
-            self._lock.acquire()
-            if tc_cmd._src_mid in self._message_ids:
+        self._lock.acquire()
+        for bucket in self._buckets:
+            if key in bucket:
                 duplicate = True
-            else:
-                self._message_ids[tc_cmd._src_mid] = tc_cmd.timestamp
-            self._lock.release()
+                break
+        else:
+            self._buckets[-1].add(key)
+            if self._store is not None:
+                self._store.append(tc_cmd.id, tc_cmd._src_mid, time())
+        self._lock.release()
         return duplicate
 
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def clear(self):
+        """
+        Forgets every key, and those in the store, when a new broker session starts numbering message ids from 1
+        :return: None
+        """
+        self._lock.acquire()
+        for bucket in self._buckets:
+            bucket.clear()
+        if self._store is not None:
+            self._store.clear()
+        self._lock.release()
+
+    def stop(self):
+        """
+        Cancel timer, if any, and close the store
+        :return: None
+        """
+        self._lock.acquire()
+        self._runnable = False
+        if self._timer:
+            self._timer.cancel()
+        if self._store is not None:
+            self._store.close()
+        self._lock.release()
+
+class Message_filter:
+    """
+    Probabilistic, fixed memory stand in for Message_tracker where one process sees messages from very many senders
+    (e.g. a logger on tc/#). Keys are added to the current of SLICES Bloom filters, each spanning one lifetime, and
+    every lifetime the oldest is swapped for an empty one, so a key is remembered for between one and two lifetimes.
+    Each slice is sized for capacity keys so a flood arriving all at once does not saturate it. Memory is set by
+    capacity and error_rate at construction and never grows, a new message is reported as a duplicate with
+    probability about error_rate while no more than capacity messages arrive per lifetime. A duplicate is never
+    missed within the lifetime.
+    """
+
+    SLICES = 2
+
+    def __init__(self, capacity=TC.DEDUP_FILTER_CAPACITY, error_rate=TC.DEDUP_FILTER_ERROR_RATE,
+                 lifetime=TC.DEFAULT_MSG_LIFE):
+        """
+        Allocates the filter slices for capacity and error_rate and starts the timer rotating them every lifetime
+        :param capacity: int messages per lifetime the filters are sized for
+        :param error_rate: float false positive rate at capacity
+        :param lifetime: seconds a key is remembered at least
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lifetime = lifetime
+        # a key is tested against every slice so the error rate is split between them
+        keys = max(1, capacity)
+        slice_error = error_rate / Message_filter.SLICES
+        self.bits = 8 * int(math.ceil(-keys * math.log(slice_error) / (8 * math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / keys * math.log(2))))
+        self._slices = deque(bytearray(self.bits // 8) for slice in range(Message_filter.SLICES))
+        self._counts = deque(0 for slice in range(Message_filter.SLICES))
+        self._lock = threading.Lock()
+        self._runnable = True
+        self._scheduler = TC_Scheduler.get()
+        self._timer = self._scheduler.schedule(self.lifetime, self._purge)
+
+    def _purge(self):
+        """
+        Replaces the oldest filter slice with an empty one, the lock is not held while the new slice is allocated
+        :return: None
+        """
+        empty = bytearray(self.bits // 8)
+        self._lock.acquire()
+        self._slices.popleft()
+        self._slices.append(empty)
+        self._counts.popleft()
+        self._counts.append(0)
+        if self._runnable:
+            self._timer = self._scheduler.schedule(self.lifetime, self._purge)
+        self._lock.release()
+
+    def is_duplicate(self, tc_cmd:TC_Identifier):
+        """
+        Atomically checks if the (sender id, message id) key of tc_cmd has probably been seen, returning True if so.
+        If not the key is added and False is returned. Where the attribute _src_mid is None, or 0 for a message
+        delivered at QoS 0 which has no message id and is never redelivered, no action is taken and False is returned.
+        :param tc_cmd: TC_Identifier
+        :return: True or False
+        """
+        if not tc_cmd._src_mid:
+            return False
+        # double hashing, the second hash is derived from the first so this also holds where hash() is 32 bit
+        bits = self.bits
+        first = hash((tc_cmd.id, tc_cmd._src_mid))
+        second = hash((first,)) | 1
+        positions = [(first + i * second) % bits for i in range(self.hashes)]
+        self._lock.acquire()
+        for slice in self._slices:
+            for position in positions:
+                if not slice[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                self._lock.release()
+                return True
+        current = self._slices[-1]
+        for position in positions:
+            current[position >> 3] |= 1 << (position & 7)
+        self._counts[-1] += 1
+        self._lock.release()
+        return False
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def stats(self):
+        """
+        :return: dict of keys held, bytes of filter memory, bits and hashes per slice and whether the current slice
+                 holds more than capacity keys, beyond which the false positive rate climbs above error_rate
+        """
+        return {'keys': len(self), 'memory': len(self._slices) * self.bits // 8, 'bits': self.bits,
+                'hashes': self.hashes, 'saturated': self._counts[-1] > self.capacity}
+
+    def clear(self):
+        """
+        Forgets every key when a new broker session starts numbering message ids from 1
+        :return: None
+        """
+        empty = [bytearray(self.bits // 8) for slice in self._slices]
+        self._lock.acquire()
+        self._slices = deque(empty)
+        self._counts = deque(0 for slice in empty)
+        self._lock.release()
+
     def stop(self):
         """
         Cancel timer, if any
         :return: None
         """
+        self._lock.acquire()
+        self._runnable = False
         if self._timer:
             self._timer.cancel()
+        self._lock.release()
+
+class TC_Worker(threading.Thread):
+    """
+    Worker stage of a TC_Pipeline, runs work items from its own bounded queue in arrival order
+    """
+
+    def __init__(self, pipeline, depth:int):
+        """
+
+        :param pipeline: TC_Pipeline
+        :param depth: int maximum number of queued work items
+        """
+        super().__init__()
+        self._pipeline = pipeline
+        self.queue = queue.Queue(depth)
+
+    def run(self):
+        """
+        Runs work items until a None item is received
+        :return: None
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            enqueued, handler, args = item
+            self._pipeline._record_wait(monotonic() - enqueued)
+            try:
+                handler(*args)
+            except Exception as err:
+                msg = "pipeline handler %s failed: %s" % (handler.__name__, str(err))
+                self._pipeline._parent.output_error(msg)
+
+
+class TC_Pipeline:
+    """
+    Bounded ingress stage between the mqtt network thread and request processing. Callbacks submit work keyed by
+    user id, work is sharded onto worker threads by key so items sharing a key are processed in arrival order.
+    """
+
+    def __init__(self, parent, workers=TC.PIPELINE_WORKERS, depth=TC.PIPELINE_DEPTH):
+        """
+
+        :param parent: TC derived object used for logging
+        :param workers: int number of worker threads
+        :param depth: int maximum queued items per worker
+        """
+        self._parent = parent
+        self._workers = [TC_Worker(self, depth) for i in range(workers)]
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """
+        Starts worker threads
+        :return: None
+        """
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """
+        Lets workers finish queued work and then waits for them to exit
+        :return: None
+        """
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.queue.put(None)
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
+
+    def is_alive(self):
+        """
+        :return: True when all workers are running
+        """
+        return all([worker.is_alive() for worker in self._workers])
+
+    def submit(self, key, handler, *args):
+        """
+        Queues handler(*args) on the worker owning key without blocking
+        :param key: hashable, e.g. user id
+        :param handler: callable
+        :return: True if queued, False if the worker queue is full
+        """
+        worker = self._workers[hash(key) % len(self._workers)]
+        try:
+            worker.queue.put_nowait((monotonic(), handler, args))
+        except queue.Full:
+            self._lock.acquire()
+            self.rejected += 1
+            self._lock.release()
+            return False
+        return True
+
+    def depth(self):
+        """
+        :return: int number of work items waiting in all worker queues
+        """
+        return sum([worker.queue.qsize() for worker in self._workers])
+
+    def stats(self):
+        """
+        :return: dict of queue depth, processed and rejected counts and queue wait times in seconds
+        """
+        self._lock.acquire()
+        mean_wait = self.total_wait / self.processed if self.processed else 0.0
+        stats = {'depth': self.depth(), 'processed': self.processed, 'rejected': self.rejected,
+                 'mean_wait': mean_wait, 'max_wait': self.max_wait}
+        self._lock.release()
+        return stats
+
+    def _record_wait(self, wait:float):
+        """
+        Accounts time a work item spent queued
+        :param wait: float seconds
+        :return: None
+        """
+        self._lock.acquire()
+        self.processed += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+        self._lock.release()
+
 
 class Server (TC):
     """
@@ -1156,14 +3163,33 @@ class Server (TC):
     TODO: add locking so only one request is processed at a time, how to deal with heavy load
     """
 
-    def __init__(self, controller_id:str, map=TC._default_phase_map):
+    def __init__(self, controller_id:str, map=TC._default_phase_map, bus=None, dedup_store=None, dedup_capacity=None,
+                 io=None, host=None):
         """
         Instantiates traffic controller server
         :param controller_id: str
         :param map: list [(int,int)] or dict {int:int} mapping of phase number to gpio pin (using grovepi pin numbers)
-        """
-        if not I_AM_PI:
-            msg = "class Server is only supported on Raspberry Pi with RPi._grovepi and grovepi installed"
+        :param bus: i2c bus backend for grovepi (e.g. grovepi_sim.SimulatedBus), None to use the Raspberry Pi SMBus
+        :param dedup_store: str path of the TC_Dedup_Store ring file keeping seen message ids across restarts, None
+                            to keep them in memory only. The client then keeps its broker session (clean_session
+                            False) so the broker redelivers messages in flight, and queues those sent while the
+                            controller is offline.
+        :param dedup_capacity: int messages per lifetime for a fixed memory Message_filter, None to track message ids
+                               exactly with a Message_tracker
+        :param io: relay io backend for TC_Relay, None for the grovepi module
+        :param host: Server_Host whose mqtt client and request pipelines this controller shares, None to run
+                     standalone with a client of its own
+        """
+        if bus is not None:
+            grovepi.set_bus(bus)
+        elif io is None and grovepi.bus is None and not I_AM_PI:
+            msg = "class Server is only supported on Raspberry Pi with RPi.GPIO and smbus installed or with a bus backend"
+            raise TC_Exception(msg)
+        if dedup_store is not None and dedup_capacity is not None:
+            msg = "dedup_store is only supported by the exact Message_tracker, not with dedup_capacity"
+            raise TC_Exception(msg)
+        if dedup_store is not None and host is not None:
+            msg = "dedup_store needs a broker session of the controller's own, not supported for hosted controllers"
             raise TC_Exception(msg)
 
         super().__init__()
@@ -1173,30 +3199,38 @@ class Server (TC):
         self.phase_to_gpio = dict(map)
         self.phases = frozenset(self.phase_to_gpio.keys())
 
-        # Configurable attributes
-        self.subscriptions = [(self.tc_topic, TC._qos), (TC._will_topic, TC._qos), (self.admin_topic, TC._qos)]
-
-        self.mqttc = mqtt.Client(controller_id)
-
         # Separate thread to manage TC relays
-        self._relays = TC_Relay(self, list(self.phase_to_gpio.values()))
+        if io is None:
+            io = grovepi
+        self._relays = TC_Relay(self, list(self.phase_to_gpio.values()), io=io)
+
+        self._host = host
+        if host is not None:
+            # the host subscribes and routes messages for this controller
+            self.mqttc = host.mqttc
+        else:
+            # Configurable attributes
+            self.subscriptions = [(self.tc_topic, TC._qos), (TC._will_topic, TC._qos), (self.admin_topic, TC._qos)]
 
-        # using password until we can get TLS setup with user certificates
-        self.mqttc.username_pw_set(self.id, password="BikeIoT")
+            # message ids restored from a dedup store are only valid within the broker session they came from
+            self.mqttc = mqtt.Client(controller_id, clean_session=dedup_store is None)
 
-        # pass reference to self for use in callbacks
-        self.mqttc.user_data_set(self)
+            # using password until we can get TLS setup with user certificates
+            self.mqttc.username_pw_set(self.id, password="BikeIoT")
 
-        # defined required topic callbacks
-        self.mqttc.will_set(TC._will_topic, TC_Identifier(TC.WILL, self.id).encode())
-        self.mqttc.on_connect = TC.on_connect
-        self.mqttc.on_disconnect = TC.on_disconnect
-        self.mqttc.on_subscribe = TC.on_subscribe
-        self.mqttc.on_message = TC.on_message
-        self.mqttc.on_log = TC.on_log
-        self.mqttc.message_callback_add(TC._will_topic, Server.on_will)
-        self.mqttc.message_callback_add(self.tc_topic, Server.on_topic)
-        self.mqttc.message_callback_add(self.admin_topic, Server.on_admin)
+            # pass reference to self for use in callbacks
+            self.mqttc.user_data_set(self)
+
+            # defined required topic callbacks
+            self.mqttc.will_set(TC._will_topic, TC_Identifier(TC.WILL, self.id).encode())
+            self.mqttc.on_connect = Server.on_connect
+            self.mqttc.on_disconnect = TC.on_disconnect
+            self.mqttc.on_subscribe = TC.on_subscribe
+            self.mqttc.on_message = TC.on_message
+            self.mqttc.on_log = TC.on_log
+            self.mqttc.message_callback_add(TC._will_topic, Server.on_will)
+            self.mqttc.message_callback_add(self.tc_topic, Server.on_topic)
+            self.mqttc.message_callback_add(self.admin_topic, Server.on_admin)
 
         # watchdog timer, set watchdog_pid iff running with systemd type=notify
         self._watchdog_timer = None
@@ -1204,15 +3238,55 @@ class Server (TC):
         self.watchdog_sec = None
 
         # load needed dynamic libraries
-        self._libsystemd = CDLL("libsystemd.so")
+        self._libsystemd = TC.load_libsystemd()
 
         # external program/script calls for system admin functions
         self._enable_adhoc_wifi = ["/sbin/ifup", "wlan0"]
         self._disable_adhoc_wifi = ["/sbin/ifdown", "wlan0"]
         self._system_reboot = ["/sbin/shutdown", "--reboot", "+1"]
 
+        # admin commands run on their own workers so phase requests keep flowing while one is running
+        if host is not None:
+            self._admin_commands = host._admin_commands
+        else:
+            self._admin_commands = TC_Pipeline(self, TC.ADMIN_CONCURRENCY, TC.ADMIN_QUEUE_DEPTH)
+        self.command_timeout = TC.COMMAND_TIMEOUT
+        self.admin_result_ack = False  # when set, c_struct admin commands are answered with a TC_ACK_Result
+
+        # a phase request arriving in a quiet period is applied at once, those following within coalesce_window
+        # seconds are applied together with one relay update
+        self.coalesce_window = TC.COALESCE_WINDOW
+        self._coalesced = []   # (TC_Request, TC_phase_request, bool on) waiting for the window to close
+        self._coalesce_timer = None   # open window, None in a quiet period
+        self._coalesce_lock = threading.Lock()
+        self.coalesced_updates = 0
+        self.coalesced_requests = 0
+
+        # when set, c_struct ACKs to a user within ack_window of the previous one are sent together in a TC_ACK_Multi
+        self.ack_aggregation = False
+        self.ack_window = TC.ACK_NAGLE_WINDOW
+        self._held_acks = dict()   # user id -> list [(mid, rc)] held while the user's window is open
+        self._ack_lock = threading.Lock()
+        self.ack_publishes = 0
+        self.acks_sent = 0
+
         # track message ids so we can check for duplicates
-        self._seen_mids = Message_tracker()
+        if dedup_capacity is not None:
+            self._seen_mids = Message_filter(dedup_capacity)
+        else:
+            store = None
+            if dedup_store is not None:
+                store = TC_Dedup_Store(dedup_store)
+            self._seen_mids = Message_tracker(store=store)
+
+        # preencoded acknowledgements for recently seen users
+        self._ack_templates = TC_ACK_Cache()
+
+        # requests are decoded on the mqtt network thread and processed by pipeline workers
+        if host is not None:
+            self._pipeline = host._pipeline
+        else:
+            self._pipeline = TC_Pipeline(self)
 
 
     def run(self):
@@ -1223,7 +3297,7 @@ class Server (TC):
         """
 
         #tell systemd we are ready
-        result = self._libsystemd.sd_pid_notify(self.watchdog_pid,0,"READY=1".encode('ascii'))
+        result = self.sd_notify("READY=1")
         if result <= 0:
             msg = "Error %d sending sd_pid_notify READY" % (result,)
             self.output_log(msg)
@@ -1233,39 +3307,15 @@ class Server (TC):
             if self.debug_level > 2:
                 msg = "Initializing watchdog timer on pid %d and interval %f seconds" % (self.watchdog_pid,
                         self.watchdog_sec/TC.WATCHDOG_INTERVAL)
-                self.output_log(msg)
-            self.watchdog()
-
-        connected = False
-        connection_retry_delay = TC.INITIAL_CONNECTION_RETRY_DELAY
-        while not connected:
-            try:
-                connected = True
-                msg = "starting TC Server for controller %s" % (self.id,)
-                self.output_log(msg)
-                self.mqttc.connect(TC._broker_url, TC._broker_port, TC._broker_keepalive)
-            except (socket.gaierror, socket.herror, socket.timeout) as e:
-                # probably network initialization delayed at startup, retry with progressive delay
-                error_int, error_string = e.args
-                connected = False
-                msg = "connect attempt failed (%d) %s:retry in %f seconds" % (error_int, error_string, connection_retry_delay)
-                self.output_error(msg)
-                sleep(connection_retry_delay)
-                connection_retry_delay *= TC.CONNECTION_RETRY_FACTOR
-                if connection_retry_delay > TC.MAX_CONNECTION_RETRY_DELAY:
-                    connection_retry_delay = TC.MAX_CONNECTION_RETRY_DELAY
-            except (ConnectionError, ConnectionRefusedError, ConnectionAbortedError, ConnectionResetError) as e:
-                error_int, error_string = e.args
-                msg = "aborted due to connection error (%d) (%s)" % (error_int, error_string)
-                self.output_error(msg)
-                exit(error_int)
-            except:
-                msg = "aborted with unkown error"
-                self.output_error(msg)
-                exit(1)
+                self.output_log(msg)
+            self.watchdog()
+
+        self.connect_broker()
 
         # enter network loop forever, relying on interrupt handler to stop things
         self._relays.start()
+        self._pipeline.start()
+        self._admin_commands.start()
         self.mqttc.loop_forever()
 
 
@@ -1277,7 +3327,7 @@ class Server (TC):
         """
 
         # tell systemd that we are stopping
-        result = self._libsystemd.sd_pid_notify(self.watchdog_pid,0,"STOPPING=1".encode('ascii'))
+        result = self.sd_notify("STOPPING=1")
         if result <= 0:
             msg = "error %d sd_pid_notify STOPPING"
             self.output_log(msg)
@@ -1287,19 +3337,39 @@ class Server (TC):
         self.mqttc.disconnect()
         if self._watchdog_timer:
             self._watchdog_timer.cancel()
-        if self._relays.isAlive():
+        self._pipeline.stop()
+        self._admin_commands.stop()
+        self.stop_controller()
+
+    def stop_controller(self):
+        """
+        Applies held phase requests and stops the relay thread and message tracking of this controller, the mqtt
+        client and pipelines must already be stopped
+        :return: None
+        """
+        self._coalesce_lock.acquire()
+        if self._coalesce_timer:
+            self._coalesce_timer.cancel()
+            self._coalesce_timer = None
+        self._coalesce_lock.release()
+        self._apply_coalesced()
+        if self._relays.is_alive():
             self._relays.stop()
             self._relays.join()
-        if self._seen_mids:
+        if self._seen_mids is not None:
             self._seen_mids.stop()
 
     def request_phase(self, request:TC_Request):
         """
         Process phase request to signal traffic controller
-        :param request:TC_Request
+        :param request:TC_Request or TC_Request_Batch
         :return: None
         """
 
+        if request.type == TC.PHASE_REQUEST_BATCH:
+            self._request_phase_batch(request)
+            return
+
         rc = TC.ACK_OK
 
         if request.phase in self.phases:
@@ -1307,10 +3377,11 @@ class Server (TC):
                 msg = "processing request type %d for phase %d from %s" % (request.type, request.phase, request.id)
                 self.output_log(msg)
                 relay_request = TC_phase_request(request.phase, request.id)
-                if request.type == TC.PHASE_REQUEST_ON:
-                    self._relays.set_phase_on(relay_request)
-                else:
-                    self._relays.set_phase_off(relay_request)
+                on = request.type == TC.PHASE_REQUEST_ON
+                if self.coalesce_window > 0 and self._coalesce(request, relay_request, on):
+                    # ack is sent once the coalesced relay update has been made
+                    return
+                self._relays.set_phases([(relay_request, on)])
             else:
                 msg = "received an invalid phase reqeust type %d" % (request.type,)
                 self.output_log(msg)
@@ -1322,6 +3393,102 @@ class Server (TC):
         # send ack
         self.send_ack(request, rc)
 
+    def _coalesce(self, request:TC_Request, relay_request:TC_phase_request, on:bool):
+        """
+        Holds a validated phase request while a coalescing window is open. Otherwise opens one and leaves the request
+        to the caller, so that a request arriving in a quiet period is applied without delay.
+        :param request: TC_Request to acknowledge
+        :param relay_request: TC_phase_request
+        :param on: bool True to set phase on and False to set it off
+        :return: bool True if the request is held
+        """
+        self._coalesce_lock.acquire()
+        held = self._coalesce_timer is not None
+        if held:
+            self._coalesced.append((request, relay_request, on))
+        else:
+            self._coalesce_timer = TC_Scheduler.get().schedule(self.coalesce_window, self._close_coalesce_window)
+        self._coalesce_lock.release()
+        return held
+
+    def _close_coalesce_window(self):
+        """
+        Runs on the scheduler thread when the coalescing window closes. Requests held during the window are handed
+        to a pipeline worker so the scheduler does not wait on the relay lock, they are applied right here only where
+        the worker queue is full, and the window is opened again. Otherwise the next request is applied at once.
+        :return: None
+        """
+        self._coalesce_lock.acquire()
+        held = len(self._coalesced) > 0
+        if held:
+            self._coalesce_timer = TC_Scheduler.get().schedule(self.coalesce_window, self._close_coalesce_window)
+        else:
+            self._coalesce_timer = None
+        self._coalesce_lock.release()
+        if held and not self._pipeline.submit(self.id, self._apply_coalesced):
+            self._apply_coalesced()
+
+    def _apply_coalesced(self):
+        """
+        Applies all held phase requests with a single relay update and then acknowledges each of them
+        :return: None
+        """
+        self._coalesce_lock.acquire()
+        held = self._coalesced
+        self._coalesced = []
+        self._coalesce_lock.release()
+        if not held:
+            return
+        self._relays.set_phases([(relay_request, on) for request, relay_request, on in held])
+        self.coalesced_updates += 1
+        self.coalesced_requests += len(held)
+        for request, relay_request, on in held:
+            self.send_ack(request, TC.ACK_OK)
+
+    def _request_phase_batch(self, batch:TC_Request_Batch):
+        """
+        Validates each entry of a batch, applies the valid ones with a single relay update and then sends one batch
+        ACK holding a result code for every entry.
+        :param batch: TC_Request_Batch
+        :return: None
+        """
+        results = []
+        relay_requests = []
+        for user_id, phase, type in batch.entries:
+            if phase not in self.phases:
+                msg = "received an invalid phase number %d in batch from %s" % (phase, batch.id)
+                self.output_error(msg)
+                results.append(TC.ACK_INVALID_PHASE)
+            elif type not in [TC.PHASE_REQUEST_ON, TC.PHASE_REQUEST_OFF]:
+                msg = "received an invalid phase reqeust type %d in batch from %s" % (type, batch.id)
+                self.output_error(msg)
+                results.append(TC.ACK_INVALID_CMD)
+            else:
+                msg = "processing request type %d for phase %d from %s" % (type, phase, user_id)
+                self.output_log(msg)
+                relay_requests.append((TC_phase_request(phase, user_id), type == TC.PHASE_REQUEST_ON))
+                results.append(TC.ACK_OK)
+
+        if relay_requests:
+            self._relays.set_phases(relay_requests)
+
+        self.send_batch_ack(batch, results)
+
+    def send_batch_ack(self, batch:TC_Request_Batch, results):
+        """
+        Sends a single TC_ACK_Batch for all entries of batch
+        :param batch: TC_Request_Batch
+        :param results: list [int] result code for each entry
+        :return: None
+        """
+        ack = TC_ACK_Batch(batch.id, batch._src_mid, results)
+        topic = TC._tc_topic_format % (batch.id,)
+        self.mqttc.publish(topic, ack.encode(), TC.DEFAULT_QOS)
+
+        if self.debug_level > 2:
+            msg = "Sent batch ACK to %s for message id %d with %d results" % (topic, ack.mid, len(results))
+            self.output_log(msg)
+
     def send_ack(self, tc_cmd:TC_Identifier, rc:int):
         """
 
@@ -1329,24 +3496,87 @@ class Server (TC):
         :param rc:
         :return: None
         """
-        ack = TC_ACK(tc_cmd.id, tc_cmd._src_mid, rc)
-        topic = TC._tc_topic_format % (tc_cmd.id,)
-        if tc_cmd._encoding == TC.ENCODING_JSON:
-            payload = StringIO()
-            ack.json_dump(payload)
-            self.mqttc.publish(topic, payload.getvalue(), TC.DEFAULT_QOS)
+        if tc_cmd.type == TC.PHASE_REQUEST_BATCH:
+            self.send_batch_ack(tc_cmd, [rc] * len(tc_cmd.entries))
+            return
+
+        if self.ack_aggregation and tc_cmd._encoding not in [TC.ENCODING_JSON, TC.ENCODING_V2]:
+            self._ack_lock.acquire()
+            held = self._held_acks.get(tc_cmd.id)
+            if held is not None:
+                held.append((tc_cmd._src_mid, rc))
+                self._ack_lock.release()
+                return
+            # nothing sent to this user lately, send now and hold any ACKs that follow within the window
+            self._held_acks[tc_cmd.id] = []
+            TC_Scheduler.get().schedule(self.ack_window, self._close_ack_window, tc_cmd.id)
+            self._ack_lock.release()
+
+        template = self._ack_templates.get(tc_cmd.id, tc_cmd._encoding)
+        timestamp = int(datetime.utcnow().timestamp())
+        self.mqttc.publish(template.topic, template.render(tc_cmd._src_mid, rc, timestamp), TC.DEFAULT_QOS)
+        self.ack_publishes += 1
+        self.acks_sent += 1
+
+        if self.debug_level > 2:
+            msg = "Sent ACK to %s for message id %d with result %d" % (template.topic, tc_cmd._src_mid, rc)
+            self.output_log(msg)
+
+    def _close_ack_window(self, user_id:str):
+        """
+        Runs on the scheduler thread when a user's ACK window closes. ACKs held during the window are published
+        together and the window is opened again, otherwise the user's next ACK is sent as soon as it is ready.
+        :param user_id: str
+        :return: None
+        """
+        self._ack_lock.acquire()
+        held = self._held_acks.pop(user_id, [])
+        if held:
+            self._held_acks[user_id] = []
+            TC_Scheduler.get().schedule(self.ack_window, self._close_ack_window, user_id)
+        self._ack_lock.release()
+        if not held:
+            return
+
+        topic = TC._tc_topic_format % (user_id,)
+        timestamp = int(datetime.utcnow().timestamp())
+        if len(held) == 1:
+            template = self._ack_templates.get(user_id, TC.ENCODING_C_STRUC)
+            mid, rc = held[0]
+            self.mqttc.publish(topic, template.render(mid, rc, timestamp), TC.DEFAULT_QOS)
+            self.ack_publishes += 1
         else:
-            self.mqttc.publish(topic, ack.encode(), TC.DEFAULT_QOS)
+            for first in range(0, len(held), TC.MAX_MULTI_ENTRIES):
+                ack = TC_ACK_Multi(user_id, held[first:first + TC.MAX_MULTI_ENTRIES], timestamp)
+                self.mqttc.publish(topic, ack.encode(), TC.DEFAULT_QOS)
+                self.ack_publishes += 1
+        self.acks_sent += len(held)
 
         if self.debug_level > 2:
-            msg = "Sent ACK to %s for message id %d with result %d" % (topic, ack.mid, ack.rc)
+            msg = "Sent %d held ACKs to %s for message ids %s" % (len(held), topic, [mid for mid, rc in held])
             self.output_log(msg)
 
 
+    @staticmethod
+    def on_connect(client, userdata, flags, rc):
+        """
+        Called when the broker responds to our connection request. Without a session to resume the broker numbers
+        message ids from 1 again, so the message ids seen so far are forgotten rather than taken for duplicates.
+        :param client: paho.mqtt.client
+        :param userdata: TC Server
+        :param flags: dict of broker response flags
+        :param rc: int connection result
+        :return: None
+        """
+        TC.on_connect(client, userdata, flags, rc)
+        if rc == mqtt.CONNACK_ACCEPTED and not flags.get('session present'):
+            userdata._seen_mids.clear()
+
     @staticmethod
     def on_topic(client:mqtt.Client, userdata, mqtt_msg:mqtt.MQTTMessage):
         """
-        Handles all requests coming to server (aka traffic controller)
+        Handles all requests coming to server (aka traffic controller). Only decodes the request on the network
+        thread and passes it on to the pipeline for processing.
         :param: client: mqtt.Client
         :param userdata: TC Server
         :param mqtt_msg: MQTTMessage
@@ -1355,83 +3585,159 @@ class Server (TC):
 
         userdata._healthy = True
 
-        # only handling PHASE_REQUEST for now, if no match then ignore
         try:
-            tc_cmd = TC.decode(mqtt_msg)
-            if userdata._seen_mids.is_duplicate(tc_cmd):
-                userdata.send_ack(tc_cmd, TC.ACK_DUPLICATE_MID)
-                msg = "Received duplicate message id %d from %s" % (tc_cmd._src_mid, tc_cmd.id)
-                userdata.output_error(msg)
-            elif tc_cmd.type in [TC.PHASE_REQUEST_ON, TC.PHASE_REQUEST_OFF]:
-                userdata.request_phase(tc_cmd)
-            elif tc_cmd.type == TC.ID:
-                userdata.send_ack(tc_cmd, TC.ACK_OK)
-            else:
-                raise TC_Exception("Received unexpected tc command type %d" % (tc_cmd.type))
+            tc_cmd = TC.decode(mqtt_msg, lazy=True)
+            userdata._submit(tc_cmd, userdata._process_request)
         except TC_Exception as err:
             userdata.output_error(err.msg)
 
     @staticmethod
     def on_admin(client:mqtt.Client, userdata, msg:mqtt.MQTTMessage):
         """
-        Callback function to process admin commands
+        Callback function to decode admin commands and pass them on to the pipeline for processing
         :param client: 
         :param userdata: 
         :param msg: 
         :return: 
         """
 
-        tc_cmd = None
-        rc = TC.ACK_OK
-
         try:
             tc_cmd = TC.decode(msg)
+            userdata._submit(tc_cmd, userdata._process_admin)
+        except TC_Exception as err:
+            userdata.output_error(err.msg)
 
+    def _submit(self, tc_cmd:TC_Identifier, handler):
+        """
+        Queues tc_cmd for handler on the pipeline worker for its user, refusing it with ACK_BUSY when that worker's
+        queue is full.
+        :param tc_cmd: TC_Identifier
+        :param handler: Server method taking tc_cmd
+        :return: None
+        """
+        # sharding must not decode the id of a lazily decoded request on the network thread
+        if not self._pipeline.submit(tc_cmd.shard_key(), handler, tc_cmd):
+            msg = "Request queue full, refusing message id %d from %s" % (tc_cmd._src_mid, tc_cmd.id)
+            self.output_error(msg)
+            self.send_ack(tc_cmd, TC.ACK_BUSY)
+
+    def _process_request(self, tc_cmd:TC_Identifier):
+        """
+        Processes a command received on the controller topic, run by pipeline workers
+        :param tc_cmd: TC_Identifier
+        :return: None
+        """
+
+        # only handling PHASE_REQUEST for now, if no match then ignore
+        try:
+            if self._seen_mids.is_duplicate(tc_cmd):
+                self.send_ack(tc_cmd, TC.ACK_DUPLICATE_MID)
+                msg = "Received duplicate message id %d from %s" % (tc_cmd._src_mid, tc_cmd.id)
+                self.output_error(msg)
+            elif tc_cmd.type in [TC.PHASE_REQUEST_ON, TC.PHASE_REQUEST_OFF, TC.PHASE_REQUEST_BATCH]:
+                self.request_phase(tc_cmd)
+            elif tc_cmd.type == TC.ID:
+                self.send_ack(tc_cmd, TC.ACK_OK)
+            else:
+                raise TC_Exception("Received unexpected tc command type %d" % (tc_cmd.type))
+        except TC_Exception as err:
+            self.output_error(err.msg)
+
+    def _process_admin(self, tc_cmd:TC_Identifier):
+        """
+        Processes a command received on the admin topic, run by pipeline workers
+        :param tc_cmd: TC_Identifier
+        :return: None
+        """
+
+        rc = TC.ACK_OK
+
+        try:
             # check that command is intended for this server
-            if userdata._seen_mids.is_duplicate(tc_cmd):
-                userdata.send_ack(tc_cmd, TC.ACK_DUPLICATE_MID)
+            if self._seen_mids.is_duplicate(tc_cmd):
+                self.send_ack(tc_cmd, TC.ACK_DUPLICATE_MID)
                 msg = "Received duplicate message id %d from %s" % (tc_cmd._src_mid, tc_cmd.id)
-                userdata.output_error(msg)
-            elif tc_cmd.controller_id != userdata.id:
+                self.output_error(msg)
+            elif tc_cmd.type not in [TC.ADMIN_REBOOT, TC.ADMIN_WIFI_ENABLE, TC.ADMIN_WIFI_DISABLE]:
+                raise TC_Exception('Unexpected command type %d' % tc_cmd.type)
+            elif tc_cmd.controller_id != self.id:
                 rc = TC.ACK_INVALID_CMD
-                msg = '%s received command type %d intended for controller %s' % (userdata.id, tc_cmd.type, tc_cmd.controller_id)
+                msg = '%s received command type %d intended for controller %s' % (self.id, tc_cmd.type, tc_cmd.controller_id)
                 raise TC_Exception(msg)
 
             elif tc_cmd.type == TC.ADMIN_REBOOT:
-                userdata._run_system_command(tc_cmd, userdata._system_reboot)
+                self._run_system_command(tc_cmd, self._system_reboot)
             elif tc_cmd.type == TC.ADMIN_WIFI_ENABLE:
-                userdata._run_system_command(tc_cmd, userdata._enable_adhoc_wifi)
+                self._run_system_command(tc_cmd, self._enable_adhoc_wifi)
             elif tc_cmd.type == TC.ADMIN_WIFI_DISABLE:
-                userdata._run_system_command(tc_cmd, userdata._disable_adhoc_wifi)
-            else:
-                raise TC_Exception('Unexpected command type %d' % tc_cmd.type)
+                self._run_system_command(tc_cmd, self._disable_adhoc_wifi)
 
         except TC_Exception as err:
-            if tc_cmd:
-                if rc == TC.ACK_OK:
-                    rc = TC.ACK_UNKNOWN_ERR
-                userdata.send_ack(tc_cmd, rc)
-            userdata.output_error(err.msg)
+            if rc == TC.ACK_OK:
+                rc = TC.ACK_UNKNOWN_ERR
+            self.send_ack(tc_cmd, rc)
+            self.output_error(err.msg)
 
 
     def _run_system_command(self, tc_cmd:TC_Identifier, args:list):
         """
-        Executes command using subprocess.run() sending ack on success or failure
+        Queues command for asynchronous execution by _execute_command, sending ACK_BUSY if too many admin commands
+        are already waiting.
+        :param tc_cmd: TC_Identifier
+        :param args: list - args[0] is executable path; args[1:] are arguments to executable
+        :return: True if the command was queued
+        """
+        msg = "queueing admin command <%s>" % str(args)
+        self.output_log(msg)
+        if not self._admin_commands.submit(tc_cmd.id, self._execute_command, tc_cmd, args):
+            msg = "admin command <%s> refused, too many commands pending" % str(args)
+            self.output_error(msg)
+            self.send_ack(tc_cmd, TC.ACK_BUSY)
+            return False
+        return True
+
+    def _execute_command(self, tc_cmd:TC_Identifier, args:list):
+        """
+        Runs command on an admin worker, killing it and its process group if it does not complete within
+        command_timeout seconds, and then sends ack on success, failure or timeout. Output is collected in a
+        temporary file, not a pipe, as daemons the command starts (e.g. by ifup) inherit its output and keep it open.
         :param tc_cmd: TC_Identifier
         :param args: list - args[0] is executable path; args[1:] are arguments to executable
-        :return: result: int
+        :return: None
         """
         msg = "running admin command <%s>" % str(args)
         self.output_log(msg)
-        result = subprocess.call(args)
-        if result == 0:
-            self.send_ack(tc_cmd, TC.ACK_OK)
+        output = b''
+        try:
+            with tempfile.TemporaryFile() as log:
+                process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+                try:
+                    process.wait(timeout=self.command_timeout)
+                    rc = TC.ACK_OK if process.returncode == 0 else TC.ACK_UNKNOWN_ERR
+                except subprocess.TimeoutExpired:
+                    # the command leads its own session, kill it with everything it started that stayed in the group
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    process.wait()
+                    rc = TC.ACK_TIMEOUT
+                status = process.returncode
+                log.seek(0)
+                output = log.read(TC.MAX_ADMIN_OUTPUT)
+        except OSError as err:
+            output = str(err).encode('utf-8')
+            rc = TC.ACK_UNKNOWN_ERR
+            status = -1
+
+        if self.admin_result_ack and tc_cmd._encoding == TC.ENCODING_C_STRUC:
+            output = output[:TC.MAX_ADMIN_OUTPUT].decode('utf-8', 'replace')
+            ack = TC_ACK_Result(tc_cmd.id, tc_cmd._src_mid, rc, status, output)
+            self.mqttc.publish(TC._tc_topic_format % (tc_cmd.id,), ack.encode(), TC.DEFAULT_QOS)
         else:
-            self.send_ack(tc_cmd, TC.ACK_UNKNOWN_ERR)
-        msg = "admin command <%s> returned with code (%d)" % (str(args), result)
+            self.send_ack(tc_cmd, rc)
+        msg = "admin command <%s> returned with code (%d) %s" % (str(args), status, TC.RESULT_CODES[rc])
         self.output_log(msg)
-        return result
-
 
     def watchdog(self):
         """
@@ -1449,18 +3755,48 @@ class Server (TC):
         result = 0
 
         # check if children are still alive
-        if not self._relays.is_alive():
+        if not self._relays.is_alive() or not self._pipeline.is_alive() or not self._admin_commands.is_alive():
             self._healthy = False
 
+        if self.debug_level > 3:
+            msg = "Request pipeline depth %(depth)d, processed %(processed)d, rejected %(rejected)d, " \
+                  "wait mean %(mean_wait).4f max %(max_wait).4f seconds" % self._pipeline.stats()
+            self.output_log(msg)
+            msg = "Scheduler pending %(pending)d, scheduled %(scheduled)d, fired %(fired)d, cancelled %(cancelled)d" \
+                  % TC_Scheduler.get().stats()
+            self.output_log(msg)
+            msg = "Relay wakeups %d, pin writes %d in %d state changes, unchanged pins skipped %d, failed writes %d" % \
+                  (self._relays.wakeups, self._relays.writes, self._relays.state_changes, self._relays.skipped_writes,
+                   self._relays.write_failures)
+            self.output_log(msg)
+            msg = "Coalesced %d phase requests into %d relay updates" % (self.coalesced_requests, self.coalesced_updates)
+            self.output_log(msg)
+            msg = "Sent %d ACKs in %d publishes" % (self.acks_sent, self.ack_publishes)
+            self.output_log(msg)
+            msg = "Relay confirmed %(confirmed)d requests, mismatches %(mismatches)d, readback timeouts %(timeouts)d, " \
+                  "time to confirmed actuation mean %(mean).4f max %(max).4f seconds" % self._relays.confirm_stats()
+            self.output_log(msg)
+            msg = "Seen message ids %d" % (len(self._seen_mids),)
+            if isinstance(self._seen_mids, Message_filter):
+                msg += ", filter memory %(memory)d bytes, saturated %(saturated)s" % self._seen_mids.stats()
+            elif self._seen_mids._store is not None:
+                msg += ", dedup store appended %(appended)d, restored %(restored)d, dropped %(dropped)d" % \
+                       self._seen_mids._store.stats()
+            self.output_log(msg)
+            for operation, stats in sorted(grovepi.get_i2c_stats().items()):
+                msg = "I2C %s calls %d, errors %d, retries %d, failures %d, latency mean %.4f max %.4f seconds" % \
+                      (operation, stats['calls'], stats['errors'], stats['retries'], stats['failures'],
+                       stats['mean_time'], stats['max_time'])
+                self.output_log(msg)
+
         # load the library at run time using cdll
         if self._healthy:
-            result = self._libsystemd.sd_pid_notify(self.watchdog_pid,0,"WATCHDOG=1".encode('ascii'))
+            result = self.sd_notify("WATCHDOG=1")
 
         if result <= 0:
             msg = "Error (%d) in sd_pid_notify" % (result,)
             self.output_log(msg)
-        self._watchdog_timer = threading.Timer(self.watchdog_sec/TC.WATCHDOG_INTERVAL, self.watchdog)
-        self._watchdog_timer.start()
+        self._watchdog_timer = TC_Scheduler.get().schedule(self.watchdog_sec/TC.WATCHDOG_INTERVAL, self.watchdog)
         self._healthy = False
 
     def signal_handler(self, signum, frame):
@@ -1473,6 +3809,231 @@ class Server (TC):
         if signum in [signal.SIGTERM, signal.SIGINT]:
             self.stop()
 
+class Server_Host(TC):
+    """
+    Runs several traffic controllers behind one mqtt connection, e.g. for a lab rig or a simulation. The host
+    subscribes to tc/+ and tc/admin/+ and routes each message to its controller by topic suffix. Controllers share
+    the host's request and admin pipelines and keep their own TC_Relay, relay io backend and message tracking. At
+    most one of them drives the grovepi module, the others need an io backend of their own.
+    """
+
+    def __init__(self, host_id:str, bus=None, workers=TC.PIPELINE_WORKERS, depth=TC.PIPELINE_DEPTH):
+        """
+
+        :param host_id: str mqtt client id of the host
+        :param bus: i2c bus backend for grovepi used by controllers without an io backend of their own
+        :param workers: int request pipeline worker threads shared by all controllers
+        :param depth: int maximum queued requests per worker, raise with the number of controllers hosted
+        """
+        super().__init__()
+        if bus is not None:
+            grovepi.set_bus(bus)
+        self.id = host_id
+        self._controllers = dict()   # controller id -> Server
+        self._running = False
+
+        self.subscriptions = [(TC._topic_base + '+', TC._qos), (TC._admin_base + '+', TC._qos)]
+        self.mqttc = mqtt.Client(host_id)
+        self.mqttc.username_pw_set(self.id, password="BikeIoT")
+        self.mqttc.user_data_set(self)
+        self.mqttc.will_set(TC._will_topic, TC_Identifier(TC.WILL, self.id).encode())
+        self.mqttc.on_connect = Server_Host.on_connect
+        self.mqttc.on_disconnect = TC.on_disconnect
+        self.mqttc.on_subscribe = TC.on_subscribe
+        self.mqttc.on_message = TC.on_message
+        self.mqttc.on_log = TC.on_log
+        self.mqttc.message_callback_add(TC._topic_base + '+', Server_Host.on_topic)
+        self.mqttc.message_callback_add(TC._admin_base + '+', Server_Host.on_admin)
+
+        # watchdog timer, set watchdog_pid iff running with systemd type=notify
+        self._watchdog_timer = None
+        self.watchdog_pid = None
+        self.watchdog_sec = None
+        self._libsystemd = TC.load_libsystemd()
+
+        self._pipeline = TC_Pipeline(self, workers, depth)
+        self._admin_commands = TC_Pipeline(self, TC.ADMIN_CONCURRENCY, TC.ADMIN_QUEUE_DEPTH)
+
+    def add_controller(self, controller_id:str, map=TC._default_phase_map, io=None, dedup_capacity=None):
+        """
+        Creates a Server for controller_id sharing this host's mqtt client and pipelines
+        :param controller_id: str
+        :param map: list [(int,int)] or dict {int:int} mapping of phase number to gpio pin
+        :param io: relay io backend for the controller's TC_Relay (e.g. grovepi_sim.SimulatedRelayIO), None for the
+                   grovepi module which only one hosted controller may drive
+        :param dedup_capacity: int messages per lifetime for a fixed memory Message_filter
+        :return: Server
+        """
+        if controller_id in self._controllers:
+            msg = "controller %s is already hosted by %s" % (controller_id, self.id)
+            raise TC_Exception(msg)
+        if io is None:
+            for other in self._controllers.values():
+                if other._relays._io is grovepi:
+                    msg = "controller %s would drive the grovepi relay pins of controller %s, give it an io backend" % (
+                        controller_id, other.id)
+                    raise TC_Exception(msg)
+        controller = Server(controller_id, map, dedup_capacity=dedup_capacity, io=io, host=self)
+        controller.debug_level = self.debug_level
+        self._controllers[controller_id] = controller
+        if self._running:
+            controller._relays.start()
+        return controller
+
+    def controllers(self):
+        """
+        :return: list of hosted Server objects
+        """
+        return list(self._controllers.values())
+
+    def start(self):
+        """
+        Starts the pipelines and the relay thread of every controller without connecting to the broker
+        :return: None
+        """
+        self._running = True
+        self._pipeline.start()
+        self._admin_commands.start()
+        for controller in self.controllers():
+            controller._relays.start()
+
+    def run(self):
+        """
+        Connects to broker, starts the controllers and begins loop
+        :return: None
+        """
+
+        #tell systemd we are ready
+        result = self.sd_notify("READY=1")
+        if result <= 0:
+            msg = "Error %d sending sd_pid_notify READY" % (result,)
+            self.output_log(msg)
+
+        # initialize watchdog
+        if self.watchdog_pid and self.watchdog_sec:
+            self.watchdog()
+
+        self.connect_broker()
+
+        # enter network loop forever, relying on interrupt handler to stop things
+        self.start()
+        self.mqttc.loop_forever()
+
+    def stop(self):
+        """
+        Disconnects from the broker, causing the network loop_forever to exit, and stops every controller
+        :return: None
+        """
+
+        # tell systemd that we are stopping
+        result = self.sd_notify("STOPPING=1")
+        if result <= 0:
+            msg = "error %d sd_pid_notify STOPPING" % (result,)
+            self.output_log(msg)
+
+        msg = "stopping TC Server host %s with %d controllers" % (self.id, len(self._controllers))
+        self.output_log(msg)
+        self.mqttc.disconnect()
+        if self._watchdog_timer:
+            self._watchdog_timer.cancel()
+        self._pipeline.stop()
+        self._admin_commands.stop()
+        for controller in self.controllers():
+            controller.stop_controller()
+        self._running = False
+
+    def watchdog(self):
+        """
+        Method sends 'heartbeat' to sd_notfiy(3) while the pipelines and every relay thread are running. This should
+        be called with a period <= WatchdogSec/3. (see systemd.service(8))
+        :return: None
+        """
+
+        result = 0
+
+        # check if children are still alive
+        if not self._pipeline.is_alive() or not self._admin_commands.is_alive():
+            self._healthy = False
+        for controller in self.controllers():
+            if not controller._relays.is_alive():
+                self._healthy = False
+
+        if self.debug_level > 3:
+            msg = "Request pipeline depth %(depth)d, processed %(processed)d, rejected %(rejected)d, " \
+                  "wait mean %(mean_wait).4f max %(max_wait).4f seconds" % self._pipeline.stats()
+            self.output_log(msg)
+            for controller in self.controllers():
+                msg = "Controller %s relay wakeups %d, pin writes %d, seen message ids %d" % \
+                      (controller.id, controller._relays.wakeups, controller._relays.writes,
+                       len(controller._seen_mids))
+                self.output_log(msg)
+
+        if self._healthy:
+            result = self.sd_notify("WATCHDOG=1")
+
+        if result <= 0:
+            msg = "Error (%d) in sd_pid_notify" % (result,)
+            self.output_log(msg)
+        self._watchdog_timer = TC_Scheduler.get().schedule(self.watchdog_sec/TC.WATCHDOG_INTERVAL, self.watchdog)
+        self._healthy = False
+
+    def signal_handler(self, signum, frame):
+        """
+        Shuts down host on SIGINT and SIGTERM
+        :param signum:
+        :param frame:
+        :return: None
+        """
+        if signum in [signal.SIGTERM, signal.SIGINT]:
+            self.stop()
+
+    @staticmethod
+    def on_connect(client, userdata, flags, rc):
+        """
+        Called when the broker responds to our connection request, see Server.on_connect
+        :param client: paho.mqtt.client
+        :param userdata: Server_Host
+        :param flags: dict of broker response flags
+        :param rc: int connection result
+        :return: None
+        """
+        TC.on_connect(client, userdata, flags, rc)
+        if rc == mqtt.CONNACK_ACCEPTED and not flags.get('session present'):
+            for controller in userdata.controllers():
+                controller._seen_mids.clear()
+
+    @staticmethod
+    def on_topic(client:mqtt.Client, userdata, mqtt_msg:mqtt.MQTTMessage):
+        """
+        Routes a message on tc/+ to the controller named by the topic suffix. Wills are logged, anything else on
+        tc/+ (e.g. ACKs to users) is ignored.
+        :param client: mqtt.Client
+        :param userdata: Server_Host
+        :param mqtt_msg: MQTTMessage
+        :return: None
+        """
+        userdata._healthy = True
+        suffix = mqtt_msg.topic[len(TC._topic_base):]
+        controller = userdata._controllers.get(suffix)
+        if controller is not None:
+            Server.on_topic(client, controller, mqtt_msg)
+        elif mqtt_msg.topic == TC._will_topic:
+            TC.on_will(client, userdata, mqtt_msg)
+
+    @staticmethod
+    def on_admin(client:mqtt.Client, userdata, mqtt_msg:mqtt.MQTTMessage):
+        """
+        Routes a message on tc/admin/+ to the controller named by the topic suffix
+        :param client: mqtt.Client
+        :param userdata: Server_Host
+        :param mqtt_msg: MQTTMessage
+        :return: None
+        """
+        controller = userdata._controllers.get(mqtt_msg.topic[len(TC._admin_base):])
+        if controller is not None:
+            Server.on_admin(client, controller, mqtt_msg)
+
+
 class User(TC):
     """
     User which is going to send traffic controller phase requests
@@ -1490,6 +4051,7 @@ class User(TC):
         self.my_topic = TC._tc_topic_format % (self.id,)
         self.mqttc = mqtt.Client(user_id)
         self.qos = TC.DEFAULT_QOS
+        self.encoding = TC.ENCODING_C_STRUC  # or TC.ENCODING_V2 for the compact wire format
 
         # using password until we can get TLS setup with user certificates
         self.mqttc.username_pw_set(self.id, self.password)
@@ -1547,7 +4109,7 @@ class User(TC):
         topic = TC._tc_topic_format % controller_id
         msg = "sending reqeust to %s for phase %d" % (controller_id, phase)
         self.output_log(msg)
-        self.mqttc.publish(topic, request.encode(), self.qos)
+        self.mqttc.publish(topic, self._encode(request), self.qos)
 
     def send_json_phase_request(self, controller_id:str, phase:int):
         """
@@ -1561,10 +4123,24 @@ class User(TC):
         topic = TC._tc_topic_format % controller_id
         msg = "sending reqeust to %s for phase %d" % (controller_id, phase)
         self.output_log(msg)
-        payload = StringIO()
-        request.json_dump(payload)
-        print("json encoding = %s" % payload.getvalue())
-        self.mqttc.publish(topic, payload.getvalue(), self.qos)
+        payload = request.json_dumps()
+        if self.debug_level > 2:
+            msg = "json encoding = %s" % (payload,)
+            self.output_log(msg)
+        self.mqttc.publish(topic, payload, self.qos)
+
+    def send_phase_batch(self, controller_id:str, entries):
+        """
+        Creates a TC_Request_Batch object and publishes on the appropriate topic
+        :param controller_id: str
+        :param entries: list [(str, int, int)] of (user_id, phase, TC.PHASE_REQUEST_ON or TC.PHASE_REQUEST_OFF)
+        :return: None
+        """
+        request = TC_Request_Batch(self.id, controller_id, entries)
+        topic = TC._tc_topic_format % controller_id
+        msg = "sending batch of %d reqeusts to %s" % (len(request.entries), controller_id)
+        self.output_log(msg)
+        self.mqttc.publish(topic, request.encode(), self.qos)
 
     def send_phase_release(self, controller_id:str, phase:int):
         """
@@ -1578,7 +4154,7 @@ class User(TC):
         topic = TC._tc_topic_format % controller_id
         msg = "sending reqeust to %s for phase %d" % (controller_id, phase)
         self.output_log(msg)
-        self.mqttc.publish(topic, request.encode(), self.qos)
+        self.mqttc.publish(topic, self._encode(request), self.qos)
 
     def send_json_phase_release(self, controller_id:str, phase:int):
         """
@@ -1592,9 +4168,7 @@ class User(TC):
         topic = TC._tc_topic_format % controller_id
         msg = "sending reqeust to %s for phase %d"  % (controller_id, phase)
         self.output_log(msg)
-        payload = StringIO()
-        request.json_dump(payload)
-        self.mqttc.publish(topic, payload.getvalue(), self.qos)
+        self.mqttc.publish(topic, request.json_dumps(), self.qos)
 
     @staticmethod
     def on_topic(client:mqtt.Client, userdata, mqtt_msg:mqtt.MQTTMessage):
@@ -1612,9 +4186,21 @@ class User(TC):
         if type == TC.ACK:
             userdata._ack_event.set()
             if userdata._wait_for_ack:
-                myACK = TC_ACK.decode(mqtt_msg)
+                myACK = TC.decode(mqtt_msg)
                 msg = "Received ACK for mid %d with result code (%d) %s" % (myACK.mid, myACK.rc, TC.RESULT_CODES[myACK.rc])
                 userdata.output_log(msg)
+        elif type == TC.ACK_MULTI:
+            userdata._ack_event.set()
+            if userdata._wait_for_ack:
+                myACK = TC.decode(mqtt_msg)
+                for mid, rc in myACK.entries:
+                    msg = "Received ACK for mid %d with result code (%d) %s" % (mid, rc, TC.RESULT_CODES[rc])
+                    userdata.output_log(msg)
+        elif type in [TC.ACK_BATCH, TC.ACK_RESULT]:
+            userdata._ack_event.set()
+            if userdata._wait_for_ack:
+                myACK = TC.decode(mqtt_msg)
+                userdata.output_log(str(myACK))
         else:
             msg = "Received type %d on %s" % (type, mqtt_msg.topic)
             userdata.output_log(msg)
@@ -1626,7 +4212,17 @@ class User(TC):
         """
         myID = TC_Identifier(TC.ID, self.id)
         topic = TC._tc_topic_format % (controller_id,)
-        self.mqttc.publish(topic, myID.encode(), TC.DEFAULT_QOS)
+        self.mqttc.publish(topic, self._encode(myID), TC.DEFAULT_QOS)
+
+    def _encode(self, tc_cmd:TC_Type):
+        """
+        Encodes tc_cmd according to self.encoding
+        :param tc_cmd: TC_Type derived object
+        :return: bytearray
+        """
+        if self.encoding == TC.ENCODING_V2:
+            return tc_cmd.encode_v2()
+        return tc_cmd.encode()
 
 def main(argv):
     """
@@ -1635,14 +4231,17 @@ def main(argv):
     :return: int
     """
 
-    USAGE = "TC_server controller_id"
+    USAGE = "TC_server controller_id [dedup_store]"
 
-    if len(argv) != 2:
+    if len(argv) not in (2, 3):
         print(USAGE, file=sys.stdout)
         sys.exit(0)
 
+    dedup_store = None
+    if len(argv) == 3:
+        dedup_store = argv[2]
 
-    myTC = Server(argv[1])
+    myTC = Server(argv[1], dedup_store=dedup_store)
 
     if myTC._debug_level > 2:
         myPID = os.getpid()
@@ -17,19 +17,19 @@
 # Last Updated: 22 Jan 2015
 # http://www.dexterindustries.com/
 
-import smbus
 import time
 import math
-import RPi.GPIO as GPIO
 import struct
+import threading
+import heapq
+import asyncio
+from concurrent.futures import Future
 
 debug =0
 
-rev = GPIO.RPI_REVISION
-if rev == 2 or rev == 3:
-	bus = smbus.SMBus(1)
-else:
-	bus = smbus.SMBus(0)
+# I2C bus backend, opened on first use by get_bus() or replaced with set_bus()
+bus = None
+_bus_lock = threading.Lock()
 
 # I2C Address of Arduino
 address = 0x04
@@ -49,6 +49,12 @@ pMode_cmd = [5]
 uRead_cmd = [7]
 # Get firmware version
 version_cmd = [8]
+# digitalWriteMany() command format header, followed by the pin count and (pin, value) pairs. Not part of any
+# released firmware, used only with dWriteMany_supported set.
+dWriteMany_cmd = [120]
+# digitalReadMany() command format header, followed by the pin count and pins, response holds one value per pin.
+# Not part of any released firmware, used only with dWriteMany_supported set.
+dReadMany_cmd = [121]
 # Accelerometer (+/- 1.5g) read
 acc_xyz_cmd = [20]
 # RTC get time
@@ -111,75 +117,467 @@ chainableRgbLedSetLevel_cmd = [95]
 # This allows us to be more specific about which commands contain unused bytes
 unused = 0
 
+# (pin, value) pairs carried by one dWriteMany_cmd block, an SMBus block write holds 32 bytes
+dWriteMany_max_pins = 15
+# pins read by one dReadMany_cmd block and the device delay before its response is ready
+dReadMany_max_pins = 30
+dReadMany_delay = .01
+# device delay of each digitalRead() block digitalReadMany_nb() sends without dWriteMany_supported. The firmware
+# answers a digital read on its next loop pass, well within this, digitalRead() keeps the library's .1 s margin.
+dReadMany_pin_delay = .01
+# Set True only for a GrovePi whose firmware handles dWriteMany_cmd and dReadMany_cmd and keeps a pending read
+# response across writes. No released firmware does and the version number does not tell, so by default pins are
+# written and read with sequential digitalWrite() and digitalRead() blocks.
+dWriteMany_supported = False
+
+# Retries of an I2C operation failing with IOError, waiting i2c_backoff seconds before the first retry and
+# doubling up to i2c_backoff_max. Operations still failing return -1.
+i2c_retries = 3
+i2c_backoff = .002
+i2c_backoff_max = .02
+# Resends of a read whose response was overwritten by writes sent during its device delay, after that writes
+# are held until the read has been collected
+i2c_max_resends = 2
+
+# I2C transaction priorities, lower values are sent to the GrovePi first
+PRIORITY_RELAY = 0
+PRIORITY_WRITE = 1
+PRIORITY_READ = 2
+
+# Response block layouts. A read_i2c_block() response is RESPONSE_LENGTH bytes starting with the echoed
+# command byte, the *_record structs span a whole response for decoding buffers of stacked responses.
+RESPONSE_LENGTH = 32
+_u16_struct = struct.Struct('>xH')
+_u16_record = struct.Struct('>xH%dx' % (RESPONSE_LENGTH - 3,))
+_acc_struct = struct.Struct('x3B')
+_acc_record = struct.Struct('x3B%dx' % (RESPONSE_LENGTH - 4,))
+_dht_struct = struct.Struct('<xff')
+_dht_record = struct.Struct('<xff%dx' % (RESPONSE_LENGTH - 9,))
+# accelerometer axis byte to signed value, bytes above 32 are negative
+_acc_axis = tuple(value if value <= 32 else 224 - value for value in range(256))
+
 # Function declarations of the various functions used for encoding and sending
 # data from RPi to Arduino
 
 
+# Returns the I2C bus backend, opening the Raspberry Pi SMBus on first use
+def get_bus():
+	global bus
+	if bus is None:
+		_bus_lock.acquire()
+		try:
+			if bus is None:
+				import smbus
+				import RPi.GPIO as GPIO
+				rev = GPIO.RPI_REVISION
+				if rev == 2 or rev == 3:
+					bus = smbus.SMBus(1)
+				else:
+					bus = smbus.SMBus(0)
+		finally:
+			_bus_lock.release()
+	return bus
+
+
+# Replaces the I2C bus backend. Any object providing the smbus.SMBus methods write_i2c_block_data, read_byte
+# and read_i2c_block_data will do, e.g. grovepi_sim.SimulatedBus
+def set_bus(backend):
+	global bus
+	_bus_lock.acquire()
+	bus = backend
+	_bus_lock.release()
+
+
+# Per operation counters of I2C calls, failed attempts (errors), retries, calls failing after all retries
+# (failures) and latency including retries
+class I2C_Stats(object):
+	__slots__ = ('calls', 'errors', 'retries', 'failures', 'total_time', 'max_time')
+
+	def __init__(self):
+		self.calls = 0
+		self.errors = 0
+		self.retries = 0
+		self.failures = 0
+		self.total_time = 0.0
+		self.max_time = 0.0
+
+
+_i2c_stats = {'write': I2C_Stats(), 'read_byte': I2C_Stats(), 'read_block': I2C_Stats()}
+_i2c_stats_lock = threading.Lock()
+
+
+# Returns a snapshot of the I2C counters, {operation: {counter: value}} including mean_time in seconds
+def get_i2c_stats():
+	_i2c_stats_lock.acquire()
+	snapshot = dict()
+	for operation, stats in _i2c_stats.items():
+		snapshot[operation] = dict((name, getattr(stats, name)) for name in I2C_Stats.__slots__)
+		snapshot[operation]['mean_time'] = stats.total_time / stats.calls if stats.calls else 0.0
+	_i2c_stats_lock.release()
+	return snapshot
+
+
+# Zeroes the I2C counters
+def reset_i2c_stats():
+	_i2c_stats_lock.acquire()
+	for operation in _i2c_stats:
+		_i2c_stats[operation] = I2C_Stats()
+	_i2c_stats_lock.release()
+
+
+# Runs one I2C operation, retrying on IOError with bounded exponential backoff, returns -1 if every attempt failed
+def _i2c_call(operation, function, *args):
+	start = time.monotonic()
+	backoff = i2c_backoff
+	errors = 0
+	while True:
+		try:
+			result = function(*args)
+			break
+		except IOError:
+			if debug:
+				print("IOError")
+			errors += 1
+			if errors > i2c_retries:
+				result = -1
+				break
+			time.sleep(backoff)
+			backoff = min(backoff * 2, i2c_backoff_max)
+	elapsed = time.monotonic() - start
+	_i2c_stats_lock.acquire()
+	stats = _i2c_stats[operation]
+	stats.calls += 1
+	stats.errors += errors
+	stats.total_time += elapsed
+	if elapsed > stats.max_time:
+		stats.max_time = elapsed
+	if result == -1:
+		stats.retries += errors - 1
+		stats.failures += 1
+	else:
+		stats.retries += errors
+	_i2c_stats_lock.release()
+	return result
+
+
 # Write I2C block
 def write_i2c_block(address, block):
-	try:
-		return bus.write_i2c_block_data(address, 1, block)
-	except IOError:
-		if debug:
-			print("IOError")
-		return -1
+	return _i2c_call('write', get_bus().write_i2c_block_data, address, 1, block)
 
 
 # Read I2C byte
 def read_i2c_byte(address):
-	try:
-		return bus.read_byte(address)
-	except IOError:
-		if debug:
-			print("IOError")
-		return -1
+	return _i2c_call('read_byte', get_bus().read_byte, address)
 
 
 # Read I2C block
 def read_i2c_block(address):
-	try:
-		return bus.read_i2c_block_data(address, 1)
-	except IOError:
-		if debug:
-			print("IOError")
-		return -1
+	return _i2c_call('read_block', get_bus().read_i2c_block_data, address, 1)
+
+
+# A command block written to the GrovePi, optionally followed after delay seconds by collect() which reads the
+# response and returns the result of the transaction
+class I2C_Transaction(object):
+	__slots__ = ('priority', 'block', 'delay', 'collect', 'future')
+
+	def __init__(self, priority, block, delay, collect):
+		self.priority = priority
+		self.block = block
+		self.delay = delay
+		self.collect = collect
+		self.future = Future()
+
+
+# Owns the I2C bus, transactions are queued by priority and run from a single thread. While a read waits out
+# its device delay only transactions without a response are sent, the GrovePi has a single response buffer
+# so a second read would overwrite the pending response. Unless dWriteMany_supported is set the firmware answers
+# with the response of the last command received, so a write sent during the delay costs the pending
+# read a resend of its command and a fresh delay. After i2c_max_resends of those, writes wait for the read so a
+# steady stream of writes cannot starve it.
+class I2C_Scheduler(threading.Thread):
+
+	def __init__(self):
+		threading.Thread.__init__(self, name='I2C_Scheduler')
+		self.daemon = True
+		self._queue = []
+		self._sequence = 0
+		self._condition = threading.Condition()
+		self._reading = None
+		self._ready = 0.0
+		self._clobbered = False
+		self._resends = 0
+		self._runnable = True
+
+	# Queues a transaction, returns a concurrent.futures.Future resolving to the transaction result
+	def submit(self, block, delay=0, collect=None, priority=PRIORITY_WRITE):
+		transaction = I2C_Transaction(priority, block, delay, collect)
+		self._condition.acquire()
+		heapq.heappush(self._queue, (priority, self._sequence, transaction))
+		self._sequence += 1
+		self._condition.notify()
+		self._condition.release()
+		return transaction.future
+
+	# Quits thread, queued transactions are cancelled
+	def stop(self):
+		self._condition.acquire()
+		self._runnable = False
+		for priority, sequence, transaction in self._queue:
+			transaction.future.cancel()
+		self._queue = []
+		self._condition.notify()
+		self._condition.release()
+
+	def run(self):
+		while self._runnable:
+			transaction = None
+			collect = None
+			self._condition.acquire()
+			while self._runnable:
+				now = time.monotonic()
+				if self._reading is not None and now >= self._ready:
+					collect = self._reading
+					self._reading = None
+					break
+				if self._queue and (self._reading is None or self._queue[0][2].collect is None and
+									(dWriteMany_supported or self._resends < i2c_max_resends)):
+					transaction = heapq.heappop(self._queue)[2]
+					break
+				timeout = None
+				if self._reading is not None:
+					timeout = self._ready - now
+				self._condition.wait(timeout)
+			self._condition.release()
+
+			if collect is not None and self._clobbered:
+				# response was replaced by an interleaved write, ask again
+				self._clobbered = False
+				self._resends += 1
+				self._send(collect)
+			elif collect is not None:
+				self._collect(collect)
+			elif transaction is not None and transaction.future.set_running_or_notify_cancel():
+				if transaction.collect is not None:
+					self._resends = 0
+				elif self._reading is not None and not dWriteMany_supported:
+					self._clobbered = True
+				self._send(transaction)
+
+	# Writes the command block of a transaction, a transaction with a response becomes the pending read
+	def _send(self, transaction):
+		try:
+			result = write_i2c_block(address, transaction.block)
+		except Exception as e:
+			transaction.future.set_exception(e)
+			return
+		if transaction.collect is None:
+			transaction.future.set_result(result)
+		else:
+			self._condition.acquire()
+			self._reading = transaction
+			self._ready = time.monotonic() + transaction.delay
+			self._condition.release()
+
+	# Reads the response of a transaction whose device delay has passed
+	def _collect(self, transaction):
+		try:
+			transaction.future.set_result(transaction.collect())
+		except Exception as e:
+			transaction.future.set_exception(e)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+# Returns the I2C scheduler owning the bus, starting it on first use
+def get_scheduler():
+	global _scheduler
+	_scheduler_lock.acquire()
+	if _scheduler is None or not _scheduler.is_alive():
+		_scheduler = I2C_Scheduler()
+		_scheduler.start()
+	_scheduler_lock.release()
+	return _scheduler
+
+
+# Runs a transaction on the I2C scheduler and waits for its result. Called from the scheduler thread itself,
+# e.g. from a collect function, the transaction runs inline.
+def i2c_transaction(block, delay=0, collect=None, priority=PRIORITY_WRITE):
+	scheduler = get_scheduler()
+	if threading.current_thread() is scheduler:
+		result = write_i2c_block(address, block)
+		if collect is None:
+			return result
+		time.sleep(delay)
+		return collect()
+	return scheduler.submit(block, delay, collect, priority).result()
+
+
+# Issues a read on the I2C scheduler without waiting for the device delay. Returns a concurrent.futures.Future,
+# callback, if given, is called with the Future once the result has been collected.
+def _read_nb(block, delay, collect, callback):
+	future = get_scheduler().submit(block, delay, collect, PRIORITY_READ)
+	if callback is not None:
+		future.add_done_callback(callback)
+	return future
+
+
+# Collects the result of a non-blocking read, waits up to timeout seconds (None waits for the device delay)
+def read_result(future, timeout=None):
+	return future.result(timeout)
+
+
+# Collect the response of a digitalRead() command
+def _digital_value():
+	return read_i2c_byte(address)
 
 
 # Arduino Digital Read
 def digitalRead(pin):
-	write_i2c_block(address, dRead_cmd + [pin, unused, unused])
-	time.sleep(.1)
-	n = read_i2c_byte(address)
-	return n
+	return i2c_transaction(dRead_cmd + [pin, unused, unused], .1, _digital_value, PRIORITY_READ)
+
+
+# Non-blocking digitalRead(), see read_result()
+def digitalRead_nb(pin, callback=None):
+	return _read_nb(dRead_cmd + [pin, unused, unused], .1, _digital_value, callback)
+
 
+# digitalRead() awaitable from an asyncio event loop
+def digitalRead_aio(pin, loop=None):
+	return asyncio.wrap_future(digitalRead_nb(pin), loop=loop)
 
-# Arduino Digital Write
+
+# Arduino Digital Write, relay writes are sent ahead of queued sensor reads. Returns -1 if the write failed.
 def digitalWrite(pin, value):
-	write_i2c_block(address, dWrite_cmd + [pin, value, unused])
+	if i2c_transaction(dWrite_cmd + [pin, value, unused], priority=PRIORITY_RELAY) == -1:
+		return -1
+	return 1
+
+
+# Arduino Digital Write of several pins, pin_values is a dict or list of (pin, value). All pins are set by a single
+# block transaction with dWriteMany_supported set, otherwise by back to back digitalWrite() blocks. Returns -1 if
+# any write failed.
+def digitalWriteMany(pin_values):
+	if isinstance(pin_values, dict):
+		pin_values = pin_values.items()
+	pin_values = list(pin_values)
+	scheduler = get_scheduler()
+	if dWriteMany_supported:
+		blocks = []
+		for start in range(0, len(pin_values), dWriteMany_max_pins):
+			chunk = pin_values[start:start + dWriteMany_max_pins]
+			block = dWriteMany_cmd + [len(chunk)]
+			for pin, value in chunk:
+				block += [pin, value]
+			blocks.append(block)
+	else:
+		blocks = [dWrite_cmd + [pin, value, unused] for pin, value in pin_values]
+	if threading.current_thread() is scheduler:
+		results = [write_i2c_block(address, block) for block in blocks]
+	else:
+		futures = [scheduler.submit(block, priority=PRIORITY_RELAY) for block in blocks]
+		results = [future.result() for future in futures]
+	if -1 in results:
+		return -1
 	return 1
 
 
+# Collect the response of a dReadMany_cmd block for count pins
+def _digital_values(count):
+	number = read_i2c_block(address)
+	if number == -1:
+		return [-1] * count
+	return number[1:1 + count]
+
+
+# Non-blocking read of several digital pins, returns a concurrent.futures.Future resolving to a list of values in
+# pin order (-1 for pins that could not be read). With dWriteMany_supported set all pins are read with one
+# dReadMany_cmd transaction, otherwise with queued digitalRead() transactions.
+def digitalReadMany_nb(pins, callback=None):
+	pins = list(pins)
+	if dWriteMany_supported:
+		futures = []
+		for start in range(0, len(pins), dReadMany_max_pins):
+			chunk = pins[start:start + dReadMany_max_pins]
+			collect = lambda count=len(chunk): _digital_values(count)
+			futures.append(_read_nb(dReadMany_cmd + [len(chunk)] + chunk, dReadMany_delay, collect, None))
+	else:
+		futures = [_read_nb(dRead_cmd + [pin, unused, unused], dReadMany_pin_delay, _digital_value, None) for pin in pins]
+
+	result = Future()
+	result.set_running_or_notify_cancel()
+	remaining = [len(futures)]
+	lock = threading.Lock()
+
+	def done(future):
+		lock.acquire()
+		remaining[0] -= 1
+		finished = remaining[0] == 0
+		lock.release()
+		if finished:
+			values = []
+			for read in futures:
+				try:
+					value = read.result()
+				except Exception:
+					value = -1
+				if isinstance(value, list):
+					values.extend(value)
+				else:
+					values.append(value)
+			result.set_result(values)
+
+	if callback is not None:
+		result.add_done_callback(callback)
+	if not futures:
+		result.set_result([])
+	for future in futures:
+		future.add_done_callback(done)
+	return result
+
+
+# Arduino Digital Read of several pins, returns a list of values in pin order
+def digitalReadMany(pins):
+	return digitalReadMany_nb(pins).result()
+
+
 # Setting Up Pin mode on Arduino
 def pinMode(pin, mode):
 	if mode == "OUTPUT":
-		write_i2c_block(address, pMode_cmd + [pin, 1, unused])
+		i2c_transaction(pMode_cmd + [pin, 1, unused])
 	elif mode == "INPUT":
-		write_i2c_block(address, pMode_cmd + [pin, 0, unused])
+		i2c_transaction(pMode_cmd + [pin, 0, unused])
 	return 1
 
 
+# Collect the response of an analogRead() command
+def _analog_value():
+	read_i2c_byte(address)
+	number = read_i2c_block(address)
+	if number == -1:
+		raise IOError("analogRead response lost")
+	return number[1] * 256 + number[2]
+
+
 # Read analog value from Pin
 def analogRead(pin):
-	bus.write_i2c_block_data(address, 1, aRead_cmd + [pin, unused, unused])
-	time.sleep(.1)
-	bus.read_byte(address)
-	number = bus.read_i2c_block_data(address, 1)
-	return number[1] * 256 + number[2]
+	return i2c_transaction(aRead_cmd + [pin, unused, unused], .1, _analog_value, PRIORITY_READ)
+
+
+# Non-blocking analogRead(), see read_result()
+def analogRead_nb(pin, callback=None):
+	return _read_nb(aRead_cmd + [pin, unused, unused], .1, _analog_value, callback)
+
+
+# analogRead() awaitable from an asyncio event loop
+def analogRead_aio(pin, loop=None):
+	return asyncio.wrap_future(analogRead_nb(pin), loop=loop)
 
 
 # Write PWM
 def analogWrite(pin, value):
-	write_i2c_block(address, aWrite_cmd + [pin, value, unused])
+	i2c_transaction(aWrite_cmd + [pin, value, unused])
 	return 1
 
 
@@ -198,130 +596,153 @@ def temp(pin, model = '1.0'):
 	return t
 
 
+# Collect the response of an ultrasonicRead() command
+def _ultrasonic_value():
+	read_i2c_byte(address)
+	return decode_ultrasonic(read_i2c_block(address))
+
+
 # Read value from Grove Ultrasonic
 def ultrasonicRead(pin):
-	write_i2c_block(address, uRead_cmd + [pin, unused, unused])
-	time.sleep(.2)
+	return i2c_transaction(uRead_cmd + [pin, unused, unused], .2, _ultrasonic_value, PRIORITY_READ)
+
+
+# Non-blocking ultrasonicRead(), see read_result()
+def ultrasonicRead_nb(pin, callback=None):
+	return _read_nb(uRead_cmd + [pin, unused, unused], .2, _ultrasonic_value, callback)
+
+
+# ultrasonicRead() awaitable from an asyncio event loop
+def ultrasonicRead_aio(pin, loop=None):
+	return asyncio.wrap_future(ultrasonicRead_nb(pin), loop=loop)
+
+
+# Collect the response of a version() command
+def _version_value():
 	read_i2c_byte(address)
 	number = read_i2c_block(address)
-	return (number[1] * 256 + number[2])
+	return "%s.%s.%s" % (number[1], number[2], number[3])
 
 
 # Read the firmware version
 def version():
-	write_i2c_block(address, version_cmd + [unused, unused, unused])
-	time.sleep(.1)
+	return i2c_transaction(version_cmd + [unused, unused, unused], .1, _version_value, PRIORITY_READ)
+
+
+# Collect the response of an acc_xyz() command
+def _acc_xyz_value():
 	read_i2c_byte(address)
-	number = read_i2c_block(address)
-	return "%s.%s.%s" % (number[1], number[2], number[3])
+	return decode_acc_xyz(read_i2c_block(address))
 
 
 # Read Grove Accelerometer (+/- 1.5g) XYZ value
 def acc_xyz():
-	write_i2c_block(address, acc_xyz_cmd + [unused, unused, unused])
-	time.sleep(.1)
+	return i2c_transaction(acc_xyz_cmd + [unused, unused, unused], .1, _acc_xyz_value, PRIORITY_READ)
+
+
+# Collect the response of a rtc_getTime() command
+def _rtc_value():
 	read_i2c_byte(address)
 	number = read_i2c_block(address)
-	if number[1] > 32:
-		number[1] = - (number[1] - 224)
-	if number[2] > 32:
-		number[2] = - (number[2] - 224)
-	if number[3] > 32:
-		number[3] = - (number[3] - 224)
-	return (number[1], number[2], number[3])
+	return number
 
 
 # Read from Grove RTC
 def rtc_getTime():
-	write_i2c_block(address, rtc_getTime_cmd + [unused, unused, unused])
-	time.sleep(.1)
+	return i2c_transaction(rtc_getTime_cmd + [unused, unused, unused], .1, _rtc_value, PRIORITY_READ)
+
+
+# Collect the response of a dht() command
+def _dht_value():
 	read_i2c_byte(address)
-	number = read_i2c_block(address)
-	return number
+	return decode_dht(read_i2c_block(address))
 
 
-# Read and return temperature and humidity from Grove DHT Pro
-def dht(pin, module_type):
-	write_i2c_block(address, dht_temp_cmd + [pin, module_type, unused])
+# Decode an ultrasonicRead() response block (list, bytes or any buffer) to the distance in cm
+def decode_ultrasonic(block):
+	if isinstance(block, list):
+		block = bytes(block)
+	return _u16_struct.unpack_from(block)[0]
 
-	# Delay necessary for proper reading fron DHT sensor
-	time.sleep(.6)
+
+# Decode an acc_xyz() response block to an (x, y, z) tuple
+def decode_acc_xyz(block):
+	if isinstance(block, list):
+		block = bytes(block)
+	x, y, z = _acc_struct.unpack_from(block)
+	return (_acc_axis[x], _acc_axis[y], _acc_axis[z])
+
+
+# Decode a dht() response block to [temperature, humidity], [-1,-1] if the read failed
+def decode_dht(block):
+	if block == -1:
+		return [-1,-1]
 	try:
-		read_i2c_byte(address)
-		number = read_i2c_block(address)
-		if number == -1:
-			return [-1,-1]
-	except (TypeError, IndexError):
+		if isinstance(block, list):
+			block = bytes(block)
+		t, hum = _dht_struct.unpack_from(block)
+	except (TypeError, ValueError, struct.error):
 		return [-1,-1]
-	# data returned in IEEE format as a float in 4 bytes
-	f = 0
-	# data is reversed
-	for element in reversed(number[1:5]):
-		# Converted to hex
-		hex_val = hex(element)
-		#print hex_val
-		try:
-			h_val = hex_val[2] + hex_val[3]
-		except IndexError:
-			h_val = '0' + hex_val[2]
-		# Convert to char array
-		if f == 0:
-			h = h_val
-			f = 1
-		else:
-			h = h + h_val
-	# convert the temp back to float
-	t = round(struct.unpack('!f', h.decode('hex'))[0], 2)
-
-	h = ''
-	# data is reversed
-	for element in reversed(number[5:9]):
-		# Converted to hex
-		hex_val = hex(element)
-		# Print hex_val
-		try:
-			h_val = hex_val[2] + hex_val[3]
-		except IndexError:
-			h_val = '0' + hex_val[2]
-		# Convert to char array
-		if f == 0:
-			h = h_val
-			f = 1
-		else:
-			h = h + h_val
-	# convert back to float
-	hum = round(struct.unpack('!f', h.decode('hex'))[0], 2)
-	return [t, hum]
+	return [round(t, 2), round(hum, 2)]
+
+
+# Batch decoders for telemetry, buffer holds back to back RESPONSE_LENGTH byte response blocks
+def decode_ultrasonic_many(buffer):
+	return [distance for (distance,) in _u16_record.iter_unpack(buffer)]
+
+
+def decode_acc_xyz_many(buffer):
+	return [(_acc_axis[x], _acc_axis[y], _acc_axis[z]) for x, y, z in _acc_record.iter_unpack(buffer)]
+
+
+def decode_dht_many(buffer):
+	return [[round(t, 2), round(hum, 2)] for t, hum in _dht_record.iter_unpack(buffer)]
+
+
+# Read and return temperature and humidity from Grove DHT Pro
+def dht(pin, module_type):
+	# Delay necessary for proper reading fron DHT sensor
+	return i2c_transaction(dht_temp_cmd + [pin, module_type, unused], .6, _dht_value, PRIORITY_READ)
+
+
+# Non-blocking dht(), see read_result()
+def dht_nb(pin, module_type, callback=None):
+	return _read_nb(dht_temp_cmd + [pin, module_type, unused], .6, _dht_value, callback)
+
+
+# dht() awaitable from an asyncio event loop
+def dht_aio(pin, module_type, loop=None):
+	return asyncio.wrap_future(dht_nb(pin, module_type), loop=loop)
 
 # Grove LED Bar - initialise
 # orientation: (0 = red to green, 1 = green to red)
 def ledBar_init(pin, orientation):
-	write_i2c_block(address, ledBarInit_cmd + [pin, orientation, unused])
+	i2c_transaction(ledBarInit_cmd + [pin, orientation, unused])
 	return 1
 
 # Grove LED Bar - set orientation
 # orientation: (0 = red to green,  1 = green to red)
 def ledBar_orientation(pin, orientation):
-	write_i2c_block(address, ledBarOrient_cmd + [pin, orientation, unused])
+	i2c_transaction(ledBarOrient_cmd + [pin, orientation, unused])
 	return 1
 
 # Grove LED Bar - set level
 # level: (0-10)
 def ledBar_setLevel(pin, level):
-	write_i2c_block(address, ledBarLevel_cmd + [pin, level, unused])
+	i2c_transaction(ledBarLevel_cmd + [pin, level, unused])
 	return 1
 
 # Grove LED Bar - set single led
 # led: which led (1-10)
 # state: off or on (0-1)
 def ledBar_setLed(pin, led, state):
-	write_i2c_block(address, ledBarSetOne_cmd + [pin, led, state])
+	i2c_transaction(ledBarSetOne_cmd + [pin, led, state])
 	return 1
 
 # Grove LED Bar - toggle single led
 # led: which led (1-10)
 def ledBar_toggleLed(pin, led):
-	write_i2c_block(address, ledBarToggleOne_cmd + [pin, led, unused])
+	i2c_transaction(ledBarToggleOne_cmd + [pin, led, unused])
 	return 1
 
 # Grove LED Bar - set all leds
@@ -329,22 +750,25 @@ def ledBar_toggleLed(pin, led):
 def ledBar_setBits(pin, state):
 	byte1 = state & 255
 	byte2 = state >> 8
-	write_i2c_block(address, ledBarSet_cmd + [pin, byte1, byte2])
+	i2c_transaction(ledBarSet_cmd + [pin, byte1, byte2])
 	return 1
 
-# Grove LED Bar - get current state
-# state: (0-1023) a bit for each of the 10 LEDs
-def ledBar_getBits(pin):
-	write_i2c_block(address, ledBarGet_cmd + [pin, unused, unused])
-	time.sleep(.2)
+# Collect the response of a ledBar_getBits() command
+def _ledBar_bits():
 	read_i2c_byte(0x04)
 	block = read_i2c_block(0x04)
 	return block[1] ^ (block[2] << 8)
 
 
+# Grove LED Bar - get current state
+# state: (0-1023) a bit for each of the 10 LEDs
+def ledBar_getBits(pin):
+	return i2c_transaction(ledBarGet_cmd + [pin, unused, unused], .2, _ledBar_bits, PRIORITY_READ)
+
+
 # Grove 4 Digit Display - initialise
 def fourDigit_init(pin):
-	write_i2c_block(address, fourDigitInit_cmd + [pin, unused, unused])
+	i2c_transaction(fourDigitInit_cmd + [pin, unused, unused])
 	return 1
 
 # Grove 4 Digit Display - set numeric value with or without leading zeros
@@ -355,9 +779,9 @@ def fourDigit_number(pin, value, leading_zero):
 	byte2 = value >> 8
 	# separate commands to overcome current 4 bytes per command limitation
 	if (leading_zero):
-		write_i2c_block(address, fourDigitValue_cmd + [pin, byte1, byte2])
+		i2c_transaction(fourDigitValue_cmd + [pin, byte1, byte2])
 	else:
-		write_i2c_block(address, fourDigitValueZeros_cmd + [pin, byte1, byte2])
+		i2c_transaction(fourDigitValueZeros_cmd + [pin, byte1, byte2])
 	time.sleep(.05)
 	return 1
 
@@ -365,7 +789,7 @@ def fourDigit_number(pin, value, leading_zero):
 # brightness: (0-7)
 def fourDigit_brightness(pin, brightness):
 	# not actually visible until next command is executed
-	write_i2c_block(address, fourDigitBrightness_cmd + [pin, brightness, unused])
+	i2c_transaction(fourDigitBrightness_cmd + [pin, brightness, unused])
 	time.sleep(.05)
 	return 1
 
@@ -373,7 +797,7 @@ def fourDigit_brightness(pin, brightness):
 # segment: (0-3)
 # value: (0-15) or (0-F)
 def fourDigit_digit(pin, segment, value):
-	write_i2c_block(address, fourDigitIndividualDigit_cmd + [pin, segment, value])
+	i2c_transaction(fourDigitIndividualDigit_cmd + [pin, segment, value])
 	time.sleep(.05)
 	return 1
 
@@ -381,7 +805,7 @@ def fourDigit_digit(pin, segment, value):
 # segment: (0-3)
 # leds: (0-255) or (0-0xFF) one bit per led, segment 2 is special, 8th bit is the colon
 def fourDigit_segment(pin, segment, leds):
-	write_i2c_block(address, fourDigitIndividualLeds_cmd + [pin, segment, leds])
+	i2c_transaction(fourDigitIndividualLeds_cmd + [pin, segment, leds])
 	time.sleep(.05)
 	return 1
 
@@ -390,7 +814,7 @@ def fourDigit_segment(pin, segment, leds):
 # right: (0-255) or (0-FF)
 # colon will be lit
 def fourDigit_score(pin, left, right):
-	write_i2c_block(address, fourDigitScore_cmd + [pin, left, right])
+	i2c_transaction(fourDigitScore_cmd + [pin, left, right])
 	time.sleep(.05)
 	return 1
 
@@ -398,19 +822,19 @@ def fourDigit_score(pin, left, right):
 # analog: analog pin to read
 # duration: analog read for this many seconds
 def fourDigit_monitor(pin, analog, duration):
-	write_i2c_block(address, fourDigitAnalogRead_cmd + [pin, analog, duration])
+	i2c_transaction(fourDigitAnalogRead_cmd + [pin, analog, duration])
 	time.sleep(duration + .05)
 	return 1
 
 # Grove 4 Digit Display - turn entire display on (88:88)
 def fourDigit_on(pin):
-	write_i2c_block(address, fourDigitAllOn_cmd + [pin, unused, unused])
+	i2c_transaction(fourDigitAllOn_cmd + [pin, unused, unused])
 	time.sleep(.05)
 	return 1
 
 # Grove 4 Digit Display - turn entire display off
 def fourDigit_off(pin):
-	write_i2c_block(address, fourDigitAllOff_cmd + [pin, unused, unused])
+	i2c_transaction(fourDigitAllOff_cmd + [pin, unused, unused])
 	time.sleep(.05)
 	return 1
 
@@ -419,14 +843,14 @@ def fourDigit_off(pin):
 # green: 0-255
 # blue: 0-255
 def storeColor(red, green, blue):
-	write_i2c_block(address, storeColor_cmd + [red, green, blue])
+	i2c_transaction(storeColor_cmd + [red, green, blue])
 	time.sleep(.05)
 	return 1
 
 # Grove Chainable RGB LED - initialise
 # numLeds: how many leds do you have in the chain
 def chainableRgbLed_init(pin, numLeds):
-	write_i2c_block(address, chainableRgbLedInit_cmd + [pin, numLeds, unused])
+	i2c_transaction(chainableRgbLedInit_cmd + [pin, numLeds, unused])
 	time.sleep(.05)
 	return 1
 
@@ -435,7 +859,7 @@ def chainableRgbLed_init(pin, numLeds):
 # testColor: (0-7) 3 bits in total - a bit for red, green and blue, eg. 0x04 == 0b100 (0bRGB) == rgb(255, 0, 0) == #FF0000 == red
 #            ie. 0 black, 1 blue, 2 green, 3 cyan, 4 red, 5 magenta, 6 yellow, 7 white
 def chainableRgbLed_test(pin, numLeds, testColor):
-	write_i2c_block(address, chainableRgbLedTest_cmd + [pin, numLeds, testColor])
+	i2c_transaction(chainableRgbLedTest_cmd + [pin, numLeds, testColor])
 	time.sleep(.05)
 	return 1
 
@@ -443,7 +867,7 @@ def chainableRgbLed_test(pin, numLeds, testColor):
 # pattern: (0-3) 0 = this led only, 1 all leds except this led, 2 this led and all leds inwards, 3 this led and all leds outwards
 # whichLed: index of led you wish to set counting outwards from the GrovePi, 0 = led closest to the GrovePi
 def chainableRgbLed_pattern(pin, pattern, whichLed):
-	write_i2c_block(address, chainableRgbLedSetPattern_cmd + [pin, pattern, whichLed])
+	i2c_transaction(chainableRgbLedSetPattern_cmd + [pin, pattern, whichLed])
 	time.sleep(.05)
 	return 1
 
@@ -451,7 +875,7 @@ def chainableRgbLed_pattern(pin, pattern, whichLed):
 # offset: index of led you wish to start at, 0 = led closest to the GrovePi, counting outwards
 # divisor: when 1 (default) sets stored color on all leds >= offset, when 2 sets every 2nd led >= offset and so on
 def chainableRgbLed_modulo(pin, offset, divisor):
-	write_i2c_block(address, chainableRgbLedSetModulo_cmd + [pin, offset, divisor])
+	i2c_transaction(chainableRgbLedSetModulo_cmd + [pin, offset, divisor])
 	time.sleep(.05)
 	return 1
 
@@ -459,6 +883,6 @@ def chainableRgbLed_modulo(pin, offset, divisor):
 # level: (0-10) the number of leds you wish to set to the stored color
 # reversible (0-1) when 0 counting outwards from GrovePi, 0 = led closest to the GrovePi, otherwise counting inwards
 def chainableRgbLed_setLevel(pin, level, reverse):
-	write_i2c_block(address, chainableRgbLedSetLevel_cmd + [pin, level, reverse])
+	i2c_transaction(chainableRgbLedSetLevel_cmd + [pin, level, reverse])
 	time.sleep(.05)
 	return 1
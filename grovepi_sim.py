@@ -0,0 +1,219 @@
+"""
+Simulated I2C bus with a GrovePi at the other end, for running grovepi, TC_Relay and Server off device.
+
+usage:
+    import grovepi, grovepi_sim
+    grovepi.set_bus(grovepi_sim.SimulatedBus(latency=0.0005, error_rate=0.01))
+"""
+
+from collections import deque
+from concurrent.futures import Future
+import grovepi
+from time import sleep, monotonic
+import random
+import struct
+import threading
+
+
+class SimulatedBus:
+    """
+    Stands in for smbus.SMBus. Every transaction is recorded, delayed by latency plus byte_time per byte on the wire
+    and fails with IOError at error_rate. Responses follow the GrovePi firmware for the commands grovepi.py issues:
+    digital pin state is kept from digitalWrite, analog, ultrasonic and dht values are read from the dicts analog,
+    distance and climate which the caller may fill in. As on the device, released firmware answers with the
+    response of the last command received and ignores unknown commands. Firmware with many_commands also accepts
+    grovepi's dWriteMany_cmd and dReadMany_cmd blocks and only read commands replace its response.
+    """
+
+    RESPONSE_LENGTH = 32
+    READ_COMMANDS = frozenset([1, 3, 7, 8, grovepi.dReadMany_cmd[0], 20, 30, 40, 56])
+
+    def __init__(self, latency=0.0005, byte_time=0.0001, error_rate=0.0, seed=None, max_log=4096,
+                 firmware=(1, 2, 7), many_commands=False):
+        """
+
+        :param latency: float seconds of fixed cost per transaction
+        :param byte_time: float seconds per byte transferred (~0.0001 at 100 kHz)
+        :param error_rate: float fraction of transactions failing with IOError
+        :param seed: random seed for reproducible error patterns
+        :param max_log: int number of transactions kept in transactions
+        :param firmware: (int, int, int) version reported to grovepi.version()
+        :param many_commands: bool firmware built with the digitalWriteMany and digitalReadMany commands, to be
+                              used with grovepi.dWriteMany_supported set
+        """
+        self.latency = latency
+        self.byte_time = byte_time
+        self.error_rate = error_rate
+        self.firmware = firmware
+        self.many_commands = many_commands
+        self.transactions = deque(maxlen=max_log)   # (monotonic time, operation, address, data)
+        self.count = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.pins = dict()       # digital pin -> value last written
+        self.stuck = dict()      # digital pin -> value it reads back regardless of writes, models a failed relay
+        self.analog = dict()     # analog pin -> value 0..1023
+        self.distance = dict()   # ultrasonic pin -> cm
+        self.climate = dict()    # dht pin -> (temperature, humidity)
+        self._random = random.Random(seed)
+        self._response = [0] * SimulatedBus.RESPONSE_LENGTH
+        self._condition = threading.Condition()
+
+    def write_i2c_block_data(self, address:int, register:int, block):
+        """
+        smbus.SMBus.write_i2c_block_data
+        :return: None
+        """
+        block = list(block)
+        self._transact('write', address, tuple(block), len(block) + 2, block)
+
+    def read_byte(self, address:int):
+        """
+        smbus.SMBus.read_byte
+        :return: int
+        """
+        self._transact('read_byte', address, None, 1)
+        return self._response[0]
+
+    def read_i2c_block_data(self, address:int, register:int):
+        """
+        smbus.SMBus.read_i2c_block_data
+        :return: list of int
+        """
+        self._transact('read_block', address, None, SimulatedBus.RESPONSE_LENGTH + 1)
+        return list(self._response)
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Blocks until predicate(self) is true, checked after every transaction
+        :param predicate: callable taking the bus
+        :param timeout: float seconds or None
+        :return: bool value of predicate
+        """
+        self._condition.acquire()
+        result = self._condition.wait_for(lambda: predicate(self), timeout)
+        self._condition.release()
+        return result
+
+    def stats(self):
+        """
+        :return: dict with transaction count, errors and simulated bus busy time
+        """
+        return {'count': self.count, 'errors': self.errors, 'busy_time': self.busy_time}
+
+    def _transact(self, operation:str, address:int, data, length:int, command=None):
+        """
+        Applies the timing and error model and records the transaction, a command block reaches the simulated
+        firmware only if the transaction succeeds
+        :return: None
+        """
+        delay = self.latency + length * self.byte_time
+        if delay > 0:
+            sleep(delay)
+        self._condition.acquire()
+        self.count += 1
+        self.busy_time += delay
+        self.transactions.append((monotonic(), operation, address, data))
+        failed = self.error_rate > 0 and self._random.random() < self.error_rate
+        if failed:
+            self.errors += 1
+        elif command is not None:
+            self._command(command)
+        self._condition.notify_all()
+        self._condition.release()
+        if failed:
+            raise IOError('simulated i2c error on %s to 0x%02x' % (operation, address))
+
+    def _command(self, block):
+        """
+        Models the firmware response to a command block, caller must hold the condition
+        :param block: list of int [command, pin, arg1, arg2]
+        :return: None
+        """
+        command, pin = block[0], block[1]
+        response = [command] + [0] * (SimulatedBus.RESPONSE_LENGTH - 1)
+        if command == 1:
+            response[0] = self.stuck.get(pin, self.pins.get(pin, 0))
+        elif command == 2:
+            self.pins[pin] = block[2]
+        elif command == grovepi.dWriteMany_cmd[0] and self.many_commands:
+            count = block[1]
+            for index in range(2, 2 + 2 * count, 2):
+                self.pins[block[index]] = block[index + 1]
+        elif command == grovepi.dReadMany_cmd[0] and self.many_commands:
+            count = block[1]
+            response[1:1 + count] = [self.stuck.get(pin, self.pins.get(pin, 0)) for pin in block[2:2 + count]]
+        elif command == 3:
+            value = self.analog.get(pin, 0)
+            response[1:3] = [value >> 8, value & 0xFF]
+        elif command == 7:
+            value = self.distance.get(pin, 0)
+            response[1:3] = [value >> 8, value & 0xFF]
+        elif command == 8:
+            response[1:4] = list(self.firmware)
+        elif command == 40:
+            temperature, humidity = self.climate.get(pin, (0.0, 0.0))
+            response[1:9] = list(struct.pack('<ff', temperature, humidity))
+        if command in SimulatedBus.READ_COMMANDS or not self.many_commands:
+            self._response = response
+
+
+class SimulatedRelayIO:
+    """
+    Relay io backend for TC_Relay(io=...) with a SimulatedBus of its own, so that each controller hosted in one
+    process drives its own relay board. Sends the same digitalWriteMany and digitalReadMany command blocks as
+    grovepi does with dWriteMany_supported set, synchronously on the calling thread.
+    """
+
+    def __init__(self, bus=None):
+        """
+
+        :param bus: SimulatedBus, by default one with no latency and many_commands
+        """
+        if bus is None:
+            bus = SimulatedBus(latency=0.0, byte_time=0.0, many_commands=True)
+        self.bus = bus
+
+    def digitalWriteMany(self, pin_values):
+        """
+        grovepi.digitalWriteMany
+        :param pin_values: list [(int, int)] or dict {int: int} of pin to value
+        :return: int 1 or -1 if a write failed
+        """
+        if isinstance(pin_values, dict):
+            pin_values = pin_values.items()
+        pin_values = list(pin_values)
+        result = 1
+        for start in range(0, len(pin_values), grovepi.dWriteMany_max_pins):
+            chunk = pin_values[start:start + grovepi.dWriteMany_max_pins]
+            block = grovepi.dWriteMany_cmd + [len(chunk)]
+            for pin, value in chunk:
+                block += [pin, value]
+            try:
+                self.bus.write_i2c_block_data(grovepi.address, 1, block)
+            except IOError:
+                result = -1
+        return result
+
+    def digitalReadMany_nb(self, pins, callback=None):
+        """
+        grovepi.digitalReadMany_nb, the returned Future is already done
+        :param pins: list of int
+        :param callback: callable taking the Future
+        :return: concurrent.futures.Future resolving to a list of values in pin order, -1 where a read failed
+        """
+        pins = list(pins)
+        values = []
+        for start in range(0, len(pins), grovepi.dReadMany_max_pins):
+            chunk = pins[start:start + grovepi.dReadMany_max_pins]
+            try:
+                self.bus.write_i2c_block_data(grovepi.address, 1, grovepi.dReadMany_cmd + [len(chunk)] + chunk)
+                values.extend(self.bus.read_i2c_block_data(grovepi.address, 1)[1:1 + len(chunk)])
+            except IOError:
+                values.extend([-1] * len(chunk))
+        result = Future()
+        result.set_running_or_notify_cancel()
+        if callback is not None:
+            result.add_done_callback(callback)
+        result.set_result(values)
+        return result